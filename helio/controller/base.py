@@ -1,13 +1,123 @@
-from helio.settings import TEMPLATE_RENDERER
+import sys
+import threading
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from helio.settings import TEMPLATE_RENDERER, PARALLEL_CONTEXT_SETUP_THREADS
 from helio.helio_exceptions import UnattachedControllerError
+from helio.controller.context import RenderContext
+from helio.controller.fragment_cache import get_fragment_cache
+
+_renderer = None
+_renderer_path = None
+_setup_pool = None
+_setup_pool_lock = threading.Lock()
+
+
+def get_renderer():
+    """Return the renderer named by the TEMPLATE_RENDERER setting. It is imported on first use then kept for the life
+    of the process. The setting can name a render function, or a renderer class (which is instantiated)."""
+    global _renderer, _renderer_path
+
+    if _renderer is None or _renderer_path != TEMPLATE_RENDERER:
+        split_renderer_module = TEMPLATE_RENDERER.split('.')
+        render_function_name = split_renderer_module[-1]
+        render_module = __import__('.'.join(split_renderer_module[:-1]), globals(), locals(), render_function_name)
+        renderer = getattr(render_module, render_function_name)
+        _renderer = renderer() if isinstance(renderer, type) else renderer
+        _renderer_path = TEMPLATE_RENDERER
+
+    return _renderer
 
 
 def render(template_name, context, request, **kwargs):
-    split_renderer_module = TEMPLATE_RENDERER.split('.')
-    render_function_name = split_renderer_module[-1]
-    render_module = __import__('.'.join(split_renderer_module[:-1]), globals(), locals(), split_renderer_module[-1])
-    render_func = getattr(render_module, render_function_name)
-    return render_func(template_name, context, request, **kwargs)
+    return get_renderer()(template_name, context, request, **kwargs)
+
+
+def mark_safe(html):
+    """Mark HTML as safe to insert into a template as it is, for renderers that escape the variables in their templates
+    (e.g. Django's autoescaping). Those renderers have a mark_safe method that does this."""
+    renderer = get_renderer()
+
+    if hasattr(renderer, 'mark_safe'):
+        return renderer.mark_safe(html)
+
+    return html
+
+
+def render_stream(template_name, context, request, **kwargs):
+    """Return an iterator over the rendered template, a piece at a time. Renderers without a stream method produce the
+    whole of it as one piece."""
+    renderer = get_renderer()
+
+    if hasattr(renderer, 'stream'):
+        return renderer.stream(template_name, context, request, **kwargs)
+
+    return iter([renderer(template_name, context, request, **kwargs)])
+
+
+def get_setup_pool():
+    """Return the thread pool that controllers with parallel_context_setup set up their children's contexts on. It
+    is created, with PARALLEL_CONTEXT_SETUP_THREADS threads, on first use then shared for the life of the process."""
+    global _setup_pool
+
+    with _setup_pool_lock:
+        if _setup_pool is None:
+            _setup_pool = ThreadPool(PARALLEL_CONTEXT_SETUP_THREADS)
+
+    return _setup_pool
+
+
+def wrap_setup_task(task):
+    """Wrap a function that is going to run on the setup pool in whatever it needs from the request's thread (e.g. the
+    request context, or the active language), for renderers that have a wrap_setup_task method to do this. Each task
+    is wrapped on its own, in the request's thread."""
+    renderer = get_renderer()
+
+    if hasattr(renderer, 'wrap_setup_task'):
+        return renderer.wrap_setup_task(task)
+
+    return task
+
+
+def _run_setup_task(task):
+    return task()
+
+
+def _setup_subtree_context(controller, request, render_args):
+    # runs on the setup pool, so the exception is returned to be raised by the rendering thread
+    try:
+        controller._setup_subtree_context(request, render_args)
+    except Exception:
+        return sys.exc_info()
+
+    return None
+
+
+# attributes with a value of one of these types can be left out of the pickled state if the class has the same value
+_IMMUTABLE_DEFAULT_TYPES = (type(None), bool, int, long, float, str, unicode)
+_NO_DEFAULT = object()
+
+# when the client loads a deferred child: as soon as the page is shown, or once its placeholder scrolls into view
+DEFER_UNTIL_PAINT = 'paint'
+DEFER_UNTIL_VISIBLE = 'visible'
+
+
+class DeferredChild(object):
+    """Inserted into the context in place of a deferred child. It renders as an empty element carrying the child's
+    path, which the client replaces with the child's content when it loads it. Its id is not the child's path, so the
+    page never has two elements with that id. The child isn't in its parent's class map, as it is set up by the client
+    from its own load."""
+
+    def __init__(self, controller, defer_until):
+        self.controller = controller
+        self.defer_until = defer_until
+
+    def __unicode__(self):
+        path = self.controller.path
+        return mark_safe(u'<div id="%s-deferred" data-helio-deferred="%s" data-helio-deferred-path="%s"></div>' %
+                         (path, self.defer_until, path))
+
+    __html__ = __unicode__
 
 
 class BaseViewController(object):
@@ -17,6 +127,48 @@ class BaseViewController(object):
     has_css = False
     _css_id = None
     _template_name = None
+    _path = None
+    _view_state = None
+    _local_id = None
+    parent = None
+    is_root = False
+    request = None
+    context = None
+
+    # new ViewStates are cloned from a prototype built once per process, rather than built from scratch, unless a
+    # controller in the default tree sets this to False (e.g. if post_attach does something that must happen per tab)
+    clone_safe = True
+
+    # set to True to keep the HTML from the last render, and return it until this controller or one below it changes.
+    # It is only kept if every controller below this one sets it too. Only use it if the HTML depends on nothing but
+    # the controllers' own state (not e.g. the request or the parent's context). The HTML is not saved with the
+    # ViewState, so it is only kept between requests by a backend that keeps the controllers live in memory
+    # (LocalMemoryViewStateBackend); with the others it only saves renders within a request
+    cache_fragment = False
+    _fragment = None
+    _subtree_cacheable = False
+
+    # set to True to run the context_setup of each child's subtree concurrently (on the setup pool) before this
+    # controller's template is rendered, e.g. if the children's context_setup waits on a database or search backend.
+    # The children's context_setup must not depend on each other. The renderer's wrap_setup_task gives them what they
+    # need from the request's thread (the request context with Flask, the active language with Django)
+    parallel_context_setup = False
+    _context_ready = False
+
+    # child keys whose children are rendered as a placeholder rather than with this controller, mapped to when the
+    # client should load them (DEFER_UNTIL_PAINT or DEFER_UNTIL_VISIBLE), e.g. for slow children below the fold. Assign
+    # a new dict to change it, rather than changing it in place, so the cached class map is rebuilt
+    deferred_children = None
+
+    # attributes that only live for the length of a request (or are derived from the tree), so writing to them does
+    # not mean the ViewState needs to be saved again
+    _transient_attributes = frozenset(['request', 'context', '_render_args', '_path', '_fragment', '_class_map',
+                                       '_context_ready', '_subtree_cacheable'])
+
+    # attributes that asset_map (or which children are in the class map) is built from, so writing to them changes the
+    # class map
+    _asset_attributes = frozenset(['component_name', 'has_js', '_js_id', 'has_css', '_css_id', 'deferred_children'])
+    _class_map = None
 
     def __init__(self):
         self._children = {}
@@ -30,10 +182,85 @@ class BaseViewController(object):
         self.is_root = False
 
     def __getstate__(self):
-        self.request = None
-        self.context = None
-        self._render_args = {}
-        return self.__dict__
+        """Return a compact state for pickling. Transient attributes and the parent link (which is rebuilt by the
+        parent on load) are left out, as is any attribute that has the same immutable value as the class attribute
+        it would fall back to. Single controller stacks are stored as just the controller."""
+        state = {}
+        cls = type(self)
+
+        for name, value in self.__dict__.iteritems():
+            if name in self._transient_attributes or name == 'parent':
+                continue
+
+            if isinstance(value, _IMMUTABLE_DEFAULT_TYPES):
+                class_value = getattr(cls, name, _NO_DEFAULT)
+
+                if type(class_value) is type(value) and class_value == value:
+                    continue
+
+            state[name] = value
+
+        children = state.pop('_children', None)
+
+        if children:
+            state['_children'] = dict((child_key, stack[0] if len(stack) == 1 else stack)
+                                      for child_key, stack in children.iteritems())
+
+        return state
+
+    def __setstate__(self, state):
+        # assign through __dict__ so loading doesn't look like a change to the ViewState
+        self.__dict__.update(state)
+        self.__dict__['_render_args'] = {}
+        children = {}
+
+        for child_key, stack in state.get('_children', {}).iteritems():
+            if not isinstance(stack, list):
+                stack = [stack]
+
+            if type(child_key) is str:
+                child_key = intern(child_key)
+
+            if stack:
+                stack[-1].__dict__['parent'] = self
+
+            children[child_key] = stack
+
+        self.__dict__['_children'] = children
+
+        if type(self._local_id) is str:
+            self.__dict__['_local_id'] = intern(self._local_id)
+
+    def __setattr__(self, name, value):
+        super(BaseViewController, self).__setattr__(name, value)
+
+        if name not in self._transient_attributes:
+            self.mark_dirty()
+
+            if name in self._asset_attributes:
+                self._invalidate_class_map()
+
+    def mark_dirty(self):
+        """Flag the ViewState this controller is attached to as changed, so it is saved at the end of the request.
+        Attribute assignments do this automatically, but controllers that change an attribute in place (e.g. appending
+        to a list) should call it themselves."""
+        view_state = self.view_state
+
+        if view_state is not None:
+            view_state.mark_dirty()
+
+        self.invalidate_fragment()
+
+    def invalidate_fragment(self):
+        """Drop the cached HTML of this controller and its ancestors (as theirs includes this controller's), so they are
+        rendered again next time."""
+        controller = self
+
+        while controller is not None:
+            if controller._fragment is not None:
+                controller._fragment = None
+
+            controller = controller.parent
 
     @property
     def local_id(self):
@@ -45,12 +272,42 @@ class BaseViewController(object):
 
     @property
     def path(self):
-        if self.parent:
-            return '{0}.{1}'.format(self.parent.path, self.local_id)
-        elif self.is_root:
-            return self.local_id
+        if self._path is None:
+            if self.parent:
+                self._path = '{0}.{1}'.format(self.parent.path, self.local_id)
+            elif self.is_root:
+                self._path = self.local_id
+            else:
+                raise UnattachedControllerError("Cannot retrieve a path for an unattached controller.")
 
-        raise UnattachedControllerError("Cannot retrieve a path for an unattached controller.")
+        return self._path
+
+    def _invalidate_path(self):
+        """Clear the cached path of this controller and every controller below it, as their paths are built from
+        this one."""
+        self._path = None
+        self._class_map = None
+
+        for child_controller_stack in self._children.itervalues():
+            if len(child_controller_stack):
+                child_controller_stack[-1]._invalidate_path()
+
+    def _invalidate_class_map(self):
+        """Clear the cached class map of this controller and its ancestors, as theirs include this controller's."""
+        controller = self
+
+        while controller is not None:
+            controller._class_map = None
+            controller = controller.parent
+
+    def iter_tree(self):
+        """Yield this controller then every active (top of stack) controller below it."""
+        yield self
+
+        for child_controller_stack in self._children.itervalues():
+            if len(child_controller_stack):
+                for controller in child_controller_stack[-1].iter_tree():
+                    yield controller
 
     @property
     def view_state(self):
@@ -63,10 +320,20 @@ class BaseViewController(object):
     def make_root(self, view_state):
         self._view_state = view_state
         self.is_root = True
+        self._invalidate_path()
 
     def attach(self, parent, local_id):
         self.parent = parent
         self.local_id = local_id
+        self._invalidate_path()
+        parent._invalidate_class_map()
+
+        view_state = self.view_state
+
+        if view_state is not None:
+            view_state.index_controller_tree(self)
+            view_state.forget_sent_controller_tree(self)
+            view_state.mark_dirty()
 
     def set_child(self, child_key, child):
         if child_key in self._children and len(self._children[child_key]):
@@ -120,7 +387,18 @@ class BaseViewController(object):
         self.pre_detach()
 
     def _post_detach(self):
+        view_state = self.view_state
+
+        if view_state is not None:
+            view_state.unindex_controller_tree(self)
+
+        self.mark_dirty()
+
+        if self.parent is not None:
+            self.parent._invalidate_class_map()
+
         self.parent = None
+        self._invalidate_path()
         self.post_detach()
 
     # asset name and map generation
@@ -136,13 +414,23 @@ class BaseViewController(object):
         return asset_map
 
     def class_map_tree(self, current_tree):
-        for child_controller_stack in self._children.itervalues():
-            if len(child_controller_stack):
-                child_controller_stack[-1].class_map_tree(current_tree)
+        current_tree.update(self._subtree_class_map())
+        return current_tree
 
-        current_tree[self.path] = self.asset_map()
+    def _subtree_class_map(self):
+        """The path -> asset map of this controller and every active controller below it. It is kept until the tree
+        below this controller, or an asset attribute in it, changes, and then only the changed branch is rebuilt."""
+        if self._class_map is None:
+            class_map = {}
 
-        return current_tree
+            for child_key, child_controller_stack in self._children.iteritems():
+                if len(child_controller_stack) and child_key not in (self.deferred_children or ()):
+                    class_map.update(child_controller_stack[-1]._subtree_class_map())
+
+            class_map[self.path] = self.asset_map()
+            self._class_map = class_map
+
+        return self._class_map
 
     @property
     def js_id(self):
@@ -187,28 +475,71 @@ class BaseViewController(object):
         return request
 
     def _context_insert_children(self):
+        own_context = self.context.layer if isinstance(self.context, RenderContext) else self.context
+
         for context_var in self._children:
-            if not context_var in self.context:
+            if not context_var in own_context:
                 child = self.get_child(context_var)
 
                 if child is not None:
-                    self.context[context_var] = self.get_child(context_var)
+                    defer_until = (self.deferred_children or {}).get(context_var)
+                    self.context[context_var] = child if defer_until is None else DeferredChild(child, defer_until)
 
     def get_context(self):
+        """Return the context this controller renders with, creating a new layer on top of its parent's context if it
+        doesn't have one yet."""
         if self.context is None:
-            if self.parent:
-                self.context = self.parent.get_context()
-            else:
-                self.context = {}
+            self.context = RenderContext(self.parent.get_context() if self.parent else None)
 
         return self.context
 
     def _context_setup(self):
+        if self._context_ready:
+            # it was set up ahead of rendering by an ancestor's parallel context setup
+            self._context_ready = False
+            return
+
         self.get_context()
         self._context_insert_children()
         self.context_setup()
 
-    def render(self, context=None, request=None, **kwargs):
+    def _context_children(self):
+        """The children that were inserted into this controller's context, in order of their keys."""
+        own_context = self.context.layer if isinstance(self.context, RenderContext) else self.context
+        return [own_context[context_var] for context_var in sorted(self._children)
+                if self._children[context_var] and own_context.get(context_var) is self.get_child(context_var)]
+
+    def _needs_context_setup(self):
+        return not self._context_ready and not (self.cache_fragment and self._fragment is not None)
+
+    def _setup_subtree_context(self, request, render_args):
+        """Set up the contexts of this controller and the controllers below it, ready for them to be rendered."""
+        self.request = request
+        self._render_args = render_args
+        self._context_setup()
+        self._context_ready = True
+
+        for child in self._context_children():
+            if child._needs_context_setup():
+                child._setup_subtree_context(request, render_args)
+
+    def _setup_children_in_parallel(self):
+        # a proxy to the request (e.g. Flask's) would not resolve on the pool's threads
+        request = self.request._get_current_object() if hasattr(self.request, '_get_current_object') else self.request
+        tasks = [partial(_setup_subtree_context, child, request, self._render_args)
+                 for child in self._context_children() if child._needs_context_setup()]
+
+        if len(tasks) > 1:
+            results = get_setup_pool().map(_run_setup_task, [wrap_setup_task(task) for task in tasks])
+        else:
+            results = [task() for task in tasks]
+
+        # results are in the order of the children, so the same error is raised whichever task finished first
+        for exc_info in results:
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _prepare_render(self, context, request, kwargs):
         self._context_setup()
         if context is not None:
             self.context.update(context)
@@ -218,7 +549,99 @@ class BaseViewController(object):
 
         self._render_args.update(kwargs)
 
-        return render(self.template_name, self.context, self.request, **self._render_args)
+        if self.parallel_context_setup:
+            try:
+                self._setup_children_in_parallel()
+            except:
+                self._drop_context()
+                raise
+
+    def _drop_context(self):
+        # the children have been rendered along with the template, so the layers are no longer needed
+        self.context = None
+
+        if self.parallel_context_setup:
+            # including those of any controllers that were set up but not rendered (or failed to set up)
+            for controller in self.iter_tree():
+                if controller._context_ready or controller.context is not None:
+                    controller._context_ready = False
+                    controller.context = None
+
+    def _update_subtree_cacheable(self):
+        # set as each render returns up the tree, so a controller only has to look at its children (which have just
+        # been rendered) rather than walk its whole subtree
+        self._subtree_cacheable = self.cache_fragment and all(
+            child_controller_stack[-1]._subtree_cacheable for child_controller_stack in self._children.itervalues()
+            if child_controller_stack)
+
+    def _store_fragment(self, html, use_fragment_cache, shared_cache_key):
+        if use_fragment_cache and self._subtree_cacheable:
+            self._fragment = html
+
+        if shared_cache_key is not None:
+            get_fragment_cache().set(shared_cache_key, html)
+
+    def render(self, context=None, request=None, **kwargs):
+        use_fragment_cache = self.cache_fragment and context is None
+
+        if use_fragment_cache and self._fragment is not None:
+            return self._fragment
+
+        shared_cache_key = self.fragment_cache_key() if context is None else None
+
+        if shared_cache_key is not None:
+            html = get_fragment_cache().get(shared_cache_key)
+
+            if html is not None:
+                return html
+
+        self._prepare_render(context, request, kwargs)
+
+        try:
+            html = render(self.template_name, self.context, self.request, **self._render_args)
+        finally:
+            self._drop_context()
+
+        self._update_subtree_cacheable()
+        self._store_fragment(html, use_fragment_cache, shared_cache_key)
+
+        return html
+
+    def render_stream(self, context=None, request=None, **kwargs):
+        """Like render, but a generator that yields the HTML a piece at a time as the template is rendered, so the start
+        of it can be sent before the rest is ready."""
+        use_fragment_cache = self.cache_fragment and context is None
+
+        if use_fragment_cache and self._fragment is not None:
+            yield self._fragment
+            return
+
+        shared_cache_key = self.fragment_cache_key() if context is None else None
+
+        if shared_cache_key is not None:
+            html = get_fragment_cache().get(shared_cache_key)
+
+            if html is not None:
+                yield html
+                return
+
+        self._prepare_render(context, request, kwargs)
+        # the pieces are only kept if the whole of the HTML is going to be cached
+        chunks = [] if use_fragment_cache or shared_cache_key is not None else None
+
+        try:
+            for chunk in render_stream(self.template_name, self.context, self.request, **self._render_args):
+                if chunks is not None:
+                    chunks.append(chunk)
+
+                yield chunk
+        finally:
+            self._drop_context()
+
+        self._update_subtree_cacheable()
+
+        if chunks is not None:
+            self._store_fragment(u''.join(chunks), use_fragment_cache, shared_cache_key)
 
     def __unicode__(self):
         return self.render()
@@ -236,6 +659,13 @@ class BaseViewController(object):
         """Set up the render context with variables to go to the template."""
         pass
 
+    def fragment_cache_key(self):
+        """Return a key to share this controller's rendered HTML between every session and ViewState under, or None
+        to not share it. The key must be built from everything the HTML depends on, including the state of the
+        controllers below this one, and should start with something unique to the component so it can be invalidated
+        by prefix with invalidate_fragments."""
+        return None
+
     def post_attach(self):
         """The controller now has a ViewState (and path) so it should do things here that rely on having them."""
         pass
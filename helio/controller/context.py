@@ -0,0 +1,48 @@
+from collections import MutableMapping
+
+
+class RenderContext(MutableMapping):
+    """The context a controller renders with. Reads fall through to the parent context (normally the parent
+    controller's), but writes and deletes only affect this context's own layer, so a controller can use its parent's
+    variables without copying them or changing them for its siblings."""
+
+    def __init__(self, parent=None, layer=None):
+        self.parent = parent
+        self.layer = {} if layer is None else layer
+
+    def __getitem__(self, key):
+        context = self
+
+        while isinstance(context, RenderContext):
+            if key in context.layer:
+                return context.layer[key]
+
+            context = context.parent
+
+        if context is None:
+            raise KeyError(key)
+
+        return context[key]
+
+    def __setitem__(self, key, value):
+        self.layer[key] = value
+
+    def __delitem__(self, key):
+        del self.layer[key]
+
+    def _keys(self):
+        keys = set(self.layer)
+
+        if self.parent is not None:
+            keys.update(self.parent)
+
+        return keys
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
+
+    def __repr__(self):
+        return 'RenderContext(%r)' % dict(self)
@@ -0,0 +1,33 @@
+import unittest
+from context import RenderContext
+
+
+class RenderContextTests(unittest.TestCase):
+    def setUp(self):
+        self.parent = RenderContext(layer={'shared': 'parent', 'parent_only': 'parent'})
+        self.context = RenderContext(self.parent, {'shared': 'child'})
+
+    def test_lookup_falls_through(self):
+        """Keys not in the context's own layer are looked up in its parents."""
+        self.assertEqual(self.context['shared'], 'child')
+        self.assertEqual(self.context['parent_only'], 'parent')
+        self.assertRaises(KeyError, lambda: self.context['missing'])
+        self.assertEqual(RenderContext({'plain': 'dict'})['plain'], 'dict')
+
+    def test_writes_to_own_layer(self):
+        """Setting and deleting keys only changes the context's own layer."""
+        self.context['new'] = 'value'
+        del self.context['shared']
+        self.assertNotIn('new', self.parent)
+        self.assertEqual(self.context['shared'], 'parent')
+        self.assertRaises(KeyError, self.context.__delitem__, 'parent_only')
+
+    def test_mapping(self):
+        """The context behaves as a mapping of every key in the chain."""
+        self.assertEqual(len(self.context), 2)
+        self.assertEqual(dict(self.context), {'shared': 'child', 'parent_only': 'parent'})
+        self.assertEqual(self.context, {'shared': 'child', 'parent_only': 'parent'})
+
+
+if __name__ == '__main__':
+    unittest.main()
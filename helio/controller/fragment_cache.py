@@ -0,0 +1,112 @@
+import threading
+from collections import OrderedDict
+from helio.settings import FRAGMENT_CACHE_MAX_ENTRIES, FRAGMENT_CACHE_BACKEND, FRAGMENT_CACHE_BACKEND_OPTIONS
+
+
+class BaseFragmentCacheBackend(object):
+    """A store for rendered HTML that can be shared by processes, behind the process-wide LRU."""
+
+    def get(self, key):
+        """Return the HTML stored for key, or None."""
+        raise NotImplementedError
+
+    def set(self, key, html):
+        raise NotImplementedError
+
+    def delete_prefix(self, prefix):
+        """Delete all the HTML stored with a key that starts with prefix."""
+        raise NotImplementedError
+
+
+class LocalMemoryFragmentCache(BaseFragmentCacheBackend):
+    """A thread safe LRU of rendered HTML, holding at most max_entries fragments."""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.pop(key, None)
+
+            if html is not None:
+                self._entries[key] = html
+
+        return html
+
+    def set(self, key, html):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = html
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+
+
+class SharedFragmentCache(BaseFragmentCacheBackend):
+    """The process-wide LRU of fragments, in front of an optional backend. Fragments found in the backend are copied
+    into the LRU, and fragments that are set or deleted are set or deleted in both."""
+
+    def __init__(self, max_entries=1000, backend=None):
+        self.local = LocalMemoryFragmentCache(max_entries)
+        self.backend = backend
+
+    def get(self, key):
+        html = self.local.get(key)
+
+        if html is None and self.backend is not None:
+            html = self.backend.get(key)
+
+            if html is not None:
+                self.local.set(key, html)
+
+        return html
+
+    def set(self, key, html):
+        self.local.set(key, html)
+
+        if self.backend is not None:
+            self.backend.set(key, html)
+
+    def delete_prefix(self, prefix):
+        self.local.delete_prefix(prefix)
+
+        if self.backend is not None:
+            self.backend.delete_prefix(prefix)
+
+
+_fragment_cache = None
+
+
+def get_fragment_cache():
+    """Return the process-wide fragment cache. It is created on first use, with FRAGMENT_CACHE_MAX_ENTRIES entries and
+    the FRAGMENT_CACHE_BACKEND (instantiated with FRAGMENT_CACHE_BACKEND_OPTIONS) behind it, if one is set."""
+    global _fragment_cache
+
+    if _fragment_cache is None:
+        backend = None
+
+        if FRAGMENT_CACHE_BACKEND is not None:
+            split_backend_path = FRAGMENT_CACHE_BACKEND.split('.')
+            backend_class_name = split_backend_path[-1]
+            backend_module = __import__('.'.join(split_backend_path[:-1]), globals(), locals(), backend_class_name)
+            backend = getattr(backend_module, backend_class_name)(**FRAGMENT_CACHE_BACKEND_OPTIONS)
+
+        _fragment_cache = SharedFragmentCache(FRAGMENT_CACHE_MAX_ENTRIES, backend)
+
+    return _fragment_cache
+
+
+def invalidate_fragments(prefix):
+    """Drop every shared fragment whose cache key starts with prefix, e.g. after the data a menu is built from has
+    changed."""
+    get_fragment_cache().delete_prefix(prefix)
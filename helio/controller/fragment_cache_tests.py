@@ -0,0 +1,71 @@
+import unittest
+from mock import patch, MagicMock
+from fragment_cache import LocalMemoryFragmentCache, SharedFragmentCache, get_fragment_cache, invalidate_fragments
+
+
+class LocalMemoryFragmentCacheTests(unittest.TestCase):
+    def test_least_recently_used_evicted(self):
+        """Once there are more than max_entries fragments, the least recently used is evicted."""
+        cache = LocalMemoryFragmentCache(max_entries=2)
+        cache.set('one', 'html one')
+        cache.set('two', 'html two')
+        cache.get('one')
+        cache.set('three', 'html three')
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('one'), 'html one')
+        self.assertIsNone(cache.get('two'))
+
+    def test_delete_prefix(self):
+        """Deleting a prefix removes only the fragments whose keys start with it."""
+        cache = LocalMemoryFragmentCache()
+        cache.set('menu:en', 'menu')
+        cache.set('menu:fr', 'menu')
+        cache.set('footer', 'footer')
+        cache.delete_prefix('menu:')
+        self.assertIsNone(cache.get('menu:en'))
+        self.assertIsNone(cache.get('menu:fr'))
+        self.assertEqual(cache.get('footer'), 'footer')
+
+
+class SharedFragmentCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.backend = MagicMock()
+        self.backend.get = MagicMock(return_value=None)
+        self.cache = SharedFragmentCache(backend=self.backend)
+
+    def test_backend_fragments_copied_locally(self):
+        """A fragment found in the backend is kept in the process-wide LRU."""
+        self.backend.get.return_value = 'html'
+        self.assertEqual(self.cache.get('key'), 'html')
+        self.assertEqual(self.cache.local.get('key'), 'html')
+
+    def test_set_and_delete_in_both(self):
+        """Fragments are set in, and deleted from, both the LRU and the backend."""
+        self.cache.set('key', 'html')
+        self.backend.set.assert_called_with('key', 'html')
+        self.assertEqual(self.cache.get('key'), 'html')
+        self.backend.get.assert_not_called()
+
+        invalidate_patcher = patch('helio.controller.fragment_cache._fragment_cache', self.cache)
+        invalidate_patcher.start()
+        self.addCleanup(invalidate_patcher.stop)
+        invalidate_fragments('ke')
+        self.backend.delete_prefix.assert_called_with('ke')
+        self.assertIsNone(self.cache.get('key'))
+
+
+class GetFragmentCacheTests(unittest.TestCase):
+    @patch('helio.controller.fragment_cache._fragment_cache', None)
+    @patch('helio.controller.fragment_cache.FRAGMENT_CACHE_BACKEND',
+           'helio.controller.fragment_cache.LocalMemoryFragmentCache')
+    @patch('helio.controller.fragment_cache.FRAGMENT_CACHE_BACKEND_OPTIONS', {'max_entries': 5})
+    def test_cache_created_once(self):
+        """The cache is created from the settings once, then reused."""
+        cache = get_fragment_cache()
+        self.assertIsInstance(cache.backend, LocalMemoryFragmentCache)
+        self.assertEqual(cache.backend.max_entries, 5)
+        self.assertIs(get_fragment_cache(), cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,10 @@
 import unittest
+import threading
+import cPickle as pickle
 from mock import patch, MagicMock
-from base import BaseViewController, render
+from base import BaseViewController, DeferredChild, render, render_stream, get_renderer, DEFER_UNTIL_VISIBLE
+from context import RenderContext
+from fragment_cache import SharedFragmentCache
 from helio.helio_exceptions import UnattachedControllerError
 from helio.viewstate.viewstate import ViewState
 
@@ -55,6 +59,47 @@ class TestBaseControllerFunctions(unittest.TestCase):
         root.set_child('child-key', child)
         self.assertEqual(child.path, 'page.child-key')
 
+    def test_child_path_cached(self):
+        """A controller's path is only built once, then cached until the controller is attached elsewhere."""
+        child = BaseViewController()
+        grandchild = BaseViewController()
+        self.root.set_child('child-key', child)
+        child.set_child('grandchild-key', grandchild)
+        self.assertEqual(grandchild.path, 'page.child-key.grandchild-key')
+
+        child.local_id = 'not-used'
+        self.assertEqual(grandchild.path, 'page.child-key.grandchild-key')
+
+        self.root.set_child('other-key', child)
+        self.assertEqual(child.path, 'page.other-key')
+        self.assertEqual(grandchild.path, 'page.other-key.grandchild-key')
+
+    def test_detached_controller_path_cleared(self):
+        """Once a controller is detached its cached path is cleared, so it can't be used by mistake."""
+        child1 = BaseViewController()
+        child2 = BaseViewController()
+        self.root.set_child('child-key', child1)
+        self.assertEqual(child1.path, 'page.child-key')
+        self.root.set_child('child-key', child2)
+
+        with self.assertRaises(UnattachedControllerError):
+            child1.path
+
+    def test_iter_tree(self):
+        """iter_tree yields the controller and all the active controllers below it, but not controllers lower down
+        a stack."""
+        child_one = BaseViewController()
+        child_two = BaseViewController()
+        child_three = BaseViewController()
+        self.root.set_child('one', child_one)
+        self.root.push_child('two', child_two)
+        self.root.push_child('two', child_three)
+        tree = list(self.root.iter_tree())
+        self.assertEqual(len(tree), 3)
+        self.assertEqual(tree[0], self.root)
+        self.assertIn(child_one, tree)
+        self.assertIn(child_three, tree)
+
     def test_child_post_attach_call(self):
         """Child's post_attach method is called after it is attached to a parent."""
         root = BaseViewController()
@@ -219,6 +264,66 @@ class TestBaseControllerFunctions(unittest.TestCase):
         self.assertEqual(asset_map_tree['page.three'], 'asset_three')
         self.assertEqual(asset_map_tree['page.three.four'], 'asset_three_four')
 
+    def test_class_map_tree_cached(self):
+        """The class map is cached, and a tree change only rebuilds the changed branch."""
+        child_one = BaseViewController()
+        child_one.asset_map = MagicMock(return_value='asset_one')
+        child_two = BaseViewController()
+        child_two.asset_map = MagicMock(return_value='asset_two')
+        self.root.set_child('one', child_one)
+        self.root.set_child('two', child_two)
+        self.root.class_map_tree({})
+        self.root.class_map_tree({})
+        self.assertEqual(child_one.asset_map.call_count, 1)
+
+        new_child = BaseViewController()
+        new_child.asset_map = MagicMock(return_value='asset_new')
+        child_two.push_child('three', new_child)
+        asset_map_tree = self.root.class_map_tree({})
+        self.assertEqual(asset_map_tree['page.two.three'], 'asset_new')
+        self.assertEqual(child_one.asset_map.call_count, 1)
+        self.assertEqual(child_two.asset_map.call_count, 2)
+
+        child_two.pop_child('three')
+        self.assertNotIn('page.two.three', self.root.class_map_tree({}))
+
+    def test_class_map_tree_asset_change(self):
+        """Changing a controller's assets changes the cached class map."""
+        child_one = BaseViewController()
+        self.root.set_child('one', child_one)
+        self.assertEqual(self.root.class_map_tree({})['page.one'], {})
+        child_one.js_id = 'script.id'
+        self.assertEqual(self.root.class_map_tree({})['page.one'], {'script': 'script.id'})
+
+    def test_class_map_tree_deferred_child(self):
+        """Deferred children, and the controllers below them, are left out of their parent's class map but are in
+        their own."""
+        child_one = BaseViewController()
+        child_one.set_child('two', BaseViewController())
+        self.root.set_child('one', child_one)
+        self.assertIn('page.one.two', self.root.class_map_tree({}))
+        self.root.deferred_children = {'one': DEFER_UNTIL_VISIBLE}
+        self.assertEqual(self.root.class_map_tree({}).keys(), ['page'])
+        self.assertEqual(sorted(child_one.class_map_tree({})), ['page.one', 'page.one.two'])
+
+    def test_deferred_children_not_shared(self):
+        """Controllers have no deferred children by default, and deferring one controller's children leaves the
+        others' alone."""
+        other = BaseViewController()
+        self.root.deferred_children = {'one': DEFER_UNTIL_VISIBLE}
+        self.assertIsNone(other.deferred_children)
+        self.assertIsNone(BaseViewController.deferred_children)
+
+    def test_class_map_tree_moved_controller(self):
+        """A controller that is moved to a new path is mapped under its new path."""
+        child_one = BaseViewController()
+        child_one.set_child('two', BaseViewController())
+        self.root.set_child('one', child_one)
+        self.root.class_map_tree({})
+        self.root.set_child('one', BaseViewController())
+        self.root.set_child('moved', child_one)
+        self.assertEqual(sorted(self.root.class_map_tree({})), ['page', 'page.moved', 'page.moved.two', 'page.one'])
+
     def test_template_name_generation(self):
         """Template name should be component_name.html if not set, otherwise it should be whatever was set."""
         self.root.component_name = 'test.component'
@@ -227,12 +332,46 @@ class TestBaseControllerFunctions(unittest.TestCase):
         self.assertEqual(self.root.template_name, 'mock-template-name')
 
     def test_parent_context_get(self):
-        """If a controller doesn't have a context, it will take its parent's as a starting point."""
+        """If a controller doesn't have a context, it gets a new layer on top of its parent's."""
+        child_one = BaseViewController()
+        self.root.set_child('one', child_one)
+        parent_context = {'parent_value': 'value'}
+        self.root.context = parent_context
+        context = child_one.get_context()
+        self.assertIsInstance(context, RenderContext)
+        self.assertIs(context.parent, parent_context)
+        self.assertEqual(context['parent_value'], 'value')
+
+    def test_child_context_layer(self):
+        """Writes to a child's context only go to its own layer, which is dropped once it has rendered."""
+        child_one = BaseViewController()
+        child_two = BaseViewController()
+        self.root.set_child('one', child_one)
+        self.root.set_child('two', child_two)
+        child_one.template_name = 'child.html'
+        root_context = self.root.get_context()
+        child_one.get_context()['value'] = 'child'
+
+        self.assertNotIn('value', root_context)
+        self.assertNotIn('value', child_two.get_context())
+
+        with patch('helio.controller.base.render', return_value='html'):
+            child_one.render()
+
+        self.assertIsNone(child_one.context)
+        self.assertNotIn('value', child_one.get_context())
+
+    @patch('helio.controller.base.render')
+    def test_children_inserted_over_parent_context(self, mock_render):
+        """A child is inserted into its parent's context even if an ancestor's context has the same key."""
         child_one = BaseViewController()
+        grandchild = BaseViewController()
         self.root.set_child('one', child_one)
-        mock_context = MagicMock()
-        self.root.context = mock_context
-        self.assertEqual(mock_context, child_one.get_context())
+        child_one.set_child('one', grandchild)
+        child_one.template_name = 'child.html'
+        self.root.get_context()['one'] = child_one
+        child_one.render()
+        self.assertIs(mock_render.call_args[0][1]['one'], grandchild)
 
     def test_parent_request_get(self):
         """If a controller does not have a request object set, it should get one from its parent."""
@@ -274,6 +413,25 @@ class TestBaseControllerFunctions(unittest.TestCase):
                                        other_arg='arg')
 
 
+    @patch('helio.controller.base.render', return_value='html')
+    def test_deferred_child_placeholder(self, mock_render):
+        """A deferred child is inserted as a placeholder carrying its path, and isn't set up or rendered with its
+        parent."""
+        self.root.template_name = 'mock_template.html'
+        child_one = BaseViewController()
+        child_one.context_setup = MagicMock()
+        child_one.render = MagicMock()
+        self.root.set_child('one', child_one)
+        self.root.deferred_children = {'one': DEFER_UNTIL_VISIBLE}
+        self.root.render()
+
+        placeholder = mock_render.call_args[0][1]['one']
+        self.assertIsInstance(placeholder, DeferredChild)
+        self.assertEqual(unicode(placeholder), u'<div id="page.one-deferred" data-helio-deferred="visible" '
+                                                u'data-helio-deferred-path="page.one"></div>')
+        child_one.context_setup.assert_not_called()
+        child_one.render.assert_not_called()
+
     @patch('helio.controller.base.render')
     def test_child_controller_context_add(self, mock_render):
         """The controller should insert child components into the context."""
@@ -301,6 +459,19 @@ class TestBaseControllerFunctions(unittest.TestCase):
             mock_module.render.assert_called_with('template.html', 'context', 'request', environment='environment',
                                                   other_arg='other_arg')
 
+    @patch('helio.controller.base.TEMPLATE_RENDERER', 'mock.module.Renderer')
+    def test_renderer_resolved_once(self):
+        """The renderer is imported once, and a renderer class is instantiated."""
+        mock_module = MagicMock()
+        mock_module.Renderer = type('Renderer', (object,), {'__call__': MagicMock(return_value='html')})
+
+        with patch('__builtin__.__import__', return_value=mock_module) as mock_import:
+            renderer = get_renderer()
+            self.assertEqual(render('template.html', 'context', 'request'), 'html')
+            self.assertIsInstance(renderer, mock_module.Renderer)
+            self.assertIs(get_renderer(), renderer)
+            self.assertEqual(mock_import.call_count, 1)
+
     @patch('helio.controller.base.render')
     def test_parent_renderargs_get(self, mock_render):
         """A controller uses its parent's render args as a starting point, updating them with the incoming kwargs before
@@ -314,12 +485,78 @@ class TestBaseControllerFunctions(unittest.TestCase):
         mock_render.assert_called_with('template_name', {}, 'request', parent_arg='arg_one', test_arg='an_arg')
 
     def test_getstate(self):
-        """The controller's __getstate__ method sets request and context to None as these cannot reliably be pickled."""
+        """The controller's __getstate__ method leaves out request and context as these cannot reliably be pickled."""
         self.root.context = 'context'
         self.root.request = 'request'
         serialize_data = self.root.__getstate__()
-        self.assertIsNone(serialize_data['request'])
-        self.assertIsNone(serialize_data['context'])
+        self.assertNotIn('request', serialize_data)
+        self.assertNotIn('context', serialize_data)
+
+    def test_getstate_compact(self):
+        """The pickled state leaves out the parent, the cached path, and attributes with their class default value.
+        Single controller stacks are stored as the controller itself."""
+        child_one = BaseViewController()
+        child_two = BaseViewController()
+        child_three = BaseViewController()
+        self.root.set_child('one', child_one)
+        self.root.push_child('two', child_two)
+        self.root.push_child('two', child_three)
+        child_one.path
+
+        self.assertEqual(child_one.__getstate__(), {'_local_id': 'one'})
+        self.assertEqual(self.root.__getstate__()['_children'], {'one': child_one, 'two': [child_two, child_three]})
+
+    def test_pickle_round_trip(self):
+        """After unpickling, parent links are rebuilt for active children and paths work again."""
+        child_one = BaseViewController()
+        child_two = BaseViewController()
+        child_three = BaseViewController()
+        self.root.set_child('one', child_one)
+        child_one.set_child('two', child_two)
+        child_one.push_child('two', child_three)
+        child_three.value = 'a value'
+
+        root = pickle.loads(pickle.dumps(self.root, pickle.HIGHEST_PROTOCOL))
+        new_one = root.get_child('one')
+        new_three = new_one.get_child('two')
+        self.assertEqual(new_one.parent, root)
+        self.assertEqual(new_three.parent, new_one)
+        self.assertIsNone(new_one._children['two'][0].parent)
+        self.assertEqual(new_three.path, 'page.one.two')
+        self.assertEqual(new_three.value, 'a value')
+        self.assertEqual(new_three._render_args, {})
+        self.assertFalse(root.view_state.dirty)
+
+    def test_attribute_write_marks_view_state_dirty(self):
+        """Setting an attribute on an attached controller marks its ViewState as dirty, unless the attribute only
+        lives for the request."""
+        child = BaseViewController()
+        self.root.set_child('one', child)
+        self.view_state.mark_clean()
+        child.request = 'request'
+        child.context = {}
+        self.assertFalse(self.view_state.dirty)
+        child.some_value = 'value'
+        self.assertTrue(self.view_state.dirty)
+
+    def test_tree_change_marks_view_state_dirty(self):
+        """Setting, pushing and popping children marks the ViewState as dirty."""
+        self.view_state.mark_clean()
+        self.root.set_child('one', BaseViewController())
+        self.assertTrue(self.view_state.dirty)
+
+        self.view_state.mark_clean()
+        self.root.push_child('one', BaseViewController())
+        self.assertTrue(self.view_state.dirty)
+
+        self.view_state.mark_clean()
+        self.root.pop_child('one')
+        self.assertTrue(self.view_state.dirty)
+
+    def test_unattached_controller_mark_dirty(self):
+        """Marking an unattached controller dirty does nothing."""
+        bc = BaseViewController()
+        bc.mark_dirty()
 
     def test_unicode(self):
         """The __unicode__ method should call render with no args."""
@@ -328,5 +565,302 @@ class TestBaseControllerFunctions(unittest.TestCase):
         self.root.render.assert_called_with()
 
 
+class CachedController(BaseViewController):
+    cache_fragment = True
+    template_name = 'cached.html'
+
+
+class TestFragmentCache(unittest.TestCase):
+    def setUp(self):
+        self.root = CachedController()
+        self.view_state = ViewState(self.root)
+        self.child_one = CachedController()
+        self.child_two = CachedController()
+        self.root.set_child('one', self.child_one)
+        self.root.set_child('two', self.child_two)
+
+        render_patcher = patch('helio.controller.base.render', side_effect=self.render_tree)
+        self.mock_render = render_patcher.start()
+        self.addCleanup(render_patcher.stop)
+
+    def render_tree(self, template_name, context, request, **kwargs):
+        return '<%s>' % ''.join(unicode(context.layer[child_key]) for child_key in sorted(context.layer))
+
+    def test_fragment_reused(self):
+        """A cached controller's HTML is reused until something changes."""
+        html = self.root.render()
+        self.assertEqual(self.mock_render.call_count, 3)
+        self.assertEqual(self.root.render(), html)
+        self.assertEqual(self.mock_render.call_count, 3)
+
+    def test_change_rerenders_dirty_path(self):
+        """Changing a controller re-renders it and its ancestors, but its siblings' cached HTML is reused."""
+        self.root.render()
+        self.child_one.value = 'changed'
+        self.assertIsNone(self.root._fragment)
+        self.assertIsNotNone(self.child_two._fragment)
+        self.mock_render.reset_mock()
+        self.root.render()
+        self.assertEqual(self.mock_render.call_count, 2)
+
+    def test_tree_change_rerenders(self):
+        """Setting, or popping, a child drops the parent's cached HTML."""
+        self.root.render()
+        self.child_one.set_child('new', CachedController())
+        self.assertIsNone(self.root._fragment)
+        self.root.render()
+        self.child_one.pop_child('new')
+        self.assertIsNone(self.child_one._fragment)
+        self.assertIsNone(self.root._fragment)
+
+    def test_uncached_descendant_not_cached(self):
+        """HTML is only kept if every controller below also caches its fragment."""
+        self.child_two.set_child('live', BaseViewController())
+        self.child_two.get_child('live').template_name = 'live.html'
+        self.root.render()
+        self.assertIsNone(self.root._fragment)
+        self.assertIsNotNone(self.child_one._fragment)
+
+    def test_cacheability_from_children(self):
+        """Whether a subtree can be cached is worked out from the children as they render, without walking the tree."""
+        with patch.object(BaseViewController, 'iter_tree') as mock_iter_tree:
+            self.root.render()
+            mock_iter_tree.assert_not_called()
+
+        self.assertIsNotNone(self.root._fragment)
+
+    def test_render_with_context_not_cached(self):
+        """Rendering with an extra context bypasses the cache."""
+        self.root.render()
+        self.mock_render.reset_mock()
+        self.child_one.render({'extra': 'value'})
+        self.assertEqual(self.mock_render.call_count, 1)
+
+    def test_fragment_not_pickled(self):
+        """The cached HTML is not pickled, and setting it doesn't mark the ViewState dirty."""
+        self.view_state.mark_clean()
+        self.root.render()
+        self.assertFalse(self.view_state.dirty)
+        self.assertNotIn('_fragment', self.root.__getstate__())
+
+
+class SharedCacheController(BaseViewController):
+    template_name = 'shared.html'
+
+    def __init__(self, cache_key):
+        super(SharedCacheController, self).__init__()
+        self.cache_key = cache_key
+        self.context_setup = MagicMock()
+
+    def fragment_cache_key(self):
+        return self.cache_key
+
+
+@patch('helio.controller.base.render', return_value='html')
+class TestSharedFragmentCache(unittest.TestCase):
+    def setUp(self):
+        cache_patcher = patch('helio.controller.base.get_fragment_cache', return_value=SharedFragmentCache())
+        self.cache = cache_patcher.start().return_value
+        self.addCleanup(cache_patcher.stop)
+
+    def test_fragment_shared(self, mock_render):
+        """Controllers with the same cache key share rendered HTML, without setting up their context."""
+        controller_one = SharedCacheController('menu')
+        controller_two = SharedCacheController('menu')
+        self.assertEqual(controller_one.render(), 'html')
+        self.assertEqual(controller_two.render(), 'html')
+        self.assertEqual(self.cache.get('menu'), 'html')
+        self.assertEqual(mock_render.call_count, 1)
+        controller_two.context_setup.assert_not_called()
+
+    def test_invalidated_fragment_rendered(self, mock_render):
+        """Once a fragment is invalidated it is rendered again."""
+        controller = SharedCacheController('menu:en')
+        controller.render()
+        self.cache.delete_prefix('menu:')
+        controller.render()
+        self.assertEqual(mock_render.call_count, 2)
+
+    def test_not_shared(self, mock_render):
+        """Controllers without a cache key, or rendered with an extra context, don't use the shared cache."""
+        SharedCacheController(None).render()
+        SharedCacheController('menu').render({'extra': 'value'})
+        self.assertEqual(len(self.cache.local), 0)
+        self.assertEqual(mock_render.call_count, 2)
+
+
+class TestRenderStream(unittest.TestCase):
+    def setUp(self):
+        renderer_patcher = patch('helio.controller.base.get_renderer')
+        self.renderer = renderer_patcher.start().return_value
+        self.addCleanup(renderer_patcher.stop)
+        self.renderer.stream = MagicMock(side_effect=lambda template_name, context, request, **kwargs: iter(
+            ['<div>', 'content', '</div>']))
+
+    def test_render_stream(self):
+        """The HTML is produced a piece at a time, from the renderer's stream method."""
+        controller = BaseViewController()
+        controller.template_name = 'stream.html'
+        self.assertEqual(list(controller.render_stream(request='request', environment='env')),
+                         ['<div>', 'content', '</div>'])
+        self.assertEqual(self.renderer.stream.call_args[0][0], 'stream.html')
+        self.assertEqual(self.renderer.stream.call_args[0][2], 'request')
+        self.assertEqual(self.renderer.stream.call_args[1], {'environment': 'env'})
+        self.assertIsNone(controller.context)
+
+    def test_renderer_without_stream(self):
+        """A renderer without a stream method produces the whole of the HTML as one piece."""
+        renderer = MagicMock(spec=['__call__'], return_value='html')
+
+        with patch('helio.controller.base.get_renderer', return_value=renderer):
+            self.assertEqual(list(render_stream('template.html', {}, None)), ['html'])
+
+    def test_fragment_cached(self):
+        """A cached controller's streamed HTML is kept, and produced in one piece the next time."""
+        controller = CachedController()
+        self.assertEqual(u''.join(controller.render_stream()), '<div>content</div>')
+        self.assertEqual(controller._fragment, '<div>content</div>')
+        self.assertEqual(list(controller.render_stream()), ['<div>content</div>'])
+        self.assertEqual(self.renderer.stream.call_count, 1)
+
+    def test_shared_fragment_cached(self):
+        """Streamed HTML is stored in, and taken from, the shared cache."""
+        with patch('helio.controller.base.get_fragment_cache', return_value=SharedFragmentCache()) as mock_cache:
+            list(SharedCacheController('menu').render_stream())
+            self.assertEqual(mock_cache.return_value.get('menu'), '<div>content</div>')
+            self.assertEqual(list(SharedCacheController('menu').render_stream()), ['<div>content</div>'])
+            self.assertEqual(self.renderer.stream.call_count, 1)
+
+
+class SetupRecordingController(BaseViewController):
+    template_name = 'recording.html'
+
+    def __init__(self, setup=None):
+        super(SetupRecordingController, self).__init__()
+        self.setup = setup
+
+    def context_setup(self):
+        self.context['setup_thread'] = threading.current_thread()
+        self.context['request'] = self.request
+        self.context['render_args'] = dict(self._render_args)
+
+        if self.setup is not None:
+            self.setup(self)
+
+
+class TestParallelContextSetup(unittest.TestCase):
+    def setUp(self):
+        self.root = BaseViewController()
+        self.root.template_name = 'root.html'
+        self.root.parallel_context_setup = True
+        self.view_state = ViewState(self.root)
+        self.rendered_contexts = {}
+
+        render_patcher = patch('helio.controller.base.render', side_effect=self.render_tree)
+        self.mock_render = render_patcher.start()
+        self.addCleanup(render_patcher.stop)
+
+    def render_tree(self, template_name, context, request, **kwargs):
+        self.rendered_contexts[template_name] = dict(context.layer)
+        return '<%s>' % ''.join(unicode(context.layer[key]) for key in sorted(context.layer)
+                                if isinstance(context.layer[key], BaseViewController))
+
+    def test_children_set_up_concurrently(self):
+        """Each child's context is set up on the pool, at the same time as its siblings', and only once."""
+        one_started, two_started = threading.Event(), threading.Event()
+        waited = {}
+
+        def wait_for_sibling(started, sibling_started):
+            def setup(controller):
+                started.set()
+                sibling_started.wait(5)
+                waited[controller.local_id] = sibling_started.is_set()
+            return setup
+
+        child_one = SetupRecordingController(wait_for_sibling(one_started, two_started))
+        child_two = SetupRecordingController(wait_for_sibling(two_started, one_started))
+        self.root.set_child('one', child_one)
+        self.root.set_child('two', child_two)
+        self.root.render()
+
+        self.assertEqual(waited, {'one': True, 'two': True})
+        self.assertIsNot(self.rendered_contexts['recording.html']['setup_thread'], threading.current_thread())
+
+    def test_tasks_wrapped_by_renderer(self):
+        """Each child's setup task is wrapped by the renderer's wrap_setup_task, in the rendering thread, and the
+        wrapped task is what runs on the pool."""
+        wrapped_in = []
+
+        def wrap_setup_task(task):
+            wrapped_in.append(threading.current_thread())
+
+            def setup_task():
+                setup_threads.append(threading.current_thread())
+                return task()
+
+            return setup_task
+
+        setup_threads = []
+        self.root.set_child('one', SetupRecordingController())
+        self.root.set_child('two', SetupRecordingController())
+
+        with patch('helio.controller.base.get_renderer', return_value=MagicMock(wrap_setup_task=wrap_setup_task)):
+            self.root.render()
+
+        self.assertEqual(wrapped_in, [threading.current_thread()] * 2)
+        self.assertEqual(len(setup_threads), 2)
+        self.assertNotIn(threading.current_thread(), setup_threads)
+
+    def test_request_and_render_args_propagated(self):
+        """The children, and the controllers below them, are set up with the request and render args of the parent,
+        with a request proxy resolved to the object behind it."""
+        request = MagicMock()
+        request._get_current_object = MagicMock(return_value='request')
+        child_one = SetupRecordingController()
+        grandchild = SetupRecordingController()
+        grandchild.template_name = 'grandchild.html'
+        self.root.set_child('one', child_one)
+        self.root.set_child('two', SetupRecordingController())
+        child_one.set_child('grandchild', grandchild)
+        self.root.render(request=request, environment='env')
+
+        for template_name in ('recording.html', 'grandchild.html'):
+            self.assertEqual(self.rendered_contexts[template_name]['request'], 'request')
+            self.assertEqual(self.rendered_contexts[template_name]['render_args'], {'environment': 'env'})
+
+        self.assertEqual(self.mock_render.call_args_list[-1][1], {'environment': 'env'})
+
+    def test_errors_raised_in_child_order(self):
+        """If several children fail, the error from the first (by key) is raised, whichever finished first."""
+        def fail_after(delay, error):
+            def setup(controller):
+                threading.Event().wait(delay)
+                raise error
+            return setup
+
+        self.root.set_child('a', SetupRecordingController(fail_after(0.05, KeyError('a'))))
+        self.root.set_child('b', SetupRecordingController(fail_after(0, ValueError('b'))))
+
+        with self.assertRaises(KeyError):
+            self.root.render()
+
+        self.assertFalse(any(controller._context_ready or controller.context is not None
+                             for controller in self.root.iter_tree()))
+
+    def test_unrendered_contexts_dropped(self):
+        """A child that was set up but not rendered doesn't keep its context for the next render."""
+        setup_calls = []
+        child_one = SetupRecordingController(lambda controller: setup_calls.append(controller.local_id))
+        self.root.set_child('one', child_one)
+        self.root.set_child('two', SetupRecordingController())
+        self.mock_render.side_effect = lambda template_name, context, request, **kwargs: 'html'
+        self.root.render()
+        self.root.render()
+
+        self.assertEqual(setup_calls, ['one', 'one'])
+        self.assertIsNone(child_one.context)
+        self.assertFalse(child_one._context_ready)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -10,3 +10,7 @@ class ControllerImportError(Exception):
 class ViewStateError(Exception):
     """General ViewState exception."""
 
+
+class HelioConfigurationError(Exception):
+    """Raised when the Helio settings can't be used together."""
+
@@ -1,13 +1,103 @@
-from django.template.loader import render_to_string
-from django.template import RequestContext
+from copy import copy
+from django.conf import settings
+from django.template.loader import render_to_string, get_template
+from django.template import RequestContext, Context
+from django.utils.encoding import force_unicode
+from django.utils.safestring import mark_safe
+from django.utils import translation
+from django.db import connections
+
+# the request attribute that the request's RequestContext is kept in
+REQUEST_CONTEXT_ATTRIBUTE = '_helio_request_context'
 
 
 def get_request_context(request):
-    return RequestContext(request)
+    """Return the RequestContext for the request. It is only created (running the context processors) the first time,
+    then kept on the request for every other controller rendered during it."""
+    request_context = vars(request).get(REQUEST_CONTEXT_ATTRIBUTE)
+
+    if request_context is None:
+        request_context = RequestContext(request)
+        setattr(request, REQUEST_CONTEXT_ATTRIBUTE, request_context)
+
+    return request_context
+
+
+def get_controller_context(request=None):
+    """Return a context to render one controller with. This is a copy of the request's RequestContext (which only
+    copies its list of layers), so the layers pushed for one controller are never seen by another."""
+    if request:
+        return copy(get_request_context(request))
+
+    return Context()
 
 
 def render(template, context, request=None):
     if request:
-        return render_to_string(template, context, context_instance=get_request_context(request))
+        return render_to_string(template, context, context_instance=get_controller_context(request))
+
+    return render_to_string(template, context)
+
+
+class DjangoRenderer(object):
+    """Renders like render, but keeps each compiled template so the template loaders are only searched once per
+    template name. With DEBUG on the templates are loaded every time, as they would be by render, so changes to them
+    are picked up."""
+
+    def __init__(self):
+        self._templates = {}
+
+    def get_template(self, template_name):
+        if settings.DEBUG:
+            return get_template(template_name)
+
+        template = self._templates.get(template_name)
+
+        if template is None:
+            template = self._templates[template_name] = get_template(template_name)
+
+        return template
+
+    def clear(self):
+        self._templates.clear()
+
+    # the HTML helio inserts into templates itself (e.g. deferred children's placeholders) isn't autoescaped
+    mark_safe = staticmethod(mark_safe)
+
+    @staticmethod
+    def wrap_setup_task(task):
+        """Run the task with the request's language active, and close the database connections it opened afterwards,
+        as nothing else closes them on the setup pool's threads."""
+        language = translation.get_language()
+
+        def setup_task():
+            translation.activate(language)
+
+            try:
+                return task()
+            finally:
+                translation.deactivate()
+
+                for connection in connections.all():
+                    connection.close()
+
+        return setup_task
+
+    def __call__(self, template, context, request=None):
+        context_instance = get_controller_context(request)
+        context_instance.update(context)
+        return self.get_template(template).render(context_instance)
+
+    def stream(self, template, context, request=None):
+        """Render the template one top level node at a time, yielding the output of each. A template that extends
+        another is a single node, so its output comes in one piece."""
+        context_instance = get_controller_context(request)
+        context_instance.update(context)
+        nodelist = self.get_template(template).nodelist
+        context_instance.render_context.push()
 
-    return render_to_string(template, context)
\ No newline at end of file
+        try:
+            for node in nodelist:
+                yield force_unicode(nodelist.render_node(node, context_instance))
+        finally:
+            context_instance.render_context.pop()
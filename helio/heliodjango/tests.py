@@ -5,8 +5,12 @@ try:
     from django.conf import settings
     settings.configure()
     from finders import ComponentStaticFinder, ComponentTemplateLoader, walk_component_base_dir, helio_static_path
-    from renderers import render, RequestContext, get_request_context
+    from renderers import render, RequestContext, Context, get_request_context, get_controller_context, \
+        DjangoRenderer
     from middleware import CSRFHeaderInject
+    from django.template.base import NodeList, Template
+    from django.utils import translation
+    from helio.controller.base import DeferredChild, DEFER_UNTIL_PAINT
 
     class StaticFinderTests(unittest.TestCase):
         def setUp(self):
@@ -184,6 +188,9 @@ try:
             self.assertEqual(sources[0], 'MOCK_BASE_DIR/component/child/another.html')
             self.assertEqual(sources[1], 'MOCK_BASE_DIR_2/component/child/another.html')
 
+    class MockHttpRequest(object):
+        pass
+
     class RendererTests(unittest.TestCase):
         @patch.object(RequestContext, '__init__', return_value=None)
         def test_request_context_create(self, mock_rc_init):
@@ -193,15 +200,39 @@ try:
             mock_rc_init.assert_called_with(mock_request)
             self.assertIsInstance(rc, RequestContext)
 
+        @patch.object(RequestContext, '__init__', return_value=None)
+        def test_request_context_reused(self, mock_rc_init):
+            """The RequestContext is only created once per request."""
+            request = MockHttpRequest()
+            rc = get_request_context(request)
+            self.assertIs(get_request_context(request), rc)
+            self.assertEqual(mock_rc_init.call_count, 1)
+            self.assertIsNot(get_request_context(MockHttpRequest()), rc)
+
+        def test_controller_contexts_separate(self):
+            """Each controller gets its own copy of the request's context, so variables pushed for one controller are
+            not seen by another."""
+            request = MockHttpRequest()
+
+            with patch('helio.heliodjango.renderers.get_request_context', return_value=Context({'shared': 1})):
+                context_one = get_controller_context(request)
+                context_one.update({'own': 1})
+                context_two = get_controller_context(request)
+
+            self.assertEqual(context_two['shared'], 1)
+            self.assertNotIn('own', context_two)
+            self.assertIsInstance(get_controller_context(), Context)
+
         @patch('helio.heliodjango.renderers.render_to_string')
         def test_render_call_with_request(self, mock_render):
-            """Render function calls the render_to_string shortcut with the RequestContext if a request is supplied."""
+            """Render function calls the render_to_string shortcut with the controller's context if a request is
+            supplied."""
             mock_rc = MagicMock()
-            with patch('helio.heliodjango.renderers.get_request_context', return_value=mock_rc) as mock_rc_init:
+            with patch('helio.heliodjango.renderers.get_controller_context', return_value=mock_rc) as mock_gcc:
                 context = MagicMock()
                 request = MagicMock()
                 render('template_name.html', context, request)
-                mock_rc_init.assert_called_with(request)
+                mock_gcc.assert_called_with(request)
                 mock_render.assert_called_with('template_name.html', context, context_instance=mock_rc)
 
         @patch('helio.heliodjango.renderers.render_to_string')
@@ -212,6 +243,81 @@ try:
             render('template_name.html', context)
             mock_render.assert_called_with('template_name.html', context)
 
+    class DjangoRendererTests(unittest.TestCase):
+        def setUp(self):
+            self.renderer = DjangoRenderer()
+            self.template = MagicMock()
+            self.template.render = MagicMock(return_value='rendered')
+
+        def test_template_cached(self):
+            """The template is only loaded the first time it is rendered."""
+            with patch('helio.heliodjango.renderers.get_template', return_value=self.template) as mock_get_template:
+                self.renderer('template_name.html', {})
+                self.assertEqual(self.renderer('template_name.html', {}), 'rendered')
+                mock_get_template.assert_called_once_with('template_name.html')
+
+        @patch('helio.heliodjango.renderers.settings.DEBUG', True)
+        def test_template_not_cached_with_debug(self):
+            """With DEBUG on, the template is loaded every time it is rendered, so changes to it are seen."""
+            with patch('helio.heliodjango.renderers.get_template', return_value=self.template) as mock_get_template:
+                self.renderer('template_name.html', {})
+                self.renderer('template_name.html', {})
+                self.assertEqual(mock_get_template.call_count, 2)
+
+        def test_render_with_request(self):
+            """The template is rendered with the controller's copy of the request context, with the controller's
+            context pushed on to it."""
+            mock_context = MagicMock()
+
+            with patch('helio.heliodjango.renderers.get_template', return_value=self.template):
+                with patch('helio.heliodjango.renderers.get_controller_context', return_value=mock_context) as mock_gcc:
+                    self.renderer('template_name.html', {'key': 'value'}, 'request')
+                    mock_gcc.assert_called_with('request')
+                    mock_context.update.assert_called_with({'key': 'value'})
+                    self.template.render.assert_called_with(mock_context)
+
+        def test_stream(self):
+            """Streaming renders the template's top level nodes one at a time, within the render context."""
+            mock_context = MagicMock()
+            self.template.nodelist = NodeList([MagicMock(), MagicMock()])
+            self.template.nodelist[0].render = MagicMock(return_value='first')
+            self.template.nodelist[1].render = MagicMock(return_value='second')
+
+            with patch('helio.heliodjango.renderers.get_template', return_value=self.template):
+                with patch('helio.heliodjango.renderers.get_controller_context', return_value=mock_context):
+                    chunks = self.renderer.stream('template_name.html', {'key': 'value'}, 'request')
+                    self.assertEqual(next(chunks), 'first')
+                    self.template.nodelist[1].render.assert_not_called()
+                    self.assertEqual(list(chunks), ['second'])
+                    self.template.nodelist[0].render.assert_called_with(mock_context)
+                    mock_context.render_context.push.assert_called_with()
+                    mock_context.render_context.pop.assert_called_with()
+
+        @patch('helio.controller.base.TEMPLATE_RENDERER', 'helio.heliodjango.renderers.DjangoRenderer')
+        def test_deferred_child_not_escaped(self):
+            """A deferred child's placeholder is inserted into a Django template without being autoescaped."""
+            deferred_child = DeferredChild(MagicMock(path='page.slow'), DEFER_UNTIL_PAINT)
+            html = Template('<p>{{ slow }}</p>').render(Context({'slow': deferred_child}))
+            self.assertEqual(html, '<p><div id="page.slow-deferred" data-helio-deferred="paint" '
+                                   'data-helio-deferred-path="page.slow"></div></p>')
+
+        def test_setup_task(self):
+            """A setup task runs with the request's language active, and its database connections are closed once it
+            has finished."""
+            mock_connection = MagicMock()
+            translation.activate('fr')
+
+            try:
+                setup_task = self.renderer.wrap_setup_task(lambda: translation.get_language())
+            finally:
+                translation.deactivate()
+
+            with patch('helio.heliodjango.renderers.connections.all', return_value=[mock_connection]):
+                self.assertEqual(setup_task(), 'fr')
+                mock_connection.close.assert_called_with()
+
+            self.assertNotEqual(translation.get_language(), 'fr')
+
     class MiddlewareTests(unittest.TestCase):
         @patch('helio.heliodjango.middleware.settings.CSRF_COOKIE_NAME', 'csrftoken')
         @patch('helio.heliodjango.middleware.csrf', return_value={'csrf_token': 'csrf-token'})
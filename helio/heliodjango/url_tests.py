@@ -1,7 +1,8 @@
 import unittest
 try:
     from urls import urlpatterns
-    from views import helio_get_view_state, helio_get_controller_data, helio_dispatch_notification
+    from views import helio_get_view_state, helio_get_controller_data, helio_dispatch_notification, \
+        helio_dispatch_notifications, helio_get_controllers_data, helio_bootstrap
 
     class DjangoURLTests(unittest.TestCase):
         def test_controller_data_url(self):
@@ -22,5 +23,20 @@ try:
             resolution = urlpatterns[2].resolve('get-view-state/')
             self.assertEqual(resolution.func, helio_get_view_state)
 
+        def test_notifications_url(self):
+            """URL notifications should resolve to the helio_dispatch_notifications method."""
+            resolution = urlpatterns[3].resolve('notifications/')
+            self.assertEqual(resolution.func, helio_dispatch_notifications)
+
+        def test_controllers_url(self):
+            """URL controllers should resolve to the helio_get_controllers_data method."""
+            resolution = urlpatterns[4].resolve('controllers/')
+            self.assertEqual(resolution.func, helio_get_controllers_data)
+
+        def test_bootstrap_url(self):
+            """URL bootstrap should resolve to the helio_bootstrap method."""
+            resolution = urlpatterns[5].resolve('bootstrap/')
+            self.assertEqual(resolution.func, helio_bootstrap)
+
 except ImportError:
     raise RuntimeWarning("Not testing Django URLs")
\ No newline at end of file
@@ -4,5 +4,8 @@ urlpatterns = patterns('',
     url(r'^controller/(?P<controller_path>[\w\.:\d]+)/?$', 'helio.heliodjango.views.helio_get_controller_data'),
     url(r'^notification/(?P<controller_path>[\w\.:\d]+)/(?P<notification_name>[\w\.\-]+)/?$',
         'helio.heliodjango.views.helio_dispatch_notification'),
-    url(r'^get-view-state/?$', 'helio.heliodjango.views.helio_get_view_state')
+    url(r'^get-view-state/?$', 'helio.heliodjango.views.helio_get_view_state'),
+    url(r'^notifications/?$', 'helio.heliodjango.views.helio_dispatch_notifications'),
+    url(r'^controllers/?$', 'helio.heliodjango.views.helio_get_controllers_data'),
+    url(r'^bootstrap/?$', 'helio.heliodjango.views.helio_bootstrap')
 )
\ No newline at end of file
@@ -1,7 +1,37 @@
-from helio.views.views import get_view_state, get_controller_data, dispatch_notification
-from django.http import HttpResponse
+from helio.views.views import get_view_state, fork_view_state, bootstrap_view_state, bootstrap_script, \
+    get_controller_data, get_controllers_data, dispatch_notification, dispatch_notifications, \
+    stream_bootstrap_view_state, stream_controller_data, stream_notification, stream_notifications, NDJSON_CONTENT_TYPE, \
+    accepts_ndjson
+from helio.viewstate.backends import check_viewstate_backend
+from helio.helio_exceptions import ViewStateError
+from helio.settings import STREAM_RESPONSES
+from django.http import HttpResponse, QueryDict
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:  # before Django 1.5, HttpResponse streams an iterator itself
+    StreamingHttpResponse = HttpResponse
+from django.utils.safestring import mark_safe
 import json
 
+# sent instead of data when the client's ViewState no longer exists, so the client can start again
+REFRESH_RESPONSE = json.dumps('refresh')
+
+check_viewstate_backend()
+
+
+def _save_session_after(chunks, session):
+    # the session middleware has already saved the session by the time a streamed response is produced
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        # lets go of the ViewStateManager if the response is closed early
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+    if session.modified:
+        session.save()
+
 
 def helio_get_view_state(request):
     try:
@@ -9,19 +39,107 @@ def helio_get_view_state(request):
     except TypeError:
         vs_id = -1
 
-    view_state = get_view_state(vs_id, request.session)
-    request.session.save()
+    if request.GET.get('fork') is not None:
+        view_state = fork_view_state(int(request.GET.get('fork')), request.session)
+    else:
+        view_state = get_view_state(vs_id, request.session)
+
+    if request.session.modified:
+        request.session.save()
+
     return HttpResponse(str(view_state.index))
 
 
+def helio_bootstrap(request):
+    try:
+        vs_id = int(request.GET.get('vs_id'))
+    except TypeError:
+        vs_id = -1
+
+    fork_vs_id = None if request.GET.get('fork') is None else int(request.GET.get('fork'))
+
+    if STREAM_RESPONSES:
+        chunks = stream_bootstrap_view_state(vs_id, request.session, fork_vs_id, request)
+
+        if request.session.modified:
+            request.session.save()
+
+        return StreamingHttpResponse(_save_session_after(chunks, request.session))
+
+    bootstrap_data = bootstrap_view_state(vs_id, request.session, fork_vs_id, request)
+
+    if request.session.modified:
+        request.session.save()
+
+    return HttpResponse(json.dumps(bootstrap_data))
+
+
+def helio_bootstrap_script(request):
+    """The g_helioBootstrap script tag for the page shell being rendered for request. The shell can't know which of
+    the session's ViewStates the tab had, so a new one is started (or forked, if the page was opened with helio_fork)."""
+    fork_vs_id = request.GET.get('helio_fork')
+    bootstrap_data = bootstrap_view_state(-1, request.session, None if fork_vs_id is None else int(fork_vs_id),
+                                          request)
+    return mark_safe(bootstrap_script(bootstrap_data))
+
+
 def helio_get_controller_data(request, controller_path):
-    controller_data = get_controller_data(controller_path, int(request.GET.get('vs_id')), request.session, request)
+    try:
+        if STREAM_RESPONSES:
+            return StreamingHttpResponse(_save_session_after(stream_controller_data(
+                controller_path, int(request.GET.get('vs_id')), request.session, request), request.session))
+
+        controller_data = get_controller_data(controller_path, int(request.GET.get('vs_id')), request.session, request)
+    except ViewStateError:
+        return HttpResponse(REFRESH_RESPONSE)
 
     return HttpResponse(json.dumps(controller_data))
 
 
+def helio_get_controllers_data(request):
+    controller_paths = [path for path in request.GET.get('paths', '').split(',') if path]
+
+    try:
+        controllers_data = get_controllers_data(controller_paths, int(request.GET.get('vs_id')), request.session,
+                                                request)
+    except ViewStateError:
+        return HttpResponse(REFRESH_RESPONSE)
+
+    return HttpResponse(json.dumps(controllers_data))
+
+
+def _stream_notifications(request):
+    return STREAM_RESPONSES and accepts_ndjson(request.META.get('HTTP_ACCEPT'))
+
+
 def helio_dispatch_notification(request, controller_path, notification_name):
-    notifications = dispatch_notification(controller_path, int(request.GET.get('vs_id')), notification_name,
-                                          request.POST, request.session, request)
+    try:
+        if _stream_notifications(request):
+            return StreamingHttpResponse(_save_session_after(stream_notification(
+                controller_path, int(request.GET.get('vs_id')), notification_name, request.POST, request.session,
+                request), request.session), content_type=NDJSON_CONTENT_TYPE)
+
+        notifications = dispatch_notification(controller_path, int(request.GET.get('vs_id')), notification_name,
+                                              request.POST, request.session, request)
+    except ViewStateError:
+        return HttpResponse(REFRESH_RESPONSE)
+
+    return HttpResponse(json.dumps(notifications))
+
+
+def helio_dispatch_notifications(request):
+    # each item's data is url encoded, as for a single notification
+    batch = [(controller_path, notification_name, QueryDict(data.encode('utf-8')))
+             for controller_path, notification_name, data in json.loads(request.POST.get('notifications', '[]'))]
+
+    try:
+        if _stream_notifications(request):
+            return StreamingHttpResponse(_save_session_after(stream_notifications(
+                batch, int(request.GET.get('vs_id')), request.session, request), request.session),
+                content_type=NDJSON_CONTENT_TYPE)
+
+        notifications = dispatch_notifications(batch, int(request.GET.get('vs_id')), request.session, request)
+    except ViewStateError:
+        return HttpResponse(REFRESH_RESPONSE)
 
     return HttpResponse(json.dumps(notifications))
@@ -1,18 +1,23 @@
 import unittest
+import json
 from mock import patch, MagicMock
+from helio.helio_exceptions import ViewStateError
 try:
-    from views import helio_get_view_state, helio_get_controller_data, helio_dispatch_notification
+    from views import helio_get_view_state, helio_get_controller_data, helio_dispatch_notification, \
+        helio_dispatch_notifications, helio_get_controllers_data, helio_bootstrap, helio_bootstrap_script
 
     class MockSession(dict):
         def __init__(self):
             super(MockSession, self).__init__()
             self.save = MagicMock()
+            self.modified = False
 
     class MockRequest(MagicMock):
         def __init__(self):
             super(MockRequest, self).__init__()
             self.GET = {}
             self.POST = {}
+            self.META = {}
             self.session = MockSession()
 
     class MockViewState(object):
@@ -23,11 +28,19 @@ try:
         def test_get_viewstate_call(self, mock_gvs):
             """When a vs_id is not supplied by the client, Helio should get -1"""
             req = MockRequest()
+            req.session.modified = True
             resp = helio_get_view_state(req)
             mock_gvs.assert_called_with(-1, req.session)
             req.session.save.assert_called_with()
             self.assertEqual(resp.content, '1')
 
+        @patch('helio.heliodjango.views.get_view_state', return_value=MockViewState())
+        def test_get_viewstate_unmodified_session_not_saved(self, mock_gvs):
+            """If the ViewState didn't change, the session is not saved."""
+            req = MockRequest()
+            helio_get_view_state(req)
+            req.session.save.assert_not_called()
+
         @patch('helio.heliodjango.views.get_view_state', return_value=MockViewState())
         def test_get_viewstate_call_with_vs_id(self, mock_gvs):
             """When a vs_id is supplied by the client, Helio should try to get it"""
@@ -37,6 +50,15 @@ try:
             mock_gvs.assert_called_with(2, req.session)
             self.assertEqual(resp.content, '1')
 
+        @patch('helio.heliodjango.views.fork_view_state', return_value=MockViewState())
+        def test_get_viewstate_fork(self, mock_fvs):
+            """When a fork vs_id is supplied by the client, Helio should fork that ViewState"""
+            req = MockRequest()
+            req.GET['fork'] = '3'
+            resp = helio_get_view_state(req)
+            mock_fvs.assert_called_with(3, req.session)
+            self.assertEqual(resp.content, '1')
+
         @patch('helio.heliodjango.views.get_controller_data', return_value={'data': 'somedata'})
         def test_get_controller_data_call(self, mock_gcd):
             """Django helio_get_controller_data view should call get_controller_data Helio view with the supplied controller
@@ -58,5 +80,145 @@ try:
             mock_dn.assert_called_with('controller.to.notify', 4, 'notification_name', req.POST, req.session, req)
             self.assertEqual(resp.content, '{"notification": "get busy"}')
 
+        @patch('helio.heliodjango.views.get_controller_data', side_effect=ViewStateError)
+        def test_get_controller_data_refresh(self, mock_gcd):
+            """If the client's ViewState no longer exists, the client is told to refresh."""
+            req = MockRequest()
+            req.GET['vs_id'] = '3'
+            resp = helio_get_controller_data(req, 'controller.path')
+            self.assertEqual(resp.content, '"refresh"')
+
+        @patch('helio.heliodjango.views.dispatch_notification', side_effect=ViewStateError)
+        def test_dispatch_notification_refresh(self, mock_dn):
+            """If the client's ViewState no longer exists, the client is told to refresh."""
+            req = MockRequest()
+            req.GET['vs_id'] = '4'
+            resp = helio_dispatch_notification(req, 'controller.to.notify', 'notification_name')
+            self.assertEqual(resp.content, '"refresh"')
+
+        @patch('helio.heliodjango.views.bootstrap_view_state', return_value={'vs_id': 1, 'html': 'html'})
+        def test_bootstrap_call(self, mock_bvs):
+            """Django helio_bootstrap view should call bootstrap_view_state Helio view with the supplied vs_id and fork,
+            and save the session if it changed"""
+            req = MockRequest()
+            req.session.modified = True
+            resp = helio_bootstrap(req)
+            mock_bvs.assert_called_with(-1, req.session, None, req)
+            req.session.save.assert_called_with()
+            self.assertEqual(json.loads(resp.content), {'vs_id': 1, 'html': 'html'})
+
+            req.GET['vs_id'] = '2'
+            req.GET['fork'] = '3'
+            helio_bootstrap(req)
+            mock_bvs.assert_called_with(2, req.session, 3, req)
+
+        @patch('helio.heliodjango.views.bootstrap_view_state', return_value={'vs_id': 1})
+        def test_bootstrap_script(self, mock_bvs):
+            """helio_bootstrap_script should start a new ViewState (forking helio_fork if given) and return the script
+            tag"""
+            req = MockRequest()
+            req.GET['helio_fork'] = '3'
+            script = helio_bootstrap_script(req)
+            mock_bvs.assert_called_with(-1, req.session, 3, req)
+            self.assertIn('window.g_helioBootstrap = {"vs_id": 1};', script)
+
+        @patch('helio.heliodjango.views.STREAM_RESPONSES', True)
+        @patch('helio.heliodjango.views.stream_controller_data', return_value=iter(['{"html": "', 'a', '"}']))
+        def test_get_controller_data_streamed(self, mock_scd):
+            """With STREAM_RESPONSES, the controller data is streamed, and the session saved after it if it changed"""
+            req = MockRequest()
+            req.GET['vs_id'] = '3'
+            resp = helio_get_controller_data(req, 'controller.path')
+            mock_scd.assert_called_with('controller.path', 3, req.session, req)
+            req.session.modified = True
+            self.assertEqual(''.join(resp), '{"html": "a"}')
+            req.session.save.assert_called_with()
+
+        @patch('helio.heliodjango.views.STREAM_RESPONSES', True)
+        @patch('helio.heliodjango.views.stream_controller_data', side_effect=ViewStateError)
+        def test_get_controller_data_streamed_refresh(self, mock_scd):
+            """If the client's ViewState no longer exists, the client is told to refresh rather than streamed to."""
+            req = MockRequest()
+            req.GET['vs_id'] = '3'
+            self.assertEqual(helio_get_controller_data(req, 'controller.path').content, '"refresh"')
+
+        @patch('helio.heliodjango.views.STREAM_RESPONSES', True)
+        @patch('helio.heliodjango.views.stream_bootstrap_view_state', return_value=iter(['{"vs_id": 1}']))
+        def test_bootstrap_streamed(self, mock_sbvs):
+            """With STREAM_RESPONSES, the bootstrap data is streamed after the new ViewState is saved to the session"""
+            req = MockRequest()
+            req.session.modified = True
+            resp = helio_bootstrap(req)
+            mock_sbvs.assert_called_with(-1, req.session, None, req)
+            req.session.save.assert_called_with()
+            self.assertEqual(''.join(resp), '{"vs_id": 1}')
+
+        @patch('helio.heliodjango.views.STREAM_RESPONSES', True)
+        @patch('helio.heliodjango.views.stream_notification', return_value=iter(['{"name": "one"}\n']))
+        def test_dispatch_notification_streamed(self, mock_sn):
+            """With STREAM_RESPONSES, the client notifications are streamed as newline delimited JSON to clients that
+            accept it"""
+            req = MockRequest()
+            req.GET['vs_id'] = '4'
+            req.META['HTTP_ACCEPT'] = 'application/x-ndjson, application/json'
+            resp = helio_dispatch_notification(req, 'controller.to.notify', 'notification_name')
+            mock_sn.assert_called_with('controller.to.notify', 4, 'notification_name', req.POST, req.session, req)
+            self.assertEqual(resp['Content-Type'], 'application/x-ndjson')
+            self.assertEqual(''.join(resp), '{"name": "one"}\n')
+
+        @patch('helio.heliodjango.views.STREAM_RESPONSES', True)
+        @patch('helio.heliodjango.views.stream_notification')
+        @patch('helio.heliodjango.views.dispatch_notification', return_value=[{'name': 'one'}])
+        def test_dispatch_notification_not_streamed_to_json_client(self, mock_dn, mock_sn):
+            """Clients that don't accept newline delimited JSON get the notifications as one JSON response"""
+            req = MockRequest()
+            req.GET['vs_id'] = '4'
+            req.META['HTTP_ACCEPT'] = 'application/json, text/javascript, */*; q=0.01'
+            resp = helio_dispatch_notification(req, 'controller.to.notify', 'notification_name')
+            mock_sn.assert_not_called()
+            self.assertEqual(resp.content, '[{"name": "one"}]')
+
+        @patch('helio.heliodjango.views.get_controllers_data', return_value={'page': {'data': 'somedata'}})
+        def test_get_controllers_data_call(self, mock_gcd):
+            """Django helio_get_controllers_data view should call get_controllers_data Helio view with the comma
+            separated paths and vs_id"""
+            req = MockRequest()
+            req.GET['vs_id'] = '3'
+            req.GET['paths'] = 'page.one,page.two'
+            resp = helio_get_controllers_data(req)
+            mock_gcd.assert_called_with(['page.one', 'page.two'], 3, req.session, req)
+            self.assertEqual(resp.content, '{"page": {"data": "somedata"}}')
+
+        @patch('helio.heliodjango.views.get_controllers_data', side_effect=ViewStateError)
+        def test_get_controllers_data_refresh(self, mock_gcd):
+            """If the client's ViewState no longer exists, the client is told to refresh."""
+            req = MockRequest()
+            req.GET['vs_id'] = '3'
+            resp = helio_get_controllers_data(req)
+            self.assertEqual(resp.content, '"refresh"')
+
+        @patch('helio.heliodjango.views.dispatch_notifications', return_value=[{'notification': 'get busy'}])
+        def test_dispatch_notifications_call(self, mock_dn):
+            """Django helio_dispatch_notifications view should call dispatch_notifications Helio view with the decoded
+            batch and vs_id, with each item's url encoded data decoded as for a single notification"""
+            req = MockRequest()
+            req.GET['vs_id'] = '4'
+            req.POST = {'notifications': '[["page.one", "first", "a=1&a=%C3%A9"], ["page.two", "second", ""]]'}
+            resp = helio_dispatch_notifications(req)
+            batch, vs_id, session, request = mock_dn.call_args[0]
+            self.assertEqual([item[:2] for item in batch], [(u'page.one', u'first'), (u'page.two', u'second')])
+            self.assertEqual(batch[0][2].getlist('a'), [u'1', u'\u00e9'])
+            self.assertEqual(dict(batch[1][2]), {})
+            self.assertEqual((vs_id, session, request), (4, req.session, req))
+            self.assertEqual(resp.content, '[{"notification": "get busy"}]')
+
+        @patch('helio.heliodjango.views.dispatch_notifications', side_effect=ViewStateError)
+        def test_dispatch_notifications_refresh(self, mock_dn):
+            """If the client's ViewState no longer exists, the client is told to refresh."""
+            req = MockRequest()
+            req.GET['vs_id'] = '4'
+            resp = helio_dispatch_notifications(req)
+            self.assertEqual(resp.content, '"refresh"')
+
 except ImportError:
     raise RuntimeWarning("Not testing Django Views")
\ No newline at end of file
@@ -1,9 +1,14 @@
 import unittest
+import json
 from mock import patch
+from helio.helio_exceptions import ViewStateError
 try:
     import flask
     from werkzeug.datastructures import ImmutableMultiDict
-    from helioflask import helioflask, template_env
+    from helioflask import helioflask, template_env, flask_bootstrap_script
+    from helio.controller.base import BaseViewController
+    from helio.viewstate.backends import LocalMemoryViewStateBackend
+    from helio.viewstate.viewstate import clear_viewstate_prototypes
 
     flask.session = {}
 
@@ -35,6 +40,14 @@ try:
                 mock_gvs.assert_called_with(2, {})
                 self.assertEqual(resp.data, '2')
 
+        @patch('helio.helioflask.helioflask.fork_view_state', return_value=MockViewState(4))
+        def test_get_viewstate_fork(self, mock_fvs):
+            """When a fork vs_id is supplied by the client, Helio should fork that ViewState"""
+            with self.app.test_request_context():
+                resp = self.client.get('/get-view-state/?vs_id=2&fork=3')
+                mock_fvs.assert_called_with(3, {})
+                self.assertEqual(resp.data, '4')
+
         @patch('helio.helioflask.helioflask.get_controller_data', return_value={'data': 'somedata'})
         def test_get_controller_data_call(self, mock_gcd):
             """Flask helio_get_controller_data view should call get_controller_data Helio view with the supplied controller
@@ -57,6 +70,109 @@ try:
                                            environment=template_env)
                 self.assertEqual(resp.data, '{"notification": "get busy"}')
 
+        @patch('helio.helioflask.helioflask.bootstrap_view_state', return_value={'vs_id': 1, 'html': 'html'})
+        def test_bootstrap_call(self, mock_bvs):
+            """Flask flask_bootstrap view should call bootstrap_view_state Helio view with the supplied vs_id and
+            fork"""
+            with self.app.test_request_context():
+                resp = self.client.get('/bootstrap/?vs_id=2&fork=3')
+                mock_bvs.assert_called_with(2, flask.session, 3, flask.request, environment=template_env)
+                self.assertEqual(json.loads(resp.data), {'vs_id': 1, 'html': 'html'})
+
+                self.client.get('/bootstrap/')
+                mock_bvs.assert_called_with(-1, flask.session, None, flask.request, environment=template_env)
+
+        @patch('helio.helioflask.helioflask.bootstrap_view_state', return_value={'vs_id': 1})
+        def test_bootstrap_script(self, mock_bvs):
+            """flask_bootstrap_script should start a new ViewState (forking helio_fork if given) and return the script
+            tag as markup"""
+            with self.app.test_request_context('/page/?helio_fork=3'):
+                script = flask_bootstrap_script()
+                self.assertEqual(mock_bvs.call_args[0][:3], (-1, flask.session, 3))
+                self.assertIn('window.g_helioBootstrap = {"vs_id": 1};', script)
+                self.assertTrue(hasattr(script, '__html__'))
+
+        @patch('helio.helioflask.helioflask.STREAM_RESPONSES', True)
+        @patch('helio.helioflask.helioflask.stream_controller_data', return_value=iter(['{"html": "', 'a', '"}']))
+        def test_get_controller_data_streamed(self, mock_scd):
+            """With STREAM_RESPONSES, the controller data is streamed"""
+            with self.app.test_request_context():
+                resp = self.client.get('/controller/controller.path?vs_id=3')
+                mock_scd.assert_called_with('controller.path', 3, flask.session, flask.request,
+                                            environment=template_env)
+                self.assertEqual(resp.data, '{"html": "a"}')
+
+        @patch('helio.helioflask.helioflask.STREAM_RESPONSES', True)
+        @patch('helio.helioflask.helioflask.stream_bootstrap_view_state', return_value=iter(['{"vs_id": 1}']))
+        def test_bootstrap_streamed(self, mock_sbvs):
+            """With STREAM_RESPONSES, the bootstrap data is streamed"""
+            with self.app.test_request_context():
+                resp = self.client.get('/bootstrap/')
+                mock_sbvs.assert_called_with(-1, flask.session, None, flask.request, environment=template_env)
+                self.assertEqual(resp.data, '{"vs_id": 1}')
+
+        @patch('helio.helioflask.helioflask.STREAM_RESPONSES', True)
+        @patch('helio.helioflask.helioflask.stream_notifications', return_value=iter(['{"name": "one"}\n']))
+        def test_dispatch_notifications_streamed(self, mock_sn):
+            """With STREAM_RESPONSES, the client notifications are streamed as newline delimited JSON to clients that
+            accept it"""
+            with self.app.test_request_context():
+                resp = self.client.post('/notifications?vs_id=4', data={'notifications': '[["page", "one", ""]]'},
+                                        headers={'Accept': 'application/x-ndjson, application/json'})
+                self.assertEqual(mock_sn.call_args[0][0][0][:2], (u'page', u'one'))
+                self.assertEqual(mock_sn.call_args[0][1:], (4, flask.session, flask.request))
+                self.assertEqual(mock_sn.call_args[1], {'environment': template_env})
+                self.assertEqual(resp.mimetype, 'application/x-ndjson')
+                self.assertEqual(resp.data, '{"name": "one"}\n')
+
+        @patch('helio.helioflask.helioflask.STREAM_RESPONSES', True)
+        @patch('helio.helioflask.helioflask.stream_notifications')
+        @patch('helio.helioflask.helioflask.dispatch_notifications', return_value=[{'name': 'one'}])
+        def test_dispatch_notifications_not_streamed_to_json_client(self, mock_dn, mock_sn):
+            """Clients that don't accept newline delimited JSON get the notifications as one JSON response"""
+            with self.app.test_request_context():
+                resp = self.client.post('/notifications?vs_id=4', data={'notifications': '[["page", "one", ""]]'},
+                                        headers={'Accept': 'application/json, text/javascript, */*; q=0.01'})
+                mock_sn.assert_not_called()
+                self.assertEqual(resp.data, '[{"name": "one"}]')
+
+        @patch('helio.helioflask.helioflask.get_controllers_data', return_value={'page': {'data': 'somedata'}})
+        def test_get_controllers_data_call(self, mock_gcd):
+            """Flask flask_get_controllers_data view should call get_controllers_data Helio view with the comma
+            separated paths and vs_id"""
+            with self.app.test_request_context():
+                resp = self.client.get('/controllers?paths=page.one,page.two&vs_id=3')
+                mock_gcd.assert_called_with(['page.one', 'page.two'], 3, flask.session, flask.request,
+                                            environment=template_env)
+                self.assertEqual(resp.data, '{"page": {"data": "somedata"}}')
+
+        @patch('helio.helioflask.helioflask.dispatch_notifications', return_value=[{'notification': 'get busy'}])
+        def test_dispatch_notifications_call(self, mock_dn):
+            """Flask flask_dispatch_notifications view should call dispatch_notifications Helio view with the decoded
+            batch and vs_id, with each item's url encoded data decoded as for a single notification"""
+            with self.app.test_request_context():
+                batch = '[["page.one", "first", "a=1&a=3"], ["page.two", "second", "b=2"]]'
+                resp = self.client.post('/notifications?vs_id=4', data={'notifications': batch})
+                self.assertEqual(mock_dn.call_args[0][0][0][:2], (u'page.one', u'first'))
+                self.assertEqual(mock_dn.call_args[0][0][0][2].getlist('a'), [u'1', u'3'])
+                self.assertEqual(mock_dn.call_args[0][0][1][2]['b'], u'2')
+                self.assertEqual(mock_dn.call_args[0][1], 4)
+                self.assertEqual(resp.data, '[{"notification": "get busy"}]')
+
+        @patch('helio.helioflask.helioflask.get_controller_data', side_effect=ViewStateError)
+        def test_get_controller_data_refresh(self, mock_gcd):
+            """If the client's ViewState no longer exists, the client is told to refresh."""
+            with self.app.test_request_context():
+                resp = self.client.get('/controller/controller.path?vs_id=3')
+                self.assertEqual(resp.data, '"refresh"')
+
+        @patch('helio.helioflask.helioflask.dispatch_notification', side_effect=ViewStateError)
+        def test_dispatch_notification_refresh(self, mock_dn):
+            """If the client's ViewState no longer exists, the client is told to refresh."""
+            with self.app.test_request_context():
+                resp = self.client.post('/notification/controller.to.notify/notification_name?vs_id=4')
+                self.assertEqual(resp.data, '"refresh"')
+
         @patch('helio.helioflask.helioflask.abort')
         def test_flask_static_invalid_url_error(self, mock_abort):
             """Test that abort(404) is called if a static path contains '..' (paths starting with / are automatically
@@ -113,5 +229,39 @@ try:
                 mock_csp.assert_called_with('file.js')
                 mock_send_file.called_with('COMPONENT_DIR/file/static/file.js')
 
+    def make_page_controller(component_name):
+        controller = BaseViewController()
+        controller.template_name = 'page.html'
+        return controller
+
+    @patch('helio.viewstate.viewstate.init_controller', side_effect=make_page_controller)
+    @patch('helio.controller.base.render_stream', side_effect=lambda template_name, context, request, **kwargs: iter(
+        [u'<p>', u'page', u'</p>']))
+    @patch('helio.views.views.CLASS_MAP_DELTAS', True)
+    @patch('helio.helioflask.helioflask.STREAM_RESPONSES', True)
+    class FlaskStreamingSessionTests(unittest.TestCase):
+        def setUp(self):
+            self.app = flask.Flask(__name__)
+            self.app.secret_key = 'secret'
+            self.app.register_blueprint(helioflask)
+            self.client = self.app.test_client()
+            self.addCleanup(clear_viewstate_prototypes)
+
+            backend_patcher = patch('helio.views.views.get_viewstate_backend',
+                                    return_value=LocalMemoryViewStateBackend())
+            backend_patcher.start()
+            self.addCleanup(backend_patcher.stop)
+
+        def test_streamed_responses_keep_view_state(self, mock_render_stream, mock_init):
+            """Streamed responses go through the real session: the ViewState started by a streamed bootstrap is found
+            by the next streamed request, along with what was recorded as sent once the first stream had finished."""
+            bootstrap_data = json.loads(self.client.get('/bootstrap/').data)
+            self.assertEqual(bootstrap_data['html'], u'<p>page</p>')
+            self.assertEqual(bootstrap_data['class_map_delta']['changed'], {'page': {}})
+
+            controller_data = json.loads(self.client.get('/controller/page?vs_id=%d' % bootstrap_data['vs_id']).data)
+            self.assertEqual(controller_data['html'], u'<p>page</p>')
+            self.assertEqual(controller_data['class_map_delta'], {'changed': {}, 'removed': []})
+
 except ImportError:
     raise RuntimeWarning("Not testing Flask integration.")
\ No newline at end of file
@@ -1,21 +1,53 @@
 from os.path import join, exists, isdir, dirname, abspath
 import json
-from flask import Blueprint, request, abort, send_file, session
-from jinja2 import Environment
+from flask import Blueprint, Response, request, abort, send_file, session, stream_with_context
+from jinja2 import Environment, Markup
+from werkzeug.urls import url_decode
 import helio.settings
 from helio.controller.finders import component_static_to_path
 from helio.helioflask.finders import ComponentTemplateLoader
-from helio.views.views import get_view_state, get_controller_data, dispatch_notification
+from helio.views.views import get_view_state, fork_view_state, bootstrap_view_state, bootstrap_script, \
+    get_controller_data, get_controllers_data, dispatch_notification, dispatch_notifications, \
+    stream_bootstrap_view_state, stream_controller_data, stream_notification, stream_notifications, NDJSON_CONTENT_TYPE, \
+    accepts_ndjson
+from helio.viewstate.backends import check_viewstate_backend
+from helio.helio_exceptions import ViewStateError
+from helio.settings import STREAM_RESPONSES
 
 STATICFILES_DIRS = (
     join(dirname(abspath(helio.settings.__file__)), 'javascript', 'static'),
     join(dirname(abspath(helio.settings.__file__)), 'helioflask', 'static')
 )
 
+# sent instead of data when the client's ViewState no longer exists, so the client can start again
+REFRESH_RESPONSE = json.dumps('refresh')
+
 helioflask = Blueprint('helioflask', __name__)
 
 template_env = Environment(loader=ComponentTemplateLoader(helio.settings.COMPONENT_BASE_DIRECTORIES))
 
+
+def _stream_response(chunks, **kwargs):
+    """A Response streaming chunks with the request context kept for them. Flask before 1.0 opens the session again
+    when stream_with_context pushes the request context, which would lose what was written to the session while the
+    stream was set up (e.g. the key of a new ViewStateManager), so that is copied across."""
+    setup_session = session._get_current_object()
+    response = Response(stream_with_context(chunks), **kwargs)
+    response_session = session._get_current_object()
+
+    if response_session is not setup_session and setup_session.modified:
+        response_session.clear()
+        response_session.update(setup_session)
+
+    return response
+
+
+# so settings that can't be used together fail as the blueprint is registered, rather than on a request
+@helioflask.record_once
+def _check_settings(state):
+    check_viewstate_backend()
+
+
 @helioflask.route('/get-view-state/')
 def flask_get_view_state():
     try:
@@ -23,23 +55,107 @@ def flask_get_view_state():
     except TypeError:
         vs_id = -1
 
-    view_state = get_view_state(vs_id, session)
-    session.modified = True
+    if request.args.get('fork') is not None:
+        view_state = fork_view_state(int(request.args.get('fork')), session)
+    else:
+        view_state = get_view_state(vs_id, session)
+
     return str(view_state.index)
 
 
+@helioflask.route('/bootstrap/')
+def flask_bootstrap():
+    try:
+        vs_id = int(request.args.get('vs_id'))
+    except TypeError:
+        vs_id = -1
+
+    fork_vs_id = None if request.args.get('fork') is None else int(request.args.get('fork'))
+
+    if STREAM_RESPONSES:
+        return _stream_response(stream_bootstrap_view_state(vs_id, session, fork_vs_id, request,
+                                                            environment=template_env))
+
+    bootstrap_data = bootstrap_view_state(vs_id, session, fork_vs_id, request, environment=template_env)
+
+    return json.dumps(bootstrap_data)
+
+
+def flask_bootstrap_script():
+    """The g_helioBootstrap script tag for the page shell being rendered for the current request. The shell can't know
+    which of the session's ViewStates the tab had, so a new one is started (or forked, if the page was opened with
+    helio_fork)."""
+    fork_vs_id = request.args.get('helio_fork')
+    bootstrap_data = bootstrap_view_state(-1, session, None if fork_vs_id is None else int(fork_vs_id), request,
+                                          environment=template_env)
+    return Markup(bootstrap_script(bootstrap_data))
+
+
 @helioflask.route('/controller/<controller_path>')
 def flask_get_controller_data(controller_path):
-    controller_data = get_controller_data(controller_path, int(request.args.get('vs_id')), session, request, environment=template_env)
-    session.modified = True
+    try:
+        if STREAM_RESPONSES:
+            return _stream_response(stream_controller_data(controller_path, int(request.args.get('vs_id')), session,
+                                                           request, environment=template_env))
+
+        controller_data = get_controller_data(controller_path, int(request.args.get('vs_id')), session, request,
+                                              environment=template_env)
+    except ViewStateError:
+        return REFRESH_RESPONSE
+
     return json.dumps(controller_data)
 
 
+@helioflask.route('/controllers')
+def flask_get_controllers_data():
+    controller_paths = [path for path in request.args.get('paths', '').split(',') if path]
+
+    try:
+        controllers_data = get_controllers_data(controller_paths, int(request.args.get('vs_id')), session, request,
+                                                environment=template_env)
+    except ViewStateError:
+        return REFRESH_RESPONSE
+
+    return json.dumps(controllers_data)
+
+
+def _stream_notifications():
+    return STREAM_RESPONSES and accepts_ndjson(request.headers.get('Accept'))
+
+
 @helioflask.route('/notification/<controller_path>/<notification_name>', methods=['POST'])
 def flask_dispatch_notification(controller_path, notification_name):
-    notifications = dispatch_notification(controller_path, int(request.args.get('vs_id')), notification_name,
-                                          request.form, session, request,  environment=template_env)
-    session.modified = True
+    try:
+        if _stream_notifications():
+            return _stream_response(stream_notification(
+                controller_path, int(request.args.get('vs_id')), notification_name, request.form, session, request,
+                environment=template_env), mimetype=NDJSON_CONTENT_TYPE)
+
+        notifications = dispatch_notification(controller_path, int(request.args.get('vs_id')), notification_name,
+                                              request.form, session, request,  environment=template_env)
+    except ViewStateError:
+        return REFRESH_RESPONSE
+
+    return json.dumps(notifications)
+
+
+@helioflask.route('/notifications', methods=['POST'])
+def flask_dispatch_notifications():
+    # each item's data is url encoded, as for a single notification
+    batch = [(controller_path, notification_name, url_decode(data))
+             for controller_path, notification_name, data in json.loads(request.form.get('notifications', '[]'))]
+
+    try:
+        if _stream_notifications():
+            return _stream_response(stream_notifications(
+                batch, int(request.args.get('vs_id')), session, request, environment=template_env),
+                mimetype=NDJSON_CONTENT_TYPE)
+
+        notifications = dispatch_notifications(batch, int(request.args.get('vs_id')), session, request,
+                                               environment=template_env)
+    except ViewStateError:
+        return REFRESH_RESPONSE
+
     return json.dumps(notifications)
 
 
@@ -1,6 +1,110 @@
+import sys
+from collections import Mapping
+from flask import has_request_context, copy_current_request_context, _request_ctx_stack
+from jinja2.utils import concat
+
+
 def render(template, context, request=None, environment=None):
     if environment is None:
         raise TypeError("Cannot render with no environment provided.")
 
     template_obj = environment.get_template(template)
-    return template_obj.render(request=request, **context)
\ No newline at end of file
+    return template_obj.render(request=request, **context)
+
+
+class _TemplateVars(Mapping):
+    """The variables a template is rendered with: the request, then the controller's context, then the template's
+    globals. Nothing is copied, so a controller's RenderContext is only walked for the names the template uses."""
+
+    def __init__(self, request, context, template_globals):
+        self._maps = ({'request': request}, context, template_globals)
+
+    def __getitem__(self, key):
+        for mapping in self._maps:
+            if key in mapping:
+                return mapping[key]
+
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(set().union(*self._maps))
+
+    def __len__(self):
+        return len(set().union(*self._maps))
+
+
+class JinjaRenderer(object):
+    """Renders like render, but keeps each compiled template (per environment) so the environment's loader and
+    cache are only consulted once per template name. Templates from an environment with auto_reload on (Jinja's
+    default) are got from the environment every time, so it can check whether they have changed."""
+
+    def __init__(self):
+        self._templates = {}
+
+    def get_template(self, template_name, environment):
+        if environment.auto_reload:
+            return environment.get_template(template_name)
+
+        key = (environment, template_name)
+        template = self._templates.get(key)
+
+        if template is None:
+            template = self._templates[key] = environment.get_template(template_name)
+
+        return template
+
+    def clear(self):
+        self._templates.clear()
+
+    @staticmethod
+    def wrap_setup_task(task):
+        """Run the task in a copy of the request context, so request and session can be used by the context_setup
+        of controllers set up on the setup pool."""
+        if not has_request_context():
+            return task
+
+        request_session = _request_ctx_stack.top.session
+
+        @copy_current_request_context
+        def setup_task():
+            # Flask before 1.0 opens the session again for the copy, so changes to it would be lost
+            _request_ctx_stack.top.session = request_session
+            return task()
+
+        return setup_task
+
+    def __call__(self, template, context, request=None, environment=None):
+        if environment is None:
+            raise TypeError("Cannot render with no environment provided.")
+
+        template_obj = self.get_template(template, environment)
+
+        try:
+            return concat(template_obj.root_render_func(self._new_context(template_obj, context, request)))
+        except Exception:
+            exc_info = sys.exc_info()
+
+        return environment.handle_exception(exc_info, True)
+
+    def _new_context(self, template_obj, context, request):
+        """A Jinja context that resolves names through the context as they are used, rather than copying it into a
+        dict as Template.render does."""
+        return template_obj.new_context(_TemplateVars(request, context, template_obj.globals), shared=True)
+
+    def stream(self, template, context, request=None, environment=None):
+        """Render the template like Jinja's generate, yielding the output a piece at a time."""
+        if environment is None:
+            raise TypeError("Cannot render with no environment provided.")
+
+        return self._generate(self.get_template(template, environment), context, request)
+
+    def _generate(self, template_obj, context, request):
+        try:
+            for chunk in template_obj.root_render_func(self._new_context(template_obj, context, request)):
+                yield chunk
+        except Exception:
+            exc_info = sys.exc_info()
+        else:
+            return
+
+        yield template_obj.environment.handle_exception(exc_info, True)
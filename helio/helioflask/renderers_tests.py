@@ -0,0 +1,87 @@
+import unittest
+import threading
+from mock import patch
+try:
+    import flask
+    from jinja2 import Environment, DictLoader
+    from renderers import JinjaRenderer
+    from helio.controller.context import RenderContext
+
+    class JinjaRendererTests(unittest.TestCase):
+        def setUp(self):
+            self.environment = Environment(loader=DictLoader({'template.html': '{{ request }} {{ value }}'}))
+            self.renderer = JinjaRenderer()
+
+        def test_render(self):
+            """The renderer renders the template with the context and request."""
+            self.assertEqual(self.renderer('template.html', {'value': 'val'}, 'req', environment=self.environment),
+                             'req val')
+
+        def test_template_cached(self):
+            """The environment is only asked for a template the first time it is rendered."""
+            self.environment.auto_reload = False
+
+            with patch.object(self.environment, 'get_template', wraps=self.environment.get_template) as mock_get:
+                self.renderer('template.html', {}, environment=self.environment)
+                self.renderer('template.html', {}, environment=self.environment)
+                self.assertEqual(mock_get.call_count, 1)
+
+        def test_template_not_cached_with_auto_reload(self):
+            """With the environment's auto_reload on, it is asked for the template every time, so changes are seen."""
+            self.environment.auto_reload = True
+
+            with patch.object(self.environment, 'get_template', wraps=self.environment.get_template) as mock_get:
+                self.renderer('template.html', {}, environment=self.environment)
+                self.renderer('template.html', {}, environment=self.environment)
+                self.assertEqual(mock_get.call_count, 2)
+
+        def test_stream(self):
+            """Streaming yields pieces of output that join to the rendered template."""
+            chunks = list(self.renderer.stream('template.html', {'value': 'val'}, 'req', environment=self.environment))
+            self.assertEqual(u''.join(chunks), 'req val')
+
+        def test_context_resolved_lazily(self):
+            """A RenderContext is used without being copied, so only the names the template uses are looked up, and
+            the environment's globals are still available."""
+            self.environment.globals['greeting'] = 'hi'
+            self.environment.loader.mapping['lazy.html'] = '{{ greeting }} {{ value }}'
+            parent = RenderContext(layer={'value': 'val', 'unused': 'x'})
+            context = RenderContext(parent)
+
+            with patch.object(RenderContext, '__iter__') as mock_iter:
+                self.assertEqual(self.renderer('lazy.html', context, environment=self.environment), 'hi val')
+                self.assertEqual(u''.join(self.renderer.stream('lazy.html', context, environment=self.environment)),
+                                 'hi val')
+                mock_iter.assert_not_called()
+
+        def test_no_environment(self):
+            """Rendering without an environment raises TypeError."""
+            self.assertRaises(TypeError, self.renderer, 'template.html', {})
+            self.assertRaises(TypeError, self.renderer.stream, 'template.html', {})
+
+        def test_setup_task_in_request_context(self):
+            """A setup task runs on another thread with the request, and the request's session, available to it."""
+            app = flask.Flask(__name__)
+            app.secret_key = 'secret'
+            seen = {}
+
+            def task():
+                seen['path'] = flask.request.path
+                flask.session['set_by_task'] = True
+                return 'result'
+
+            with app.test_request_context('/page/'):
+                setup_task = self.renderer.wrap_setup_task(task)
+                thread = threading.Thread(target=lambda: seen.update(result=setup_task()))
+                thread.start()
+                thread.join()
+                self.assertEqual(seen, {'path': '/page/', 'result': 'result'})
+                self.assertTrue(flask.session['set_by_task'])
+
+        def test_setup_task_without_request(self):
+            """Outside of a request, setup tasks are run as they are."""
+            task = lambda: None
+            self.assertIs(self.renderer.wrap_setup_task(task), task)
+
+except ImportError:
+    raise RuntimeWarning("Not testing Flask/Jinja2 Template Integration")
@@ -43,6 +43,136 @@ var detachCSS = function(controllerPath){
     $('#css_' + cssSelector).remove();
 }
 
+// the HTML last loaded into each controller, which HTML patches from the server are applied to
+var g_helioHTMLBaselines = {};
+
+var storeHTMLBaseline = function(controllerPath, html){
+    // the HTML stored for the controller's ancestors and descendants no longer matches what is in the page
+    $.each(g_helioHTMLBaselines, function(baselinePath){
+        if(baselinePath.indexOf(controllerPath + '.') === 0 || controllerPath.indexOf(baselinePath + '.') === 0)
+            delete g_helioHTMLBaselines[baselinePath];
+    });
+
+    g_helioHTMLBaselines[controllerPath] = html;
+}
+
+var tokenizeHTML = function(html){
+    // must split the HTML the same way as tokenize_html in helio/views/patches.py
+    return html.match(/<[^>]*>?|[^<]+/g) || [];
+}
+
+var htmlChecksum = function(html){
+    // Adler-32 of the UTF-8 encoded HTML, as calculated by html_checksum in helio/views/patches.py
+    var utf8HTML = unescape(encodeURIComponent(html)), a = 1, b = 0;
+
+    for(var charIndex = 0; charIndex < utf8HTML.length; ++charIndex){
+        a = (a + utf8HTML.charCodeAt(charIndex)) % 65521;
+        b = (b + a) % 65521;
+    }
+
+    return ((b << 16) | a) >>> 0;
+}
+
+var applyHTMLPatch = function(baseHTML, patch){
+    // returns null if the patch can't be applied to the HTML, or doesn't produce what the server rendered
+    if(baseHTML == undefined || htmlChecksum(baseHTML) != patch.base)
+        return null;
+
+    var tokens = tokenizeHTML(baseHTML);
+
+    for(var operationIndex = patch.operations.length - 1; operationIndex >= 0; --operationIndex){
+        var operation = patch.operations[operationIndex];
+        tokens.splice(operation[0], operation[1] - operation[0], operation[2]);
+    }
+
+    var html = tokens.join('');
+    return htmlChecksum(html) == patch.checksum ? html : null;
+}
+
+// controllers that have asked to load themselves in this tick, which are fetched together by loadPendingControllers
+var g_helioPendingLoads = [];
+
+var buildControllersURL = function(controllerPaths){
+    var controllersURL = g_helioSettings.controllers_url || '/controllers';
+
+    controllersURL += (controllersURL.indexOf('?') == -1 ? '?' : '&') + 'paths=' + controllerPaths.join(',');
+    if(g_helioSettings.viewstate_id)
+        controllersURL += '&vs_id=' + g_helioSettings.viewstate_id;
+
+    return controllersURL;
+}
+
+var queueControllerLoad = function(controller){
+    if(g_helioPendingLoads.length == 0)
+        setTimeout(loadPendingControllers, 0);
+
+    g_helioPendingLoads.push(controller);
+}
+
+var loadPendingControllers = function(){
+    var pendingLoads = g_helioPendingLoads;
+    g_helioPendingLoads = [];
+
+    if(pendingLoads.length == 1){
+        var controller = pendingLoads[0];
+
+        $.get(controller.buildURL(), function(data){
+            controller.loadCallback(data);
+        }, 'json');
+        return;
+    }
+
+    var controllersByPath = {}, controllerPaths = [];
+    $.each(pendingLoads, function(index, controller){
+        if(controllersByPath[controller.controllerPath] == undefined)
+            controllerPaths.push(controller.controllerPath);
+
+        controllersByPath[controller.controllerPath] = controller;
+    });
+
+    $.get(buildControllersURL(controllerPaths), function(data){
+        if(data == 'refresh'){
+            refreshViewState();
+            return;
+        }
+
+        // controllers inside another one that was loaded are left out by the server, as they were loaded with it
+        $.each(data, function(controllerPath, controllerData){
+            controllersByPath[controllerPath].loadCallback(controllerData);
+        });
+    }, 'json');
+}
+
+var loadDeferredControllers = function($container){
+    // the server renders a placeholder, carrying the child's path, for each deferred child. They are replaced by
+    // loading the child (so several are fetched together) now, or once they scroll into view
+    $container.find('[data-helio-deferred]').each(function(){
+        var placeholder = this;
+
+        var loadPlaceholder = function(){
+            // the child isn't in its parent's class map, so it is loaded into a plain controller, which sets it up.
+            // Its content takes the placeholder's place, and the controller then finds the child by its path
+            var controller = new Controller($(placeholder).attr('data-helio-deferred-path'), '#' + placeholder.id);
+            controller.setContent = function(content){
+                this.$container.replaceWith(content);
+                this.setSelector('#' + this.controllerPath);
+            };
+            controller.load();
+        };
+
+        if($(placeholder).attr('data-helio-deferred') == 'visible' && window.IntersectionObserver){
+            var observer = new IntersectionObserver(function(entries){
+                if(entries[0].isIntersecting){
+                    observer.disconnect();
+                    loadPlaceholder();
+                }
+            });
+            observer.observe(placeholder);
+        } else
+            loadPlaceholder();
+    });
+}
+
 var Controller = klass(function(controllerPath, selector, extraData){
     this.controllerPath = controllerPath;
     if(selector == undefined)
@@ -68,26 +198,85 @@ var Controller = klass(function(controllerPath, selector, extraData){
 
         if(controllerData)
             this.loadCallback(controllerData);
-        else {
-            var _parent = this;
-
-            $.get(this.buildURL(), function(data){
-                _parent.loadCallback(data);
-            }, 'json');
-        }
+        else
+            queueControllerLoad(this);
     },
     setContent: function(content){
         this.$container.html(content);
     },
     loadCallback: function(controllerData){
+        if(controllerData == 'refresh'){
+            refreshViewState();
+            return;
+        }
+
+        if(controllerData.patch != undefined){
+            controllerData.html = applyHTMLPatch(g_helioHTMLBaselines[this.controllerPath], controllerData.patch);
+
+            if(controllerData.html == null){
+                // the HTML in the page isn't what the patch was made against, so load the full HTML instead
+                this.load();
+                return;
+            }
+        }
+
+        storeHTMLBaseline(this.controllerPath, controllerData.html);
         this.setContent(controllerData.html);
 
-        if(controllerData.class_map == undefined)
-            return;
+        if(controllerData.class_map_delta != undefined)
+            this.applyClassMapDelta(controllerData.class_map_delta);
+        else if(controllerData.class_map != undefined)
+            this.applyClassMap(controllerData.class_map);
 
+        // deferred children aren't in the class map, so they are set up from their own load once the rest is
+        loadDeferredControllers(this.$container);
+    },
+    applyClassMap: function(classMap){
         g_helioLoader.removeChildrenOfController(this.controllerPath);
 
-        var sortedControllerMap = controllerClassMapTransform(controllerData.class_map);
+        var sortedControllerMap = controllerClassMapTransform(classMap);
+
+        for(var controllerIndex=0; controllerIndex < sortedControllerMap.length; ++controllerIndex)
+            this._setupController(sortedControllerMap[controllerIndex]);
+    },
+    applyClassMapDelta: function(classMapDelta){
+        // only the controllers that were added or changed (including those replaced by another controller) are set up
+        // again. The others keep their instances and are re-bound to their new containers, unless they can't be
+        // re-bound, in which case they are created again
+        var rootControllerPath = this.controllerPath;
+        var controllerRegistry = g_helioLoader.controllerRegistry;
+        var reinitializeTypes = {};
+
+        $.each(classMapDelta.removed, function(index, controllerPath){
+            delete controllerRegistry[controllerPath];
+            detachCSS(controllerPath);
+        });
+
+        $.each(classMapDelta.changed, function(controllerPath){
+            delete controllerRegistry[controllerPath];
+        });
+
+        $.each(controllerRegistry, function(controllerPath, controller){
+            if(controllerPath.indexOf(rootControllerPath + '.') !== 0)
+                return;
+
+            var controllerClassID = g_helioLoader.controllerTypeNameRegistry[controllerPath];
+
+            if(controllerClassID == undefined || controller.containerReplaced)
+                controller.rebind();
+            else
+                reinitializeTypes[controllerPath] = controllerClassID;
+        });
+
+        var sortedReinitializePaths = controllerClassMapTransform(reinitializeTypes);
+
+        for(var reinitializeIndex=0; reinitializeIndex < sortedReinitializePaths.length; ++reinitializeIndex){
+            var reinitializePath = sortedReinitializePaths[reinitializeIndex];
+            delete controllerRegistry[reinitializePath.path];
+            g_helioLoader.initializeController(reinitializePath.path, reinitializePath.assets);
+        }
+
+        var sortedControllerMap = controllerClassMapTransform(classMapDelta.changed);
 
         for(var controllerIndex=0; controllerIndex < sortedControllerMap.length; ++controllerIndex)
             this._setupController(sortedControllerMap[controllerIndex]);
@@ -129,6 +318,18 @@ var Controller = klass(function(controllerPath, selector, extraData){
     attach: function(){
         this.$container.data('attached', true);
     },
+    // components that bind to elements inside their container (e.g. event handlers set up in the constructor) can
+    // set this to a function that binds them again. It is called when the container has been replaced with new HTML,
+    // and without it the component is created again instead
+    containerReplaced: null,
+    rebind: function(){
+        // the container has been replaced by new content, so locate it again and attach to it
+        this.$container = $(this.containerSelector);
+        this.attach();
+
+        if(this.containerReplaced)
+            this.containerReplaced();
+    },
     detach: function(){
         this.$container.data('attached', false);
     },
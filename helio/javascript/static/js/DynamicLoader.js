@@ -138,17 +138,41 @@ var DynamicLoader = klass(function(){
         if(unloadedDependenciesCount == 0)
            this.setupAndRegisterAfterDependenciesComplete(typeIdentifier, setupCallback);
     },
-    getViewState: function(){
-        var viewStatePath = g_helioSettings.view_state_path || '/get-view-state/';
+    buildViewStateURL: function(viewStatePath){
         var currentVSID = (g_helioSettings.viewstate_id == undefined || g_helioSettings.viewstate_id == null) ? '-1' : g_helioSettings.viewstate_id;
         var viewStateURL = viewStatePath + (viewStatePath.indexOf('?') >= 0 ? '&' : '?') + 'vs_id=' + currentVSID;
 
+        if(g_helioSettings.fork_viewstate_id != undefined && g_helioSettings.fork_viewstate_id != null){
+            // start from a copy of another tab's ViewState, rather than a new one
+            viewStateURL += '&fork=' + g_helioSettings.fork_viewstate_id;
+            delete g_helioSettings.fork_viewstate_id;
+        }
+
+        return viewStateURL;
+    },
+    getViewState: function(){
+        var viewStateURL = this.buildViewStateURL(g_helioSettings.view_state_path || '/get-view-state/');
+
         var _this = this;
         $.get(viewStateURL, function(data){
             setViewStateID(data);
             if(_this.postViewStateSetup)
                 _this.postViewStateSetup();
         });
+    },
+    bootstrap: function(){
+        // gets the ViewState and the page's controller data in one request
+        var bootstrapURL = this.buildViewStateURL(g_helioSettings.bootstrap_path || '/bootstrap/');
+
+        var _this = this;
+        $.get(bootstrapURL, function(data){
+            _this.bootstrapCallback(data);
+        }, 'json');
+    },
+    bootstrapCallback: function(bootstrapData){
+        setViewStateID(bootstrapData.vs_id);
+        if(this.postBootstrapSetup)
+            this.postBootstrapSetup(bootstrapData);
     }
 });
 
@@ -159,6 +183,18 @@ var setViewStateID = function(viewStateID){
     }
 }
 
+var forkViewStateURL = function(url){
+    // a URL that opens this tab's ViewState in a new tab, e.g. for a link's href
+    return url + (url.indexOf('?') >= 0 ? '&' : '?') + 'helio_fork=' + g_helioSettings.viewstate_id;
+}
+
+var refreshViewState = function(){
+    // the server no longer has this tab's ViewState, so start again with a new one
+    if(g_helioSettings.viewstate_id)
+        g_helioSettings.viewstate_id = 0;
+    window.location = '/';
+}
+
 var registerClass = function(typeIdentifer, dependencies, setupCallback){
     if(typeof(dependencies) == 'string')
         dependencies = [dependencies];
@@ -12,42 +12,173 @@ var buildNotificationURL = function(targetPath, notificationName){
     return notificationURL;
 }
 
+var buildBatchNotificationURL = function(){
+    var notificationURL = g_helioSettings.batch_notification_url || '/notifications';
+
+    if(g_helioSettings.viewstate_id)
+        notificationURL += (notificationURL.indexOf('?') == -1 ? '?' : '&')  + 'vs_id=' + g_helioSettings.viewstate_id;
+
+    return notificationURL;
+}
+
 var postNotification = function(targetPath, notificationName, notificationData, force, uncritical){
     window.g_helioNotificationCentre.postNotification(targetPath, notificationName, notificationData, force, uncritical);
 }
 
+// the content type of streamed notifications, as NDJSON_CONTENT_TYPE in helio/views/views.py
+var NDJSON_CONTENT_TYPE = 'application/x-ndjson';
+
+var NotificationStreamParser = klass(function(notificationCallback){
+    this.notificationCallback = notificationCallback;
+    this.parsedLength = 0;
+}).methods({
+    feed: function(responseText){
+        // called with all of the response received so far, so only the complete lines after the last one parsed are
+        // new
+        var lineEnd;
+
+        while((lineEnd = responseText.indexOf('\n', this.parsedLength)) != -1){
+            var line = responseText.substring(this.parsedLength, lineEnd);
+            this.parsedLength = lineEnd + 1;
+
+            if(line)
+                this.notificationCallback(JSON.parse(line));
+        }
+    }
+});
+
 var NotificationCentre = klass(function(){
     this.notifications = [];
+    this.pendingPosts = [];
     this.notificationActive = false;
     this.postActive = false;
 }).methods({
     postNotification: function(targetPath, notificationName, notificationData, force, uncritical){
-        if(!force && (this.postActive || this.notificationActive))
-            return false;
+        if(!force && (this.postActive || this.notificationActive)){
+            // sent along with any others posted in the meantime once the current one has finished
+            this.queuePost(targetPath, notificationName, notificationData, uncritical);
+            return true;
+        }
 
-        var notificationURL = buildNotificationURL(targetPath, notificationName);
+        this.sendPost(buildNotificationURL(targetPath, notificationName), notificationData, uncritical);
+        return true;
+    },
+    queuePost: function(targetPath, notificationName, notificationData, uncritical){
+        // notifications aren't idempotent (two "add" clicks should add twice), so each one is kept in order. Only a
+        // load that is already queued is dropped, as loading the same controller twice gives the same result
+        var postKey = JSON.stringify([targetPath, notificationName, notificationData]);
+
+        if(notificationName.split(':')[0] == 'load'){
+            for(var postIndex = 0; postIndex < this.pendingPosts.length; ++postIndex){
+                if(this.pendingPosts[postIndex].key == postKey)
+                    return;
+            }
+        }
 
+        this.pendingPosts.push({key: postKey, target: targetPath, name: notificationName, data: notificationData,
+                                uncritical: uncritical});
+    },
+    flushPendingPosts: function(){
+        if(this.pendingPosts.length == 0 || this.postActive || this.notificationActive)
+            return;
+
+        var pendingPosts = this.pendingPosts;
+        this.pendingPosts = [];
+
+        if(pendingPosts.length == 1){
+            var post = pendingPosts[0];
+            this.sendPost(buildNotificationURL(post.target, post.name), post.data, post.uncritical);
+            return;
+        }
+
+        var batch = [], uncritical = true;
+
+        for(var postIndex = 0; postIndex < pendingPosts.length; ++postIndex){
+            // each item's data is url encoded, as $.post would encode it for a single notification, so the server
+            // decodes it the same way
+            var postData = pendingPosts[postIndex].data;
+            if(typeof postData != 'string')
+                postData = $.param(postData || {});
+
+            batch.push([pendingPosts[postIndex].target, pendingPosts[postIndex].name, postData]);
+            uncritical = uncritical && pendingPosts[postIndex].uncritical;
+        }
+
+        this.sendPost(buildBatchNotificationURL(), {notifications: JSON.stringify(batch)}, uncritical);
+    },
+    sendPost: function(notificationURL, notificationData, uncritical){
         var _this = this;
         if(!uncritical) {
             this.postActive = true;
             this.activityStatusChanged();
         }
+        if(g_helioSettings.stream_notifications){
+            this.streamPost(notificationURL, notificationData);
+            return;
+        }
+
         $.post(notificationURL, notificationData, function(callbackData){
             _this.notificationPostCallback(callbackData);
         }, 'json').fail(function(){
             _this.notificationPostFailure();
         });
-        return true;
+    },
+    streamPost: function(notificationURL, notificationData){
+        // asks the server to send each notification on its own line as soon as it is ready, so they are delegated as
+        // they arrive rather than once the whole response has. A server that doesn't stream them sends the usual JSON
+        var _this = this;
+        var streamParser = new NotificationStreamParser(function(notification){
+            _this.notificationStreamCallback(notification);
+        });
+
+        var isStreamed = function(xhr){
+            return (xhr.getResponseHeader('Content-Type') || '').indexOf(NDJSON_CONTENT_TYPE) === 0;
+        };
+
+        $.ajax({
+            url: notificationURL,
+            type: 'POST',
+            data: notificationData,
+            dataType: 'text',
+            headers: {Accept: NDJSON_CONTENT_TYPE + ', application/json'},
+            xhr: function(){
+                var xhr = $.ajaxSettings.xhr();
+                xhr.onprogress = function(){
+                    if(isStreamed(xhr))
+                        streamParser.feed(xhr.responseText);
+                };
+                return xhr;
+            }
+        }).done(function(responseText, textStatus, jqXHR){
+            if(!isStreamed(jqXHR)){
+                _this.notificationPostCallback(JSON.parse(responseText));
+                return;
+            }
+
+            // the last line, or a refresh response, may not have a newline after it
+            streamParser.feed(responseText + '\n');
+            _this.notificationPostCallback([]);
+        }).fail(function(){
+            _this.notificationPostFailure();
+        });
+    },
+    notificationStreamCallback: function(notification){
+        if(notification == 'refresh'){
+            refreshViewState();
+            return;
+        }
+
+        this.queueNotificationDelegation(notification);
+        this.processQueue();
     },
     notificationPostFailure: function(){
         this.postActive = false;
         this.activityStatusChanged();
+        this.flushPendingPosts();
     },
     notificationPostCallback: function(notificationData){
         if (notificationData == 'refresh') {
-            if(g_helioSettings.viewstate_id)
-                g_helioSettings.viewstate_id = 0;
-            window.location = '/';
+            refreshViewState();
             return;
         }
 
@@ -78,6 +209,8 @@ var NotificationCentre = klass(function(){
                 window.scrollTo(0, 0);
                 this.scrollTopOnFinish = false;
             }
+            if(this.notifications.length == 0)
+                this.flushPendingPosts();
             return;
         }
 
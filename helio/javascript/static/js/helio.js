@@ -7,10 +7,26 @@ var helioSetup = function(){
         window.g_helioSettings.viewstate_id = sessionStorage.getItem('helioViewStateID');
     }
 
+    var forkMatch = /[?&]helio_fork=(\d+)/.exec(window.location.search);
+
+    if(forkMatch)
+        window.g_helioSettings.fork_viewstate_id = forkMatch[1];
+
     g_helioLoader.postViewStateSetup = function(){
         var page = new Controller('page', 'body');
         page.load();
     };
 
-    g_helioLoader.getViewState();
+    g_helioLoader.postBootstrapSetup = function(bootstrapData){
+        var page = new Controller('page', 'body');
+        page.load(bootstrapData);
+    };
+
+    if(window.g_helioBootstrap){
+        // the page was rendered with the bootstrap data already in it, so there's nothing to request
+        var bootstrapData = window.g_helioBootstrap;
+        delete window.g_helioBootstrap;
+        g_helioLoader.bootstrapCallback(bootstrapData);
+    } else
+        g_helioLoader.bootstrap();
 }
\ No newline at end of file
@@ -85,6 +85,74 @@ describe("Controller helpers", function(){
     });
 });
 
+describe("HTML patches", function(){
+    it("tokenizeHTML should split HTML into tags and text", function(){
+        expect(tokenizeHTML('<div>a < b</div>')).toEqual(['<div>', 'a ', '< b</div>']);
+        expect(tokenizeHTML('')).toEqual([]);
+    });
+
+    it("htmlChecksum should calculate the Adler-32 of the UTF-8 encoded HTML", function(){
+        expect(htmlChecksum('Wikipedia')).toBe(300286872);
+        expect(htmlChecksum('\u00e9')).toBe(36766061);
+    });
+
+    it("applyHTMLPatch should apply the operations to the tokens of the base HTML", function(){
+        var baseHTML = '<ul><li>one</li><li>two</li></ul>';
+        var html = '<ul><li>one</li><li>three</li></ul>';
+        var patch = {base: htmlChecksum(baseHTML), operations: [[5, 6, 'three']], checksum: htmlChecksum(html)};
+        expect(applyHTMLPatch(baseHTML, patch)).toBe(html);
+        expect(applyHTMLPatch('<ul></ul>', patch)).toBe(null);
+        expect(applyHTMLPatch(undefined, patch)).toBe(null);
+    });
+
+    it("storeHTMLBaseline should drop the baselines of the controller's ancestors and descendants", function(){
+        g_helioHTMLBaselines = {'page': 'a', 'page.one': 'b', 'page.one.two': 'c', 'page.other': 'd'};
+        storeHTMLBaseline('page.one', 'new');
+        expect(g_helioHTMLBaselines).toEqual({'page.one': 'new', 'page.other': 'd'});
+    });
+});
+
+describe("loadDeferredControllers", function(){
+    var mockLoad;
+
+    beforeEach(function(){
+        mockLoad = spyOn(Controller.prototype, 'load');
+    });
+
+    it("should load deferred children straight away", function(){
+        loadDeferredControllers($('<div><div id="page.slow-deferred" data-helio-deferred="paint" data-helio-deferred-path="page.slow"></div></div>'));
+        expect(mockLoad).toHaveBeenCalled();
+        expect(mockLoad.mostRecentCall.object.controllerPath).toBe('page.slow');
+    });
+
+    it("should replace the placeholder with the child's content", function(){
+        var $page = $('<div><div id="page.slow-deferred" data-helio-deferred="paint" data-helio-deferred-path="page.slow"></div></div>').appendTo('body');
+        mockLoad.andCallFake(function(){
+            this.setContent('<div id="page.slow">slow</div>');
+        });
+
+        loadDeferredControllers($page);
+        expect($page.html()).toBe('<div id="page.slow">slow</div>');
+        expect(mockLoad.mostRecentCall.object.$container.text()).toBe('slow');
+        $page.remove();
+    });
+
+    it("should load children deferred until visible once they scroll into view", function(){
+        var observerCallback, savedIntersectionObserver = window.IntersectionObserver;
+        window.IntersectionObserver = function(callback){
+            observerCallback = callback;
+            this.observe = jasmine.createSpy();
+            this.disconnect = jasmine.createSpy();
+        };
+
+        loadDeferredControllers($('<div><div id="page.slow-deferred" data-helio-deferred="visible" data-helio-deferred-path="page.slow"></div></div>'));
+        expect(mockLoad).not.toHaveBeenCalled();
+        observerCallback([{isIntersecting: true}]);
+        expect(mockLoad).toHaveBeenCalled();
+        window.IntersectionObserver = savedIntersectionObserver;
+    });
+});
+
 describe("Controller", function() {
     var testController;
     beforeEach(function(){
@@ -152,6 +220,7 @@ describe("Controller", function() {
         };
 
         spyOn($, 'get'); // don't actually call get
+        jasmine.Clock.useMock();
         testController.$container = mock$Container;
         testController.load();
         expect(mock$Container.data).toHaveBeenCalledWith('attached', false);
@@ -159,13 +228,40 @@ describe("Controller", function() {
 
     it("should call get with the component URL and 'json' (type) arg", function(){
         var mockGet = spyOn($, 'get');
+        jasmine.Clock.useMock();
 
         testController.load();
+        expect(mockGet).not.toHaveBeenCalled();
+        jasmine.Clock.tick(0);
         expect(mockGet.mostRecentCall.args[0]).toBe(testController.buildURL());
         expect(mockGet.mostRecentCall.args[1]).toEqual(jasmine.any(Function));
         expect(mockGet.mostRecentCall.args[2]).toBe('json');
     });
 
+    it("should load the controllers that load in the same tick with one get", function(){
+        var mockGet = spyOn($, 'get');
+        var otherController = new Controller('this.is.other');
+        var mockLoadCallback = spyOn(testController, 'loadCallback');
+        var mockOtherLoadCallback = spyOn(otherController, 'loadCallback');
+        jasmine.Clock.useMock();
+
+        testController.load();
+        otherController.load();
+        testController.load();
+        jasmine.Clock.tick(0);
+        expect(mockGet.callCount).toBe(1);
+        expect(mockGet.mostRecentCall.args[0]).toBe('/controllers?paths=this.is.my.path,this.is.other&vs_id=viewstate_id');
+
+        mockGet.mostRecentCall.args[1]({'this.is.other': 'other-data'});
+        expect(mockLoadCallback).not.toHaveBeenCalled();
+        expect(mockOtherLoadCallback).toHaveBeenCalledWith('other-data');
+    });
+
+    it("should build the controllers URL from g_helioSettings.controllers_url if set", function(){
+        window.g_helioSettings.controllers_url = '/mock/controllers?format=json';
+        expect(buildControllersURL(['a', 'b'])).toBe('/mock/controllers?format=json&paths=a,b&vs_id=viewstate_id');
+    });
+
     it("setContent should use the .html() method to set the container content", function(){
         var mock$Container = {
             html: jasmine.createSpy()
@@ -185,6 +281,23 @@ describe("Controller", function() {
         expect(window.g_helioLoader.removeChildrenOfController).toHaveBeenCalledWith('this.is.my.path');
     });
 
+    it("should refresh the viewstate, and not set any content, if the load response is 'refresh'", function(){
+        var mockRefresh = spyOn(window, 'refreshViewState');
+        var mockSetContent = spyOn(testController, 'setContent');
+        testController.loadCallback('refresh');
+        expect(mockRefresh).toHaveBeenCalled();
+        expect(mockSetContent).not.toHaveBeenCalled();
+    });
+
+    it("should load the full HTML if a patch can't be applied", function(){
+        var mockLoad = spyOn(testController, 'load');
+        var mockSetContent = spyOn(testController, 'setContent');
+        g_helioHTMLBaselines = {};
+        testController.loadCallback({'patch': {base: 1, operations: [], checksum: 1}});
+        expect(mockLoad).toHaveBeenCalled();
+        expect(mockSetContent).not.toHaveBeenCalled();
+    });
+
     it("should process the class map through controllerClassMapTransform", function(){
         window.g_helioLoader = {
             controllerTypeNameRegistry: {},
@@ -205,6 +318,80 @@ describe("Controller", function() {
         expect(testController._setupController.calls[1].args[0]).toEqual({ depth: 1, path: 'page.two', assets: {script: 'js.component', css: 'the.css'}});
     });
 
+    it("should load deferred children once the class map has been set up", function(){
+        var mockApplyClassMap = spyOn(testController, 'applyClassMap');
+        var mockLoadDeferred = spyOn(window, 'loadDeferredControllers').andCallFake(function(){
+            expect(mockApplyClassMap).toHaveBeenCalled();
+        });
+        testController.loadCallback({'html': '', 'class_map': {}});
+        expect(mockLoadDeferred).toHaveBeenCalledWith(testController.$container);
+    });
+
+    it("should apply a class map delta, setting up only the changed controllers and re-binding the others", function(){
+        var mockUnchanged = {rebind: jasmine.createSpy()};
+        var mockRemoved = {rebind: jasmine.createSpy()};
+        var mockOutside = {rebind: jasmine.createSpy()};
+        window.g_helioLoader = {
+            controllerTypeNameRegistry: {},
+            controllerRegistry: {
+                'this.is.my.path.unchanged': mockUnchanged,
+                'this.is.my.path.removed': mockRemoved,
+                'this.is.other': mockOutside
+            }
+        };
+        var mockDetachCSS = spyOn(window, 'detachCSS');
+        testController._setupController = jasmine.createSpy();
+
+        testController.loadCallback({'html': 'html', 'class_map_delta': {
+            'changed': {'this.is.my.path.new': {'script': 'js.component'}},
+            'removed': ['this.is.my.path.removed']
+        }});
+
+        expect(mockDetachCSS).toHaveBeenCalledWith('this.is.my.path.removed');
+        expect(window.g_helioLoader.controllerRegistry['this.is.my.path.removed']).toBe(undefined);
+        expect(mockUnchanged.rebind).toHaveBeenCalled();
+        expect(mockRemoved.rebind).not.toHaveBeenCalled();
+        expect(mockOutside.rebind).not.toHaveBeenCalled();
+        expect(testController._setupController.calls.length).toBe(1);
+        expect(testController._setupController.calls[0].args[0]).toEqual({depth: 5, path: 'this.is.my.path.new', assets: {script: 'js.component'}});
+    });
+
+    it("should re-bind components with a containerReplaced hook, and create the others again", function(){
+        var mockRebindable = {rebind: jasmine.createSpy(), containerReplaced: function(){}};
+        var mockNotRebindable = {rebind: jasmine.createSpy()};
+        var mockReplaced = {rebind: jasmine.createSpy(), containerReplaced: function(){}};
+        window.g_helioLoader = {
+            controllerTypeNameRegistry: {
+                'this.is.my.path.rebindable': 'js.rebindable',
+                'this.is.my.path.notrebindable': 'js.notrebindable',
+                'this.is.my.path.replaced': 'js.replaced'
+            },
+            controllerRegistry: {
+                'this.is.my.path.rebindable': mockRebindable,
+                'this.is.my.path.notrebindable': mockNotRebindable,
+                'this.is.my.path.replaced': mockReplaced
+            },
+            initializeController: jasmine.createSpy()
+        };
+        testController._setupController = jasmine.createSpy();
+
+        testController.applyClassMapDelta({'changed': {'this.is.my.path.replaced': {'script': 'js.replaced'}},
+                                           'removed': []});
+
+        expect(mockRebindable.rebind).toHaveBeenCalled();
+        expect(mockNotRebindable.rebind).not.toHaveBeenCalled();
+        expect(window.g_helioLoader.initializeController).toHaveBeenCalledWith('this.is.my.path.notrebindable', 'js.notrebindable');
+        expect(mockReplaced.rebind).not.toHaveBeenCalled();
+        expect(window.g_helioLoader.controllerRegistry['this.is.my.path.replaced']).toBe(undefined);
+        expect(testController._setupController.calls[0].args[0].path).toEqual('this.is.my.path.replaced');
+    });
+
+    it("rebind should call the containerReplaced hook", function(){
+        testController.containerReplaced = jasmine.createSpy();
+        testController.rebind();
+        expect(testController.containerReplaced).toHaveBeenCalled();
+    });
+
     it("_setupController should set controllerTypeNameRegistry to undefined for an undefined class, and controllerRegistry should be a Controller instance", function(){
          window.g_helioLoader = {
             controllerTypeNameRegistry: {},
@@ -213,6 +213,37 @@ describe("DynamicLoader", function(){
         dynamicLoader.getViewState();
         expect(mockGet).toHaveBeenCalledWith('?mock-vs-url&vs_id=2', jasmine.any(Function));
     });
+
+    it("should ask for a fork of the fork_viewstate_id setting's ViewState, once", function(){
+        window.g_helioSettings = {'viewstate_id': '2', 'fork_viewstate_id': '1'};
+        var mockGet = spyOn($, 'get');
+
+        dynamicLoader.getViewState();
+        expect(mockGet).toHaveBeenCalledWith('/get-view-state/?vs_id=2&fork=1', jasmine.any(Function));
+        expect(window.g_helioSettings['fork_viewstate_id']).toBeUndefined();
+    });
+
+    it("should bootstrap from /bootstrap/ by default, or g_helioSettings.bootstrap_path", function(){
+        window.g_helioSettings = {'fork_viewstate_id': '1'};
+        var mockGet = spyOn($, 'get');
+
+        dynamicLoader.bootstrap();
+        expect(mockGet).toHaveBeenCalledWith('/bootstrap/?vs_id=-1&fork=1', jasmine.any(Function), 'json');
+
+        window.g_helioSettings = {'bootstrap_path': '/mock-bootstrap/', 'viewstate_id': '2'};
+        dynamicLoader.bootstrap();
+        expect(mockGet).toHaveBeenCalledWith('/mock-bootstrap/?vs_id=2', jasmine.any(Function), 'json');
+    });
+
+    it("should set the view state ID and call postBootstrapSetup with the bootstrap data", function(){
+        window.g_helioSettings = {};
+        dynamicLoader.postBootstrapSetup = jasmine.createSpy();
+        var bootstrapData = {'vs_id': 4, 'html': 'html', 'class_map': {}};
+
+        dynamicLoader.bootstrapCallback(bootstrapData);
+        expect(window.g_helioSettings['viewstate_id']).toBe(4);
+        expect(dynamicLoader.postBootstrapSetup).toHaveBeenCalledWith(bootstrapData);
+    });
 });
 
 describe("registerClass", function(){
@@ -241,6 +272,14 @@ describe("registerClass", function(){
     });
 });
 
+describe("forkViewStateURL", function(){
+    it("should add the current view state ID to the URL as helio_fork", function(){
+        window.g_helioSettings = {'viewstate_id': '3'};
+        expect(forkViewStateURL('/page/')).toBe('/page/?helio_fork=3');
+        expect(forkViewStateURL('/page/?a=b')).toBe('/page/?a=b&helio_fork=3');
+    });
+});
+
 describe("setViewStateID", function(){
     it("should set view state ID into the Helio settings and the session storage", function(){
         window.g_helioSettings = {};
@@ -38,11 +38,12 @@ describe("NotificationCentre", function(){
         });
     });
 
-    it("should drop the notification if one is already in progress, unless forced", function(){
+    it("should queue the notification if one is already in progress, unless forced", function(){
         notificationCentre.notificationActive = true;
         notificationCentre.postNotification('path', 'name', 'data');
         expect(mockURLGEN).not.toHaveBeenCalled();
         expect(mockPost).not.toHaveBeenCalled();
+        expect(notificationCentre.pendingPosts.length).toBe(1);
         notificationCentre.postNotification('path', 'name', 'data', true);
         expect(mockURLGEN).toHaveBeenCalledWith('path', 'name');
         expect(mockPost).toHaveBeenCalledWith('mock-url', 'data', jasmine.any(Function), 'json');
@@ -51,12 +52,81 @@ describe("NotificationCentre", function(){
 
         notificationCentre.notificationActive = false;
         notificationCentre.postActive = true;
-        notificationCentre.postNotification('path', 'name', 'data');
+        notificationCentre.postNotification('path', 'other-name', 'data');
         expect(mockURLGEN).not.toHaveBeenCalled();
         expect(mockPost).not.toHaveBeenCalled();
-        notificationCentre.postNotification('path', 'name', 'data', true);
+        expect(notificationCentre.pendingPosts.length).toBe(2);
+    });
+
+    it("should keep every queued notification, in order", function(){
+        notificationCentre.postActive = true;
+        notificationCentre.postNotification('path', 'add', {'a': 1});
+        notificationCentre.postNotification('path', 'add', {'a': 1});
+        notificationCentre.postNotification('path', 'add', {'a': 2});
+        expect(notificationCentre.pendingPosts.length).toBe(3);
+        expect(notificationCentre.pendingPosts[2].data).toEqual({'a': 2});
+    });
+
+    it("should coalesce identical queued loads", function(){
+        notificationCentre.postActive = true;
+        notificationCentre.postNotification('path', 'load');
+        notificationCentre.postNotification('path', 'load');
+        notificationCentre.postNotification('path', 'load:scroll_top');
+        notificationCentre.postNotification('other.path', 'load');
+        expect(notificationCentre.pendingPosts.length).toBe(3);
+    });
+
+    it("should send a single queued notification on its own once idle", function(){
+        notificationCentre.postActive = true;
+        notificationCentre.postNotification('path', 'name', 'data');
+        notificationCentre.postActive = false;
+        notificationCentre.processQueue();
         expect(mockURLGEN).toHaveBeenCalledWith('path', 'name');
         expect(mockPost).toHaveBeenCalledWith('mock-url', 'data', jasmine.any(Function), 'json');
+        expect(notificationCentre.pendingPosts.length).toBe(0);
+    });
+
+    it("should send the queued notifications as one batch once idle", function(){
+        window.g_helioSettings = {viewstate_id: 2};
+        notificationCentre.postActive = true;
+        notificationCentre.postNotification('path', 'name', {'a': 1});
+        notificationCentre.postNotification('other.path', 'other-name', 'b=2');
+        notificationCentre.notificationPostCallback([]);
+        expect(mockURLGEN).not.toHaveBeenCalled();
+        expect(mockPost).toHaveBeenCalledWith('/notifications?vs_id=2',
+            {notifications: '[["path","name","a=1"],["other.path","other-name","b=2"]]'}, jasmine.any(Function),
+            'json');
+        expect(notificationCentre.postActive).toBe(true);
+    });
+
+    it("should stream the notification if g_helioSettings.stream_notifications is set", function(){
+        window.g_helioSettings = {'stream_notifications': true};
+        var mockStreamPost = spyOn(notificationCentre, 'streamPost');
+        notificationCentre.postNotification('path', 'name', 'data');
+        expect(mockStreamPost).toHaveBeenCalledWith('mock-url', 'data');
+        expect(mockPost).not.toHaveBeenCalled();
+        expect(notificationCentre.postActive).toBe(true);
+    });
+
+    it("should ask for streamed notifications, and handle a JSON response from a server that doesn't stream", function(){
+        var mockAjax = spyOn($, 'ajax').andReturn({done: function(callback){
+            callback('[{"name": "load", "target": "path"}]', 'success', {getResponseHeader: function(){
+                return 'application/json';
+            }});
+            return {fail: function(){}};
+        }});
+        var mockCallback = spyOn(notificationCentre, 'notificationPostCallback');
+        notificationCentre.streamPost('mock-url', 'data');
+        expect(mockAjax.mostRecentCall.args[0].headers.Accept).toBe('application/x-ndjson, application/json');
+        expect(mockCallback).toHaveBeenCalledWith([{'name': 'load', 'target': 'path'}]);
+    });
+
+    it("should delegate streamed notifications as they arrive", function(){
+        var mockDelegator = spyOn(notificationCentre, 'queueNotificationDelegation');
+        var mockProcessQueue = spyOn(notificationCentre, 'processQueue');
+        notificationCentre.notificationStreamCallback({'name': 'load', 'target': 'path'});
+        expect(mockDelegator).toHaveBeenCalledWith({'name': 'load', 'target': 'path'});
+        expect(mockProcessQueue).toHaveBeenCalled();
     });
 
     it("should not call activityStatusChanged on uncritical calls", function(){
@@ -243,4 +313,22 @@ describe("NotificationCentre", function(){
         expect(notificationCentre.notificationActive).toBe(false);
         expect(mockProcessQueue).toHaveBeenCalled();
     });
-});
\ No newline at end of file
+});
+
+describe("NotificationStreamParser", function(){
+    it("should call back with each complete line of JSON, once", function(){
+        var mockCallback = jasmine.createSpy();
+        var streamParser = new NotificationStreamParser(mockCallback);
+
+        streamParser.feed('{"name": "one"}\n{"na');
+        expect(mockCallback.callCount).toBe(1);
+        expect(mockCallback).toHaveBeenCalledWith({'name': 'one'});
+
+        streamParser.feed('{"name": "one"}\n{"name": "two"}\n');
+        expect(mockCallback.callCount).toBe(2);
+        expect(mockCallback.mostRecentCall.args[0]).toEqual({'name': 'two'});
+
+        streamParser.feed('{"name": "one"}\n{"name": "two"}\n\n');
+        expect(mockCallback.callCount).toBe(2);
+    });
+});
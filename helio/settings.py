@@ -2,5 +2,22 @@ import os
 
 COMPONENT_BASE_DIRECTORIES = (os.path.join(os.getcwd(), 'components'),)
 VIEWSTATE_MANAGER_SESSION_KEY = 'helio_viewstates'
-TEMPLATE_RENDERER = 'helio.heliodjango.renderers.render'
+TEMPLATE_RENDERER = 'helio.heliodjango.renderers.DjangoRenderer'
 DEFAULT_ROOT_COMPONENT = 'page'
+VIEWSTATE_BACKEND = 'helio.viewstate.backends.SessionViewStateBackend'
+VIEWSTATE_BACKEND_OPTIONS = {}
+VIEWSTATE_MAX_PER_SESSION = 20
+VIEWSTATE_IDLE_TTL = 60 * 60 * 24
+VIEWSTATE_COMPRESSION_LEVEL = 6
+FRAGMENT_CACHE_MAX_ENTRIES = 1000
+FRAGMENT_CACHE_BACKEND = None
+FRAGMENT_CACHE_BACKEND_OPTIONS = {}
+CLASS_MAP_DELTAS = False
+HTML_PATCHES = False
+HTML_PATCH_BASELINE_MAX_ENTRIES = 1000
+# streaming is coarse-grained: the Django renderer yields each top level template node (so a template that extends
+# another comes out in one piece), child controllers are rendered within their parent's chunk rather than streamed
+# separately, and the client only parses the response once it has all arrived. It gets the first bytes to the client
+# sooner, not a progressively rendered page
+STREAM_RESPONSES = False
+PARALLEL_CONTEXT_SETUP_THREADS = 4
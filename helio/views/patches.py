@@ -0,0 +1,119 @@
+import re
+import zlib
+from difflib import SequenceMatcher
+from hashlib import sha1
+from helio.controller.fragment_cache import LocalMemoryFragmentCache
+from helio.settings import HTML_PATCH_BASELINE_MAX_ENTRIES
+
+# splits HTML into tags and the text between them, the same way as tokenizeHTML in BaseController.js
+HTML_TOKEN_RE = re.compile(r'<[^>]*>?|[^<]+')
+
+# roughly the JSON overhead of each patch operation, used to decide whether a patch is worth sending
+OPERATION_OVERHEAD = 16
+
+# once the common start and end have been trimmed, the changed middles are only diffed token by token if they have no
+# more tokens than this between them (SequenceMatcher is worse than linear), otherwise the middle is replaced whole
+MAX_DIFF_TOKENS = 400
+
+
+def tokenize_html(html):
+    return HTML_TOKEN_RE.findall(html)
+
+
+def html_checksum(html):
+    """Adler-32 of the UTF-8 encoded HTML, as calculated by htmlChecksum in BaseController.js."""
+    if isinstance(html, unicode):
+        html = html.encode('utf-8')
+
+    return zlib.adler32(html) & 0xffffffff
+
+
+def _changed_ranges(base_tokens, tokens):
+    """Yield (base_start, base_end, start, end) for each range of base_tokens that is replaced by a range of tokens.
+    The common start and end are trimmed in linear time, and only what is left in the middle is diffed, if it is
+    small enough."""
+    prefix = 0
+    max_prefix = min(len(base_tokens), len(tokens))
+
+    while prefix < max_prefix and base_tokens[prefix] == tokens[prefix]:
+        prefix += 1
+
+    suffix = 0
+    max_suffix = max_prefix - prefix
+
+    while suffix < max_suffix and base_tokens[-1 - suffix] == tokens[-1 - suffix]:
+        suffix += 1
+
+    base_middle = base_tokens[prefix:len(base_tokens) - suffix]
+    middle = tokens[prefix:len(tokens) - suffix]
+
+    if not base_middle and not middle:
+        return
+
+    if len(base_middle) + len(middle) > MAX_DIFF_TOKENS:
+        yield prefix, prefix + len(base_middle), prefix, prefix + len(middle)
+        return
+
+    for tag, base_start, base_end, start, end in SequenceMatcher(None, base_middle, middle,
+                                                                 autojunk=False).get_opcodes():
+        if tag != 'equal':
+            yield prefix + base_start, prefix + base_end, prefix + start, prefix + end
+
+
+# the HTML sent to clients, keyed by its digest, for patches to be made against. Only the digests are stored in the
+# ViewStates, so the HTML isn't written into the session. A baseline that has been evicted (or was sent by another
+# process) means the full HTML is sent instead of a patch
+_baselines = LocalMemoryFragmentCache(HTML_PATCH_BASELINE_MAX_ENTRIES)
+
+
+def html_digest(html):
+    if isinstance(html, unicode):
+        html = html.encode('utf-8')
+
+    return sha1(html).hexdigest()
+
+
+def remember_baseline(html):
+    """Keep html as a baseline for patches, and return the digest to find it by."""
+    digest = html_digest(html)
+    _baselines.set(digest, html)
+    return digest
+
+
+def get_baseline(digest):
+    """Return the baseline HTML with the digest, or None if it isn't known to this process."""
+    return _baselines.get(digest)
+
+
+def make_html_patch(base_html, html):
+    """Return a patch that turns base_html into html, or None if it wouldn't be smaller than html. The operations are
+    [start, end, replacement] where start and end index the tokens of base_html, and are in order of start."""
+    base_tokens = tokenize_html(base_html)
+    tokens = tokenize_html(html)
+    operations = []
+    patch_size = 0
+
+    for base_start, base_end, start, end in _changed_ranges(base_tokens, tokens):
+        replacement = ''.join(tokens[start:end])
+        operations.append([base_start, base_end, replacement])
+        patch_size += len(replacement) + OPERATION_OVERHEAD
+
+        if patch_size >= len(html):
+            return None
+
+    return {'base': html_checksum(base_html), 'operations': operations, 'checksum': html_checksum(html)}
+
+
+def apply_html_patch(base_html, patch):
+    """Apply a patch from make_html_patch, returning None if base_html isn't what the patch was made from or the
+    result isn't what it was made to produce."""
+    if html_checksum(base_html) != patch['base']:
+        return None
+
+    tokens = tokenize_html(base_html)
+
+    for start, end, replacement in reversed(patch['operations']):
+        tokens[start:end] = [replacement]
+
+    html = ''.join(tokens)
+    return html if html_checksum(html) == patch['checksum'] else None
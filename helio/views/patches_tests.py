@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import unittest
+from mock import patch
+from patches import tokenize_html, html_checksum, make_html_patch, apply_html_patch
+
+
+class HTMLPatchTests(unittest.TestCase):
+    base_html = u'<ul>' + u''.join(u'<li>row %d</li>' % row for row in xrange(20)) + u'</ul>'
+
+    def test_tokenize(self):
+        """HTML is split into tags and text, without losing any characters."""
+        self.assertEqual(tokenize_html('<div>a < b</div>'), ['<div>', 'a ', '< b</div>'])
+        self.assertEqual(''.join(tokenize_html(self.base_html)), self.base_html)
+
+    def test_checksum(self):
+        """The checksum is the Adler-32 of the UTF-8 encoded HTML."""
+        self.assertEqual(html_checksum('Wikipedia'), 300286872)
+        self.assertEqual(html_checksum(u'é'), 36766061)
+
+    def test_patch_round_trip(self):
+        """Applying a patch to the HTML it was made from gives the new HTML."""
+        html = self.base_html.replace(u'row 5', u'row five').replace(u'<li>row 9</li>', u'')
+        patch = make_html_patch(self.base_html, html)
+        self.assertEqual(len(patch['operations']), 2)
+        self.assertEqual(apply_html_patch(self.base_html, patch), html)
+
+    def test_large_patch_not_made(self):
+        """No patch is made if it wouldn't be smaller than the new HTML."""
+        self.assertIsNone(make_html_patch(self.base_html, u'<p>completely different</p>'))
+
+    def test_large_change_replaced_whole(self):
+        """When the changed middle is too big to diff it is replaced in one operation, after the common start and end
+        are trimmed."""
+        html = self.base_html.replace(u'row 5', u'row five').replace(u'row 9', u'row nine')
+
+        with patch('helio.views.patches.MAX_DIFF_TOKENS', 4):
+            html_patch = make_html_patch(self.base_html, html)
+
+        self.assertEqual(html_patch['operations'], [[17, 30, u'row five</li><li>row 6</li><li>row 7</li><li>row 8</li>'
+                                                             u'<li>row nine']])
+        self.assertEqual(apply_html_patch(self.base_html, html_patch), html)
+
+    def test_unchanged_html(self):
+        """HTML that hasn't changed gets a patch with no operations."""
+        self.assertEqual(make_html_patch(self.base_html, self.base_html)['operations'], [])
+
+    def test_wrong_base(self):
+        """A patch isn't applied to HTML other than what it was made from."""
+        patch = make_html_patch(self.base_html, self.base_html.replace(u'row 5', u'row five'))
+        self.assertIsNone(apply_html_patch(self.base_html.replace(u'row 1', u'row one'), patch))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,18 @@
 import unittest
+import json
+import shutil
+import tempfile
+from os.path import join
 from mock import MagicMock, patch
-from views import get_view_state, get_controller_data, dispatch_notification
+from views import get_view_state, fork_view_state, bootstrap_view_state, bootstrap_script, get_controller_data, \
+    get_controllers_data, dispatch_notification, dispatch_notifications, coalesce_load_notifications, \
+    stream_controller_data, stream_bootstrap_view_state, stream_notification, stream_notifications
 from helio.settings import VIEWSTATE_MANAGER_SESSION_KEY
+from helio.views.patches import html_digest, remember_baseline, get_baseline
+from helio.helio_exceptions import ViewStateError
+from helio.controller.base import BaseViewController
+from helio.viewstate.backends import SQLiteViewStateBackend
+from helio.viewstate.viewstate import clear_viewstate_prototypes
 
 
 @patch('helio.viewstate.viewstate.init_controller', return_value=MagicMock())
@@ -29,6 +40,20 @@ class GetViewStateTests(unittest.TestCase):
         self.assertEqual(vs, 'viewstate')
 
 
+    def test_fork_view_state(self, mock_init):
+        """fork_view_state asks the VSM to fork the ViewState, and falls back to a new ViewState if it is missing."""
+        mock_vsm = MagicMock()
+        mock_vsm.fork_view_state = MagicMock(return_value='forked viewstate')
+        session = {VIEWSTATE_MANAGER_SESSION_KEY: mock_vsm}
+        self.assertEqual(fork_view_state(2, session), 'forked viewstate')
+        mock_vsm.fork_view_state.assert_called_with(2)
+
+        mock_vsm.fork_view_state.side_effect = ViewStateError
+        mock_vsm.get_view_state = MagicMock(return_value='new viewstate')
+        self.assertEqual(fork_view_state(2, session), 'new viewstate')
+        mock_vsm.get_view_state.assert_called_with(-1)
+
+
 class MockedControllerTest(unittest.TestCase):
     def setUp(self):
         self.mock_vsm = MagicMock()
@@ -55,6 +80,23 @@ class GetControllerDataTests(MockedControllerTest):
         self.mock_controller.class_map_tree.assert_called_with({})
         self.assertEqual({'html': 'controller html', 'class_map': 'class_map'}, controller_data)
 
+    @patch('helio.views.views.CLASS_MAP_DELTAS', True)
+    def test_get_controller_data_delta(self, mock_init):
+        """With the CLASS_MAP_DELTAS setting, the class map is sent as the changes since it was last sent."""
+        self.mock_controller.render = MagicMock(return_value='controller html')
+        self.mock_controller.class_map_tree = MagicMock(return_value='class_map')
+        self.mock_controller.path = 'controller.path'
+        self.mock_vs.class_map_delta = MagicMock(return_value='delta')
+
+        controller_data = get_controller_data('controller.path', 'vs_id', self.session, 'request')
+        self.mock_vs.class_map_delta.assert_called_with('controller.path', 'class_map')
+        self.assertEqual({'html': 'controller html', 'class_map_delta': 'delta'}, controller_data)
+
+    def test_no_view_state_manager(self, mock_init):
+        """If the session has no ViewStateManager, get_controller_data raises ViewStateError."""
+        with self.assertRaises(ViewStateError):
+            get_controller_data('controller.path', 'vs_id', {}, 'request')
+
     def test_kwargs_pass(self, mock_init):
         """get_controller_data should pass kwargs to the render function"""
         self.mock_controller.render = MagicMock(return_value='controller html')
@@ -64,6 +106,196 @@ class GetControllerDataTests(MockedControllerTest):
 
         self.mock_controller.render.assert_called_with(request='request', environment='env', more_arg='more_arg')
 
+    @patch('helio.views.views._release_view_state_manager')
+    def test_released_after_error(self, mock_release, mock_init):
+        """The ViewStateManager is released once the request has finished with it, even if rendering raised."""
+        self.mock_controller.render = MagicMock(side_effect=ValueError)
+
+        with self.assertRaises(ValueError):
+            get_controller_data('controller.path', 'vs_id', self.session)
+
+        mock_release.assert_called_once_with(self.session)
+
+
+@patch('helio.viewstate.viewstate.init_controller', return_value=MagicMock())
+class BootstrapTests(MockedControllerTest):
+    def setUp(self):
+        super(BootstrapTests, self).setUp()
+        self.mock_vs.index = 2
+        self.mock_vs.root_controller.render = MagicMock(return_value='html')
+        self.mock_vs.root_controller.class_map_tree = MagicMock(return_value='class_map')
+
+    def test_bootstrap_view_state(self, mock_init):
+        """The root controller's data is returned along with the index of the ViewState."""
+        bootstrap_data = bootstrap_view_state(2, self.session, request='request')
+        self.mock_vsm.get_view_state.assert_called_with(2)
+        self.mock_vs.root_controller.render.assert_called_with(request='request')
+        self.assertEqual(bootstrap_data, {'html': 'html', 'class_map': 'class_map', 'vs_id': 2})
+
+    def test_bootstrap_fork(self, mock_init):
+        """With fork_vs_id, the ViewState is forked from that one, or a new one if it doesn't exist."""
+        self.mock_vsm.fork_view_state = MagicMock(return_value=self.mock_vs)
+        bootstrap_view_state(-1, self.session, fork_vs_id=1)
+        self.mock_vsm.fork_view_state.assert_called_with(1)
+
+        self.mock_vsm.fork_view_state.side_effect = ViewStateError
+        self.assertEqual(bootstrap_view_state(-1, self.session, fork_vs_id=1)['vs_id'], 2)
+        self.mock_vsm.get_view_state.assert_called_with(-1)
+
+    def test_bootstrap_script(self, mock_init):
+        """The script sets g_helioBootstrap to the data, with nothing in it able to close the script tag."""
+        script = bootstrap_script({'html': '</script><p>text</p>', 'vs_id': 2})
+        self.assertEqual(script.count('</script>'), 1)
+        prefix = '<script type="text/javascript">window.g_helioBootstrap = '
+        self.assertTrue(script.startswith(prefix))
+        self.assertEqual(json.loads(script[len(prefix):-len(';</script>')]),
+                         {'html': '</script><p>text</p>', 'vs_id': 2})
+
+
+@patch('helio.viewstate.viewstate.init_controller', return_value=MagicMock())
+class StreamTests(MockedControllerTest):
+    def setUp(self):
+        super(StreamTests, self).setUp()
+        self.mock_controller.render_stream = MagicMock(return_value=iter([u'<p>"one"', u'</p>\u00e9']))
+        self.mock_controller.class_map_tree = MagicMock(return_value={'page': {}})
+        self.mock_vs.root_controller = self.mock_controller
+        self.mock_vs.index = 2
+        save_patcher = patch('helio.views.views._save_view_state_manager')
+        self.mock_save = save_patcher.start()
+        self.addCleanup(save_patcher.stop)
+
+    def test_stream_controller_data(self, mock_init):
+        """The streamed JSON is the same data as get_controller_data returns. The ViewStateManager is saved before the
+        response starts, and again once it has all been produced."""
+        chunks = stream_controller_data('page', 'vs_id', self.session, 'request')
+        self.mock_controller.render_stream.assert_not_called()
+        self.mock_save.assert_called_once_with(self.session, self.mock_vsm)
+        data = ''.join(chunks)
+        self.mock_controller.render_stream.assert_called_with(request='request')
+        self.assertEqual(json.loads(data), {'html': u'<p>"one"</p>\u00e9', 'class_map': {'page': {}}})
+        self.assertEqual(self.mock_save.call_count, 2)
+
+    def test_stream_missing_view_state(self, mock_init):
+        """ViewStateError is raised straight away, rather than from the iterator, and the ViewStateManager is
+        released."""
+        self.mock_vsm.get_view_state.side_effect = ViewStateError
+
+        with patch('helio.views.views._release_view_state_manager') as mock_release:
+            with self.assertRaises(ViewStateError):
+                stream_controller_data('page', 3, self.session)
+
+            mock_release.assert_called_once_with(self.session)
+
+    @patch('helio.views.views._release_view_state_manager')
+    def test_stream_released(self, mock_release, mock_init):
+        """A stream's ViewStateManager is released once it has all been produced, or once the stream is closed, even
+        if it was never started."""
+        chunks = stream_controller_data('page', 'vs_id', self.session)
+        mock_release.assert_not_called()
+        list(chunks)
+        mock_release.assert_called_once_with(self.session)
+
+        chunks = stream_controller_data('page', 'vs_id', self.session)
+        chunks.close()
+        chunks.close()
+        self.assertEqual(mock_release.call_count, 2)
+        self.assertEqual(self.mock_save.call_count, 3)
+
+    @patch('helio.views.views.CLASS_MAP_DELTAS', True)
+    @patch('helio.views.views.HTML_PATCHES', True)
+    def test_stream_deltas_and_patches(self, mock_init):
+        """With the settings, the class map delta is sent and the whole of the HTML is kept for the next patch."""
+        self.mock_controller.path = 'page'
+        self.mock_vs.class_map_delta = MagicMock(return_value={'changed': {}, 'removed': []})
+        data = json.loads(''.join(stream_controller_data('page', 'vs_id', self.session)))
+        self.assertEqual(data['class_map_delta'], {'changed': {}, 'removed': []})
+        self.mock_vs.swap_sent_html_digest.assert_called_with('page', html_digest(u'<p>"one"</p>\u00e9'))
+        self.assertEqual(get_baseline(html_digest(u'<p>"one"</p>\u00e9')), u'<p>"one"</p>\u00e9')
+
+    def test_stream_notification(self, mock_init):
+        """The notification is handled straight away, then each client notification is produced as a line of JSON as
+        it is rendered. The ViewStateManager is saved once the notification has been handled, and again at the end."""
+        self.mock_vs.notification_centre = [{'name': 'load', 'target': 'page'}, {'name': 'other', 'target': 'page'}]
+        self.mock_controller.render = MagicMock(return_value='html')
+        lines = stream_notification('page', 'vs_id', 'name', {}, self.session, 'request')
+        self.mock_controller.handle_notification.assert_called_with('name', {}, 'request')
+        self.mock_controller.render.assert_not_called()
+        self.mock_save.assert_called_once_with(self.session, self.mock_vsm)
+
+        self.assertEqual(json.loads(next(lines)), {'name': 'load', 'target': 'page',
+                                                   'data': {'html': 'html', 'class_map': {'page': {}}}})
+        self.assertEqual(self.mock_save.call_count, 1)
+        self.assertEqual(list(lines), ['{"name": "other", "target": "page"}\n'])
+        self.assertEqual(self.mock_save.call_count, 2)
+
+    def test_stream_notifications(self, mock_init):
+        """A batch of notifications is handled and saved straight away, with the client notifications streamed."""
+        self.mock_vs.notification_centre = [{'name': 'other', 'target': 'page'}]
+        lines = stream_notifications([('page', 'one', {}), ('page', 'two', {})], 'vs_id', self.session)
+        self.assertEqual(self.mock_controller.handle_notification.call_count, 2)
+        self.mock_save.assert_called_once_with(self.session, self.mock_vsm)
+        self.assertEqual(list(lines), ['{"name": "other", "target": "page"}\n'])
+
+    def test_stream_bootstrap(self, mock_init):
+        """The bootstrap data is streamed with the vs_id, and the new ViewState is saved before and after."""
+        chunks = stream_bootstrap_view_state(-1, self.session)
+        self.assertEqual(self.mock_save.call_count, 1)
+        self.assertEqual(json.loads(''.join(chunks)), {'vs_id': 2, 'html': u'<p>"one"</p>\u00e9',
+                                                       'class_map': {'page': {}}})
+        self.assertEqual(self.mock_save.call_count, 2)
+
+
+@patch('helio.viewstate.viewstate.init_controller', return_value=MagicMock())
+class GetControllersDataTests(MockedControllerTest):
+    def test_outermost_paths_rendered(self, mock_init):
+        """Each requested controller is rendered, except those inside another requested controller, with the
+        ViewState loaded once."""
+        self.mock_controller.render = MagicMock(return_value='html')
+        self.mock_controller.class_map_tree = MagicMock(return_value='class_map')
+        controllers_data = get_controllers_data(['page.main.list', 'page.side', 'page.main', 'page.side'], 'vs_id',
+                                                self.session, 'request')
+
+        self.mock_vsm.get_view_state.assert_called_once_with('vs_id', no_create=True)
+        self.assertEqual(controllers_data, {'page.main': {'html': 'html', 'class_map': 'class_map'},
+                                            'page.side': {'html': 'html', 'class_map': 'class_map'}})
+        self.assertEqual(self.mock_controller.render.call_count, 2)
+
+    def test_missing_view_state(self, mock_init):
+        """ViewStateError is raised if the ViewState no longer exists."""
+        self.mock_vsm.get_view_state.side_effect = ViewStateError
+        with self.assertRaises(ViewStateError):
+            get_controllers_data(['page'], 3, self.session)
+
+
+class CoalesceLoadNotificationTests(unittest.TestCase):
+    def test_ancestor_absorbs_descendants(self):
+        """A load of an ancestor absorbs loads of any of its descendants, wherever they are in the queue."""
+        notifications = [{'name': 'load', 'target': 'page.main.list.item3'}, {'name': 'other', 'target': 'page.x'},
+                         {'name': 'load', 'target': 'page.main'}, {'name': 'load', 'target': 'page.main.list'},
+                         {'name': 'load', 'target': 'page.mainly'}]
+        self.assertEqual(coalesce_load_notifications(notifications), [
+            {'name': 'other', 'target': 'page.x'}, {'name': 'load', 'target': 'page.main'},
+            {'name': 'load', 'target': 'page.mainly'}])
+
+    def test_non_consecutive_duplicates_dropped(self):
+        """Repeated loads of the same controller are dropped even if not next to each other."""
+        notifications = [{'name': 'load', 'target': 'page.one'}, {'name': 'load', 'target': 'page.two'},
+                         {'name': 'load', 'target': 'page.one'}]
+        self.assertEqual(coalesce_load_notifications(notifications), [
+            {'name': 'load', 'target': 'page.one'}, {'name': 'load', 'target': 'page.two'}])
+
+    def test_scroll_top_kept(self):
+        """If any absorbed load was load:scroll_top, the surviving load is too."""
+        notifications = [{'name': 'load', 'target': 'page.one'}, {'name': 'load:scroll_top', 'target': 'page.one.two'}]
+        self.assertEqual(coalesce_load_notifications(notifications), [{'name': 'load:scroll_top', 'target': 'page.one'}])
+
+    def test_loads_with_data_untouched(self):
+        """Loads that already carry data, and other notifications, are passed through as they are."""
+        notifications = [{'name': 'load', 'target': 'page'}, {'name': 'load', 'target': 'page.one', 'data': 'html'},
+                         {'name': 'other', 'target': 'page.one'}, {'name': 'other', 'target': 'page.one'}]
+        self.assertEqual(coalesce_load_notifications(notifications), notifications)
+
+
 @patch('helio.viewstate.viewstate.init_controller', return_value=MagicMock())
 class ProcessNotificationTests(MockedControllerTest):
     def test_process_notification(self, mock_init):
@@ -85,7 +317,7 @@ class ProcessNotificationTests(MockedControllerTest):
     def test_controller_data_added_on_load(self, mock_init):
         """On a load notification the NotificationCentre gets the target controller that is to be loaded and bundles its
         data into the request, unless it has data already."""
-        notifications = [{'name': 'load:scroll_top', 'target': 'test'}, {'name': 'load', 'target': 'test'},
+        notifications = [{'name': 'load:scroll_top', 'target': 'test'}, {'name': 'load', 'target': 'test2'},
                          {'name': 'load:scroll_top', 'target': 'test', 'data': 'existing'},
                          {'name': 'load', 'target': 'test', 'data': ''}]
 
@@ -105,6 +337,50 @@ class ProcessNotificationTests(MockedControllerTest):
         self.assertEqual(queued_notifications[2]['data'], 'existing')
         self.assertEqual(queued_notifications[3]['data'], '')
 
+    def test_descendant_loads_rendered_once(self, mock_init):
+        """Loads absorbed by an ancestor load are not rendered or returned."""
+        notifications = [{'name': 'load', 'target': 'page.main.list.item3'}, {'name': 'load', 'target': 'page.main'}]
+        notification_centre = MagicMock()
+        self.mock_vs.notification_centre = notification_centre
+        notification_centre.__iter__ = MagicMock(return_value=iter(notifications))
+        self.mock_controller.render = MagicMock(return_value='html')
+        self.mock_controller.class_map_tree = MagicMock(return_value='class_map')
+        queued_notifications = dispatch_notification('controller.path', 'vs_id', 'notification-name', {},
+                                                     self.session, 'request')
+
+        self.assertEqual(len(queued_notifications), 1)
+        self.assertEqual(queued_notifications[0]['target'], 'page.main')
+        self.assertEqual(self.mock_controller.render.call_count, 1)
+
+    @patch('helio.views.views.HTML_PATCHES', True)
+    def test_html_patches(self, mock_init):
+        """With the HTML_PATCHES setting, loads are sent as a patch against the HTML last sent for the controller,
+        unless there wasn't any."""
+        notification_centre = MagicMock()
+        self.mock_vs.notification_centre = notification_centre
+        notification_centre.__iter__ = MagicMock(side_effect=lambda: iter([{'name': 'load', 'target': 'page.main'}]))
+        self.mock_controller.render = MagicMock(return_value=u'<ul><li>one</li><li>three</li></ul>')
+        self.mock_controller.class_map_tree = MagicMock(return_value='class_map')
+        self.mock_controller.path = 'page.main'
+        base_digest = remember_baseline(u'<ul><li>one</li><li>two</li></ul>')
+        self.mock_vs.swap_sent_html_digest = MagicMock(return_value=base_digest)
+
+        data = dispatch_notification('page.main', 'vs_id', 'name', {}, self.session, 'request')[0]['data']
+        self.mock_vs.swap_sent_html_digest.assert_called_with('page.main',
+                                                              html_digest(u'<ul><li>one</li><li>three</li></ul>'))
+        self.assertNotIn('html', data)
+        self.assertEqual(data['patch']['operations'], [[5, 6, u'three']])
+
+        self.mock_vs.swap_sent_html_digest.return_value = None
+        data = dispatch_notification('page.main', 'vs_id', 'name', {}, self.session, 'request')[0]['data']
+        self.assertNotIn('patch', data)
+        self.assertEqual(data['html'], u'<ul><li>one</li><li>three</li></ul>')
+
+        # the baseline was sent by another process, or has been evicted
+        self.mock_vs.swap_sent_html_digest.return_value = html_digest(u'<ul><li>unknown</li></ul>')
+        data = dispatch_notification('page.main', 'vs_id', 'name', {}, self.session, 'request')[0]['data']
+        self.assertNotIn('patch', data)
+
     def test_kwargs_pass(self, mock_init):
         """dispatch_notification should pass kwargs to the target's handle_notification."""
         notifications = [{'name': 'load:scroll_top', 'target': 'test'}]
@@ -121,3 +397,77 @@ class ProcessNotificationTests(MockedControllerTest):
 
         mock_controller.handle_notification.assert_called_with('notification-name', {}, 'request', environment='env')
         mock_controller.render.assert_called_with(request='request', environment='env')
+
+
+@patch('helio.viewstate.viewstate.init_controller', return_value=MagicMock())
+class DispatchNotificationsTests(MockedControllerTest):
+    def test_notifications_dispatched_in_order(self, mock_init):
+        """Each notification in the batch is sent to its target in order, with the ViewState loaded once."""
+        self.mock_vs.notification_centre = []
+        handled = []
+        self.mock_controller.handle_notification = MagicMock(side_effect=lambda name, data, request: handled.append(
+            (name, data)))
+        dispatch_notifications([('page.one', 'first', {'a': '1'}), ('page.two', 'second', {})], 'vs_id', self.session,
+                               'request')
+
+        self.mock_vsm.get_view_state.assert_called_once_with('vs_id', no_create=True)
+        self.assertEqual([call[0][0] for call in self.mock_vs.controller_from_path.call_args_list],
+                         ['page.one', 'page.two'])
+        self.assertEqual(handled, [('first', {'a': '1'}), ('second', {})])
+
+    def test_stale_paths_skipped(self, mock_init):
+        """Notifications whose target has gone, e.g. removed by an earlier notification in the batch, are skipped."""
+        self.mock_vs.notification_centre = []
+        self.mock_vs.controller_from_path.side_effect = [KeyError('gone'), None, self.mock_controller]
+        dispatch_notifications([('page.gone', 'one', {}), ('page.none', 'two', {}), ('page.here', 'three', {})],
+                               'vs_id', self.session, 'request')
+        self.mock_controller.handle_notification.assert_called_once_with('three', {}, 'request')
+
+    def test_loads_merged(self, mock_init):
+        """Loads queued by different notifications in the batch are coalesced and each controller rendered once."""
+        self.mock_vs.notification_centre = [{'name': 'load', 'target': 'page.main.list'},
+                                            {'name': 'load', 'target': 'page.main'},
+                                            {'name': 'other', 'target': 'page.side'}]
+        self.mock_controller.render = MagicMock(return_value='html')
+        self.mock_controller.class_map_tree = MagicMock(return_value='class_map')
+        client_notifications = dispatch_notifications([('page.main.list', 'one', {}), ('page.main', 'two', {})],
+                                                      'vs_id', self.session, 'request')
+
+        self.assertEqual([notification['target'] for notification in client_notifications], ['page.main', 'page.side'])
+        self.assertEqual(self.mock_controller.render.call_count, 1)
+
+    def test_missing_view_state(self, mock_init):
+        """ViewStateError is raised if the ViewState no longer exists, as for a single notification."""
+        self.mock_vsm.get_view_state.side_effect = ViewStateError
+        with self.assertRaises(ViewStateError):
+            dispatch_notifications([('page', 'name', {})], 3, self.session)
+
+
+class AppendingController(BaseViewController):
+    def __init__(self):
+        super(AppendingController, self).__init__()
+        self.items = []
+
+    def handle_notification(self, notification_name, data, request=None, **kwargs):
+        self.items.append(data)
+
+
+@patch('helio.viewstate.viewstate.init_controller', side_effect=lambda component_name: AppendingController())
+class InPlaceChangeTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.addCleanup(clear_viewstate_prototypes)
+        backend_patcher = patch('helio.views.views.get_viewstate_backend',
+                                return_value=SQLiteViewStateBackend(join(self.temp_dir, 'viewstates.sqlite3')))
+        backend_patcher.start()
+        self.addCleanup(backend_patcher.stop)
+
+    def test_in_place_changes_saved(self, mock_init):
+        """A notification handler that changes its state in place, rather than assigning to an attribute, has its
+        changes saved by a backend that stores the ViewStates outside the session."""
+        session = {}
+        vs_id = get_view_state(-1, session).index
+        dispatch_notification('page', vs_id, 'add', 'one', session)
+        dispatch_notifications([('page', 'add', 'two')], vs_id, session)
+        self.assertEqual(fork_view_state(vs_id, session).root_controller.items, ['one', 'two'])
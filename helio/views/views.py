@@ -1,40 +1,404 @@
-from helio.viewstate.viewstate import ViewStateManager
-from helio.settings import VIEWSTATE_MANAGER_SESSION_KEY
+import json
+from contextlib import contextmanager
+from helio.viewstate.backends import get_viewstate_backend
+from helio.helio_exceptions import ViewStateError
+from helio.settings import CLASS_MAP_DELTAS, HTML_PATCHES
+from helio.views.patches import make_html_patch, remember_baseline, get_baseline
 
+# the content type of streamed client notifications, which are sent one JSON object per line
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
 
-def _get_controller_and_view_state_from_session(path, vs_id, session):
-    vsm = session[VIEWSTATE_MANAGER_SESSION_KEY]
-    vs = vsm.get_view_state(vs_id, no_create=True)
-    return vs.controller_from_path(path), vs
+
+def accepts_ndjson(accept_header):
+    """Whether a request's Accept header asks for the client notifications to be streamed. Clients only ask for it if
+    they can read the stream, so notifications are only streamed to those that do (and only with STREAM_RESPONSES)."""
+    return NDJSON_CONTENT_TYPE in (accept_header or '')
+
+
+def _get_view_state_manager(session, create=False):
+    backend = get_viewstate_backend()
+    vsm = backend.load(session)
+
+    if vsm is None:
+        if not create:
+            raise ViewStateError("There is no ViewStateManager for this session.")
+
+        vsm = backend.create(session)
+
+    return vsm
+
+
+def _save_view_state_manager(session, vsm):
+    get_viewstate_backend().save(session, vsm)
+
+
+def _release_view_state_manager(session):
+    get_viewstate_backend().release(session)
+
+
+@contextmanager
+def _loaded_view_state_manager(session, create=False):
+    """The session's ViewStateManager for the length of the with block, which is released once the block has finished
+    with it (even if it raised), so the backend can let the session's next request have it."""
+    vsm = _get_view_state_manager(session, create)
+
+    try:
+        yield vsm
+    finally:
+        _release_view_state_manager(session)
+
+
+def _start_view_state(vsm, vs_id, fork_vs_id=None):
+    """Get the ViewState at vs_id (or a new one) for a page that is being loaded, or a new ViewState copied from the
+    one at fork_vs_id if it is given."""
+    if fork_vs_id is None:
+        view_state = vsm.get_view_state(vs_id)
+    else:
+        try:
+            view_state = vsm.fork_view_state(fork_vs_id)
+        except ViewStateError:
+            view_state = vsm.get_view_state(-1)
+
+    if CLASS_MAP_DELTAS:
+        # the page is being loaded, so the client doesn't have any of the class map yet
+        view_state.reset_sent_class_map()
+
+    if HTML_PATCHES:
+        view_state.reset_sent_html()
+
+    return view_state
 
 
 def get_view_state(vs_id, session):
-    if not VIEWSTATE_MANAGER_SESSION_KEY in session:
-        vsm = ViewStateManager()
-        session[VIEWSTATE_MANAGER_SESSION_KEY] = vsm
+    with _loaded_view_state_manager(session, create=True) as vsm:
+        view_state = _start_view_state(vsm, vs_id)
+        _save_view_state_manager(session, vsm)
 
-    return session[VIEWSTATE_MANAGER_SESSION_KEY].get_view_state(vs_id)
+    return view_state
 
 
-def get_controller_data(path, vs_id, session, request=None, **kwargs):
-    controller, _ = _get_controller_and_view_state_from_session(path, vs_id, session)
+def fork_view_state(vs_id, session):
+    """Return a new ViewState copied from the one at vs_id, or a default ViewState if there isn't one."""
+    with _loaded_view_state_manager(session, create=True) as vsm:
+        view_state = _start_view_state(vsm, None, fork_vs_id=vs_id)
+        _save_view_state_manager(session, vsm)
+
+    return view_state
+
+
+def _render_controller_data(controller, view_state, request, allow_patch=False, **kwargs):
+    """Render a controller, returning its HTML with the class map of its subtree (or, with the CLASS_MAP_DELTAS
+    setting, the changes to it since it was last sent to the client). With the HTML_PATCHES setting and allow_patch,
+    a patch against the HTML last sent for the controller is returned instead of the HTML, if it is smaller."""
     html = controller.render(request=request, **kwargs)
     class_map = controller.class_map_tree({})
 
-    return {'html': html, 'class_map': class_map}
+    if CLASS_MAP_DELTAS:
+        controller_data = {'html': html, 'class_map_delta': view_state.class_map_delta(controller.path, class_map)}
+    else:
+        controller_data = {'html': html, 'class_map': class_map}
 
+    if HTML_PATCHES:
+        base_digest = view_state.swap_sent_html_digest(controller.path, remember_baseline(html))
+        base_html = get_baseline(base_digest) if allow_patch and base_digest is not None else None
+        patch = make_html_patch(base_html, html) if base_html is not None else None
 
-def dispatch_notification(path, vs_id, name, data, session, request=None, **kwargs):
-    controller, vs = _get_controller_and_view_state_from_session(path, vs_id, session)
+        if patch is not None:
+            del controller_data['html']
+            controller_data['patch'] = patch
+
+    return controller_data
+
+
+def bootstrap_view_state(vs_id, session, fork_vs_id=None, request=None, **kwargs):
+    """Everything the client needs to start a page, in one go: get_view_state (or fork_view_state, if fork_vs_id is
+    given) followed by get_controller_data for the root controller. Returns the root controller's data with the
+    ViewState's index added as vs_id."""
+    with _loaded_view_state_manager(session, create=True) as vsm:
+        view_state = _start_view_state(vsm, vs_id, fork_vs_id)
+        bootstrap_data = _render_controller_data(view_state.root_controller, view_state, request, **kwargs)
+        bootstrap_data['vs_id'] = view_state.index
+        _save_view_state_manager(session, vsm)
+
+    return bootstrap_data
+
+
+def bootstrap_script(bootstrap_data):
+    """Return a script tag that hands the data from bootstrap_view_state to the client as g_helioBootstrap, for
+    rendering into the page that includes helio.js so the client can start without requesting anything."""
+    # escaping < means nothing in the data can close the script tag early
+    return '<script type="text/javascript">window.g_helioBootstrap = %s;</script>' % json.dumps(
+        bootstrap_data).replace('<', '\\u003c')
+
+
+def _stream_controller_data(controller, view_state, request, extra_data, **kwargs):
+    """Like _render_controller_data (without patches), but yields the JSON of the data a piece at a time as the HTML is
+    rendered. The items of extra_data are added to it."""
+    # with HTML_PATCHES the whole of the HTML is needed as the base for the next patch
+    html_chunks = [] if HTML_PATCHES else None
+    yield '{%s"html": "' % ''.join('%s: %s, ' % (json.dumps(key), json.dumps(value))
+                                   for key, value in extra_data.iteritems())
+
+    for chunk in controller.render_stream(request=request, **kwargs):
+        if html_chunks is not None:
+            html_chunks.append(chunk)
+
+        # the JSON encoding of a string is the encodings of its pieces joined together
+        yield json.dumps(unicode(chunk))[1:-1]
+
+    class_map = controller.class_map_tree({})
+
+    if CLASS_MAP_DELTAS:
+        yield '", "class_map_delta": %s}' % json.dumps(view_state.class_map_delta(controller.path, class_map))
+    else:
+        yield '", "class_map": %s}' % json.dumps(class_map)
+
+    if html_chunks is not None:
+        view_state.swap_sent_html_digest(controller.path, remember_baseline(u''.join(html_chunks)))
+
+
+class _SaveAfterStream(object):
+    """An iterator over the chunks of a streamed response that saves the ViewStateManager once they have all been
+    produced. The ViewStateManager is released once the stream has finished or is closed (as the WSGI server closes
+    the response), or, failing that, once the stream is thrown away, even if it was never started."""
+
+    def __init__(self, chunks, session, vsm):
+        self._chunks = chunks
+        self._session = session
+        self._vsm = vsm
+        self._released = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            _save_view_state_manager(self._session, self._vsm)
+            self.close()
+            raise
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        if self._released:
+            return
+
+        self._released = True
+
+        try:
+            if hasattr(self._chunks, 'close'):
+                self._chunks.close()
+        finally:
+            _release_view_state_manager(self._session)
+
+    def __del__(self):
+        self.close()
+
+
+def _stream_after_setup(session, create, setup):
+    """Load the ViewStateManager and call setup with it, which does what has to happen before the response starts
+    and returns the chunks to stream. The ViewStateManager is saved straight away, so the session is complete before
+    the response starts, and again once the chunks have all been produced. It is released if setup raises."""
+    vsm = _get_view_state_manager(session, create)
+
+    try:
+        chunks = setup(vsm)
+        _save_view_state_manager(session, vsm)
+    except:
+        _release_view_state_manager(session)
+        raise
+
+    return _SaveAfterStream(chunks, session, vsm)
+
+
+def stream_bootstrap_view_state(vs_id, session, fork_vs_id=None, request=None, **kwargs):
+    """bootstrap_view_state, but returns an iterator over the JSON of the data that renders the HTML as it is
+    consumed. The new ViewState is saved straight away, so the session is complete before the response starts, and
+    the ViewStateManager is saved again once the rendering has finished."""
+    def setup(vsm):
+        view_state = _start_view_state(vsm, vs_id, fork_vs_id)
+        return _stream_controller_data(view_state.root_controller, view_state, request, {'vs_id': view_state.index},
+                                       **kwargs)
+
+    return _stream_after_setup(session, True, setup)
+
+
+def stream_controller_data(path, vs_id, session, request=None, **kwargs):
+    """get_controller_data, but returns an iterator over the JSON of the data that renders the HTML as it is consumed.
+    ViewStateError is raised straight away, rather than from the iterator. The ViewStateManager is saved once the
+    rendering has finished, which is after the response has started, so this should only be used with a
+    VIEWSTATE_BACKEND that doesn't keep the ViewStates in the session itself. It is also saved straight away, so the
+    session is complete before the response starts."""
+    def setup(vsm):
+        vs = vsm.get_view_state(vs_id, no_create=True)
+        return _stream_controller_data(vs.controller_from_path(path), vs, request, {}, **kwargs)
+
+    return _stream_after_setup(session, False, setup)
+
+
+def get_controller_data(path, vs_id, session, request=None, **kwargs):
+    with _loaded_view_state_manager(session) as vsm:
+        vs = vsm.get_view_state(vs_id, no_create=True)
+        controller_data = _render_controller_data(vs.controller_from_path(path), vs, request, **kwargs)
+        _save_view_state_manager(session, vsm)
+
+    return controller_data
+
+
+def get_controllers_data(paths, vs_id, session, request=None, **kwargs):
+    """Render several controllers of the same ViewState with a single session load and save, returning a dict of
+    their data keyed by path. A path that is a descendant of another one in paths is left out, as it is rendered as
+    part of its ancestor."""
+    controllers_data = {}
+
+    with _loaded_view_state_manager(session) as vsm:
+        vs = vsm.get_view_state(vs_id, no_create=True)
+
+        for path in sorted(set(_outermost_paths(paths).itervalues())):
+            controllers_data[path] = _render_controller_data(vs.controller_from_path(path), vs, request, **kwargs)
+
+        _save_view_state_manager(session, vsm)
+
+    return controllers_data
+
+
+def _is_render_load(notification):
+    return notification['name'].split(':')[0] == 'load' and notification.get('data') is None
+
+
+def _outermost_paths(paths):
+    """Map each path to the shortest path in paths that is the same as, or an ancestor of, it."""
+    path_set = set(paths)
+    outermost = {}
+
+    for path in path_set:
+        split_path = path.split('.')
+
+        for depth in xrange(1, len(split_path) + 1):
+            ancestor_path = '.'.join(split_path[:depth])
+
+            if ancestor_path in path_set:
+                outermost[path] = ancestor_path
+                break
+
+    return outermost
+
+
+def coalesce_load_notifications(notifications):
+    """Reduce the load notifications that need rendering to the smallest set of subtrees. A load of an ancestor
+    absorbs loads of its descendants, and repeated loads of the same controller are dropped wherever they are in the
+    queue. The surviving load keeps its position and is a load:scroll_top if any load it absorbed was. Other
+    notifications are left untouched."""
+    load_targets = [notification['target'] for notification in notifications if _is_render_load(notification)]
+
+    if not load_targets:
+        return list(notifications)
+
+    outermost = _outermost_paths(load_targets)
+    scroll_top_targets = set(outermost[notification['target']] for notification in notifications
+                             if _is_render_load(notification) and notification['name'] == 'load:scroll_top')
+
+    coalesced_notifications = []
+    emitted_targets = set()
+
+    for notification in notifications:
+        if not _is_render_load(notification):
+            coalesced_notifications.append(notification)
+            continue
+
+        target = notification['target']
+
+        if outermost[target] != target or target in emitted_targets:
+            continue
+
+        emitted_targets.add(target)
+        coalesced_notifications.append({'name': 'load:scroll_top' if target in scroll_top_targets else 'load',
+                                        'target': target})
+
+    return coalesced_notifications
+
+
+def _iter_client_notifications(view_state, request, **kwargs):
+    """Yield the client notifications queued on the ViewState, rendering the data for each load as it is reached."""
+    for client_notification in coalesce_load_notifications(list(view_state.notification_centre)):
+        if _is_render_load(client_notification):
+            controller = view_state.controller_from_path(client_notification['target'])
+            client_notification['data'] = _render_controller_data(controller, view_state, request, allow_patch=True,
+                                                                   **kwargs)
+
+        yield client_notification
+
+
+def _handle_notifications(view_state, notifications, request, **kwargs):
+    for path, name, data in notifications:
+        # an earlier notification in the batch may have removed the target, as for post_notification
+        try:
+            controller = view_state.controller_from_path(path)
+        except (KeyError, IndexError):
+            continue
+
+        if controller is None:
+            continue
+
+        _handle_notification(view_state, controller, name, data, request, **kwargs)
+
+
+def _handle_notification(view_state, controller, name, data, request, **kwargs):
+    controller.invalidate_fragment()
     controller.handle_notification(name, data, request, **kwargs)
-    client_notifications = []
-    for client_notification in [notification for notification in vs.notification_centre]:
-        if client_notification['name'].split(':')[0] == 'load' and client_notification.get('data') is None:
-            controller = vs.controller_from_path(client_notification['target'])
-            html = controller.render(request=request, **kwargs)
-            class_map = controller.class_map_tree({})
-            client_notification['data'] = {'html': html, 'class_map': class_map}
+    # a handler may change its state in place (e.g. append to a list), which attribute assignments don't catch, so
+    # the ViewState is always saved after a notification. Only read-only requests, like loads, skip the save
+    view_state.mark_dirty()
+
 
-        client_notifications.append(client_notification)
+def _ndjson_lines(client_notifications):
+    for client_notification in client_notifications:
+        yield json.dumps(client_notification) + '\n'
+
+
+def dispatch_notification(path, vs_id, name, data, session, request=None, **kwargs):
+    with _loaded_view_state_manager(session) as vsm:
+        vs = vsm.get_view_state(vs_id, no_create=True)
+        _handle_notification(vs, vs.controller_from_path(path), name, data, request, **kwargs)
+        client_notifications = list(_iter_client_notifications(vs, request, **kwargs))
+        _save_view_state_manager(session, vsm)
+
+    return client_notifications
+
+
+def dispatch_notifications(notifications, vs_id, session, request=None, **kwargs):
+    """Dispatch an ordered list of (path, name, data) notifications to the same ViewState, as if each had been sent
+    with dispatch_notification, but loading and saving the session once. The client notifications they queue are
+    coalesced and rendered together, so a controller loaded by several of them is only rendered once."""
+    with _loaded_view_state_manager(session) as vsm:
+        vs = vsm.get_view_state(vs_id, no_create=True)
+        _handle_notifications(vs, notifications, request, **kwargs)
+        client_notifications = list(_iter_client_notifications(vs, request, **kwargs))
+        _save_view_state_manager(session, vsm)
 
     return client_notifications
+
+
+def stream_notification(path, vs_id, name, data, session, request=None, **kwargs):
+    """dispatch_notification, but returns an iterator over the client notifications as lines of JSON (with the
+    NDJSON_CONTENT_TYPE), each one rendered as it is reached. The notification is handled straight away, and the
+    ViewStateManager saved before the response starts and again at the end, as for stream_controller_data."""
+    def setup(vsm):
+        vs = vsm.get_view_state(vs_id, no_create=True)
+        _handle_notification(vs, vs.controller_from_path(path), name, data, request, **kwargs)
+        return _ndjson_lines(_iter_client_notifications(vs, request, **kwargs))
+
+    return _stream_after_setup(session, False, setup)
+
+
+def stream_notifications(notifications, vs_id, session, request=None, **kwargs):
+    """dispatch_notifications, with the client notifications streamed as for stream_notification."""
+    def setup(vsm):
+        vs = vsm.get_view_state(vs_id, no_create=True)
+        _handle_notifications(vs, notifications, request, **kwargs)
+        return _ndjson_lines(_iter_client_notifications(vs, request, **kwargs))
+
+    return _stream_after_setup(session, False, setup)
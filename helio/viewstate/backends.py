@@ -0,0 +1,438 @@
+import cPickle as pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from uuid import uuid4
+from helio.settings import VIEWSTATE_BACKEND, VIEWSTATE_BACKEND_OPTIONS, VIEWSTATE_MANAGER_SESSION_KEY, \
+    VIEWSTATE_MAX_PER_SESSION, STREAM_RESPONSES
+from helio.viewstate.viewstate import ViewStateManager, get_default_viewstate
+from helio.helio_exceptions import ViewStateError, HelioConfigurationError
+from helio.viewstate.serialization import dumps_view_state, loads_view_state
+
+
+class BaseViewStateBackend(object):
+    """A ViewState backend decides where a session's ViewStateManager lives between requests."""
+
+    # whether save writes the ViewStates themselves into the session, which can't be done once a streamed response
+    # has started
+    stores_in_session = False
+
+    def load(self, session):
+        """Return the ViewStateManager for the session, or None if it doesn't have one."""
+        raise NotImplementedError
+
+    def save(self, session, view_state_manager):
+        """Store the ViewStateManager for the session, after a request has finished with it."""
+        raise NotImplementedError
+
+    def release(self, session):
+        """Called once a request has finished with the ViewStateManager it loaded, whether or not it was saved (or the
+        request failed), so a backend that only lets one request use a session's ViewStateManager at a time can let
+        the next one have it."""
+        pass
+
+    def create(self, session):
+        """Return a new, empty, ViewStateManager for a session that doesn't have one yet."""
+        return ViewStateManager()
+
+
+class SessionViewStateBackend(BaseViewStateBackend):
+    """Stores the whole ViewStateManager in the session, so it is serialized along with the rest of the session."""
+
+    stores_in_session = True
+
+    def load(self, session):
+        return session.get(VIEWSTATE_MANAGER_SESSION_KEY)
+
+    def save(self, session, view_state_manager):
+        # assigning marks the session as modified, so only do it when there is something new to store
+        if view_state_manager.dirty or session.get(VIEWSTATE_MANAGER_SESSION_KEY) is not view_state_manager:
+            session[VIEWSTATE_MANAGER_SESSION_KEY] = view_state_manager
+
+
+class LocalMemoryViewStateBackend(BaseViewStateBackend):
+    """Keeps live ViewStateManagers in a process-local LRU, so they don't need to be serialized between requests. The
+    session only holds an opaque key to the entry. This relies on sticky sessions.
+
+    Entries are evicted once there are more than max_entries, or once they have not been used for idle_ttl seconds.
+    If pickle_fallback is True a pickled copy of the ViewStateManager is also kept in the session, and is used when the
+    entry has been evicted (or the request has landed on a different process). This costs a pickle on every save that
+    changes the manager, so it is off by default.
+
+    Every request for a session is given the same live ViewStateManager, so a request holds the session's lock from the
+    load until it is released (after the save), and concurrent requests for the session (e.g. two tabs, or a deferred
+    child loading alongside a notification) wait for each other rather than change the same controllers at once. This
+    also means concurrent requests for a session whose entry was evicted don't each unpickle their own copy. A request
+    must release the ViewStateManager before it loads it again."""
+
+    fallback_session_key = VIEWSTATE_MANAGER_SESSION_KEY + '_pickled'
+
+    def __init__(self, max_entries=1000, idle_ttl=3600, pickle_fallback=False):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.pickle_fallback = pickle_fallback
+        self._entries = OrderedDict()
+        self._key_locks = {}
+        # the number of requests holding or waiting for each key's lock, which is kept until there are none
+        self._key_users = {}
+        self._held_keys = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stores_in_session(self):
+        return self.pickle_fallback
+
+    def _evict(self, now):
+        """Remove expired entries, then the least recently used entries until the size cap is met. Entries are kept
+        in order of use, so expired ones are always at the front."""
+        while self._entries:
+            key, (_, last_used) = next(self._entries.iteritems())
+
+            if now - last_used <= self.idle_ttl:
+                break
+
+            del self._entries[key]
+            self._drop_key_lock(key)
+
+        while len(self._entries) > self.max_entries:
+            key, _ = self._entries.popitem(last=False)
+            self._drop_key_lock(key)
+
+    def _drop_key_lock(self, key):
+        if key not in self._key_users:
+            self._key_locks.pop(key, None)
+
+    def _use_key_lock(self, key):
+        """Return the lock for a key, creating it if needed, and count the caller as one of its users until
+        _unuse_key_lock. Must be called while holding self._lock."""
+        lock = self._key_locks.get(key)
+
+        if lock is None:
+            lock = self._key_locks[key] = threading.Lock()
+
+        self._key_users[key] = self._key_users.get(key, 0) + 1
+        return lock
+
+    def _unuse_key_lock(self, key):
+        """Must be called while holding self._lock."""
+        self._key_users[key] -= 1
+
+        if not self._key_users[key]:
+            del self._key_users[key]
+
+            if key not in self._entries:
+                del self._key_locks[key]
+
+    def _store(self, key, view_state_manager, now):
+        self._entries.pop(key, None)
+        self._entries[key] = (view_state_manager, now)
+        self._evict(now)
+
+    def load(self, session):
+        key = session.get(VIEWSTATE_MANAGER_SESSION_KEY)
+
+        if key is None:
+            return None
+
+        if isinstance(key, ViewStateManager):  # stored by SessionViewStateBackend
+            return key
+
+        has_fallback = self.pickle_fallback and session.get(self.fallback_session_key) is not None
+
+        with self._lock:
+            if key not in self._entries and not has_fallback:
+                return None
+
+            key_lock = self._use_key_lock(key)
+
+        # held until release, so only this request uses the live ViewStateManager in the meantime
+        key_lock.acquire()
+
+        try:
+            view_state_manager = self._load_entry(session, key, has_fallback)
+        except:
+            self._let_go(key, key_lock)
+            raise
+
+        if view_state_manager is None:
+            self._let_go(key, key_lock)
+            return None
+
+        with self._lock:
+            self._held_keys.add(key)
+
+        return view_state_manager
+
+    def _let_go(self, key, key_lock):
+        with self._lock:
+            self._unuse_key_lock(key)
+
+        key_lock.release()
+
+    def _load_entry(self, session, key, has_fallback):
+        now = time.time()
+
+        with self._lock:  # the entry may have been evicted, or restored by another request, while we waited
+            entry = self._entries.get(key)
+
+            if entry is not None and now - entry[1] <= self.idle_ttl:
+                self._store(key, entry[0], now)
+                return entry[0]
+
+        if not has_fallback:
+            return None
+
+        view_state_manager = pickle.loads(session[self.fallback_session_key])
+
+        with self._lock:
+            self._store(key, view_state_manager, now)
+
+        return view_state_manager
+
+    def save(self, session, view_state_manager):
+        key = session.get(VIEWSTATE_MANAGER_SESSION_KEY)
+        is_new = key is None or isinstance(key, ViewStateManager)
+
+        if is_new:
+            key = uuid4().hex
+            session[VIEWSTATE_MANAGER_SESSION_KEY] = key
+
+        # the request holds the key's lock from its load, or has the only reference to a new key
+        with self._lock:
+            self._store(key, view_state_manager, time.time())
+
+        if self.pickle_fallback and (is_new or view_state_manager.dirty):
+            session[self.fallback_session_key] = pickle.dumps(view_state_manager, pickle.HIGHEST_PROTOCOL)
+
+        view_state_manager.mark_clean()
+
+    def release(self, session):
+        key = session.get(VIEWSTATE_MANAGER_SESSION_KEY)
+
+        with self._lock:
+            # a request that didn't load the key (e.g. it created the ViewStateManager) doesn't hold its lock
+            if key not in self._held_keys:
+                return
+
+            self._held_keys.remove(key)
+            key_lock = self._key_locks[key]
+
+        self._let_go(key, key_lock)
+
+
+class SQLiteViewStateManager(ViewStateManager):
+    """A ViewStateManager whose ViewStates are stored individually in a SQLiteViewStateBackend, so only the tabs that
+    are requested are loaded."""
+
+    def __init__(self, backend, session_key):
+        super(SQLiteViewStateManager, self).__init__()
+        self._backend = backend
+        self.session_key = session_key
+        self._loaded_view_states = {}
+
+    def get_view_state(self, index, no_create=False):
+        index = None if index < 0 else index
+
+        if index in self._loaded_view_states:
+            return self._loaded_view_states[index]
+
+        view_state = None if index is None else self._backend.read_view_state(self.session_key, index)
+
+        if view_state is None:
+            if no_create:
+                raise ViewStateError("ViewState does not exist at index %s" % index)
+            view_state = get_default_viewstate()
+            self._add_view_state(view_state)
+        else:
+            self._loaded_view_states[view_state.index] = view_state
+
+        return view_state
+
+    def _add_view_state(self, view_state):
+        self.session_key = self._backend.insert_view_state(self.session_key, view_state)
+        self._loaded_view_states[view_state.index] = view_state
+
+    def loaded_view_states(self):
+        return self._loaded_view_states.values()
+
+    @property
+    def dirty(self):
+        return any(view_state.dirty for view_state in self._loaded_view_states.itervalues())
+
+    def mark_clean(self):
+        for view_state in self._loaded_view_states.itervalues():
+            view_state.mark_clean()
+
+
+class SQLiteViewStateBackend(BaseViewStateBackend):
+    """Stores each ViewState as its own row in a SQLite database (in WAL mode), keyed by session and vs_id. The database
+    can be shared by all the worker processes on a machine, and a request only loads the tab it needs. The session
+    only holds an opaque key.
+
+    Rows that haven't been used for idle_ttl seconds are ignored, and are deleted by purge(), which runs at most once
+    every purge_interval seconds when a ViewState is inserted. Reading a row refreshes its timestamp (at most once every
+    touch_interval seconds), and once a session has more than max_view_states rows the least recently used are
+    deleted.
+
+    Each session has a counter of the vs_ids it has given out, so a vs_id is never given to another ViewState once its
+    row has been deleted, and a stale tab gets a ViewStateError rather than another tab's ViewState."""
+
+    def __init__(self, path, idle_ttl=86400, timeout=10.0, max_view_states=VIEWSTATE_MAX_PER_SESSION,
+                 purge_interval=300, touch_interval=60):
+        self.path = path
+        self.idle_ttl = idle_ttl
+        self.timeout = timeout
+        self.max_view_states = max_view_states
+        self.purge_interval = purge_interval
+        self.touch_interval = touch_interval
+        self._last_purge = 0
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        """The connection for the current thread, as SQLite connections can't be shared between threads."""
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS helio_viewstates (session_key TEXT NOT NULL, '
+                               'vs_id INTEGER NOT NULL, data BLOB NOT NULL, updated REAL NOT NULL, '
+                               'PRIMARY KEY (session_key, vs_id))')
+            connection.execute('CREATE TABLE IF NOT EXISTS helio_viewstate_sessions (session_key TEXT PRIMARY KEY, '
+                               'next_vs_id INTEGER NOT NULL, updated REAL NOT NULL)')
+            self._local.connection = connection
+
+        return connection
+
+    def read_view_state(self, session_key, index):
+        now = time.time()
+        row = self.connection.execute('SELECT data, updated FROM helio_viewstates WHERE session_key = ? AND '
+                                      'vs_id = ? AND updated >= ?', (session_key, index, now - self.idle_ttl)).fetchone()
+
+        if row is None:
+            return None
+
+        if now - row[1] > self.touch_interval:
+            self.connection.execute('UPDATE helio_viewstates SET updated = ? WHERE session_key = ? AND vs_id = ?',
+                                    (now, session_key, index))
+
+        view_state = loads_view_state(str(row[0]))
+        view_state.index = index
+        return view_state
+
+    def insert_view_state(self, session_key, view_state):
+        """Store a new ViewState for the session, with the session's next vs_id as its index. The session's least
+        recently used ViewStates are deleted if it now has more than max_view_states.
+
+        Returns the session key the ViewState was stored under. A session that doesn't have a counter yet (it is new,
+        or its counter has been purged) is given a new key, so the vs_ids its old tabs had can't be given out again."""
+        connection = self.connection
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+
+        try:
+            row = connection.execute('SELECT next_vs_id FROM helio_viewstate_sessions WHERE session_key = ?',
+                                     (session_key,)).fetchone()
+
+            if row is None:
+                session_key = uuid4().hex
+                index = 0
+                connection.execute('INSERT INTO helio_viewstate_sessions (session_key, next_vs_id, updated) VALUES '
+                                   '(?, 1, ?)', (session_key, now))
+            else:
+                index = row[0]
+                connection.execute('UPDATE helio_viewstate_sessions SET next_vs_id = ?, updated = ? WHERE '
+                                   'session_key = ?', (index + 1, now, session_key))
+
+            view_state.index = index
+            connection.execute('INSERT INTO helio_viewstates (session_key, vs_id, data, updated) VALUES (?, ?, ?, ?)',
+                               (session_key, index, self._dump(view_state), now))
+
+            if self.max_view_states is not None:
+                connection.execute('DELETE FROM helio_viewstates WHERE session_key = ? AND vs_id IN (SELECT vs_id '
+                                   'FROM helio_viewstates WHERE session_key = ? AND vs_id != ? ORDER BY updated DESC, '
+                                   'vs_id DESC LIMIT -1 OFFSET ?)',
+                                   (session_key, session_key, index, max(self.max_view_states - 1, 0)))
+        except:
+            connection.execute('ROLLBACK')
+            raise
+
+        connection.execute('COMMIT')
+        view_state.mark_clean()
+
+        if now - self._last_purge >= self.purge_interval:
+            self._last_purge = now
+            self.purge()
+
+        return session_key
+
+    def write_view_state(self, session_key, view_state):
+        self.connection.execute('INSERT OR REPLACE INTO helio_viewstates (session_key, vs_id, data, updated) VALUES '
+                                '(?, ?, ?, ?)', (session_key, view_state.index, self._dump(view_state), time.time()))
+
+    def purge(self):
+        """Delete the ViewStates that have been idle for longer than idle_ttl, and the counters of the sessions that
+        have none left and haven't inserted one for as long."""
+        idle_since = time.time() - self.idle_ttl
+        self.connection.execute('DELETE FROM helio_viewstates WHERE updated < ?', (idle_since,))
+        self.connection.execute('DELETE FROM helio_viewstate_sessions WHERE updated < ? AND session_key NOT IN '
+                                '(SELECT session_key FROM helio_viewstates)', (idle_since,))
+
+    def _dump(self, view_state):
+        return sqlite3.Binary(dumps_view_state(view_state))
+
+    def load(self, session):
+        session_key = session.get(VIEWSTATE_MANAGER_SESSION_KEY)
+
+        if not isinstance(session_key, basestring):
+            return None
+
+        return SQLiteViewStateManager(self, session_key)
+
+    def create(self, session):
+        return SQLiteViewStateManager(self, uuid4().hex)
+
+    def save(self, session, view_state_manager):
+        if session.get(VIEWSTATE_MANAGER_SESSION_KEY) != view_state_manager.session_key:
+            session[VIEWSTATE_MANAGER_SESSION_KEY] = view_state_manager.session_key
+
+        for view_state in view_state_manager.loaded_view_states():
+            if view_state.dirty:
+                self.write_view_state(view_state_manager.session_key, view_state)
+
+        view_state_manager.mark_clean()
+
+
+_backend = None
+
+
+def get_viewstate_backend():
+    """Return the backend named by the VIEWSTATE_BACKEND setting. It is imported and instantiated (with
+    VIEWSTATE_BACKEND_OPTIONS) on first use, then shared for the life of the process."""
+    global _backend
+
+    if _backend is None:
+        split_backend_path = VIEWSTATE_BACKEND.split('.')
+        backend_class_name = split_backend_path[-1]
+        backend_module = __import__('.'.join(split_backend_path[:-1]), globals(), locals(), backend_class_name)
+        _backend = getattr(backend_module, backend_class_name)(**VIEWSTATE_BACKEND_OPTIONS)
+
+    return _backend
+
+
+def check_viewstate_backend():
+    """Raise HelioConfigurationError if the VIEWSTATE_BACKEND can't be used with the other settings. Streamed responses
+    save the ViewStateManager once the response has been sent, when the session can no longer be changed, so
+    STREAM_RESPONSES needs a backend that keeps the ViewStates outside the session. The framework integrations call
+    this as they are set up."""
+    if STREAM_RESPONSES and get_viewstate_backend().stores_in_session:
+        raise HelioConfigurationError("STREAM_RESPONSES can't be used with %s, as it stores the ViewStates in the "
+                                      "session. Use a backend that keeps them outside the session, e.g. "
+                                      "LocalMemoryViewStateBackend (without pickle_fallback) or SQLiteViewStateBackend."
+                                      % VIEWSTATE_BACKEND)
@@ -0,0 +1,383 @@
+import cPickle as pickle
+import threading
+import time
+import unittest
+import shutil
+import tempfile
+from os.path import join
+from mock import patch, MagicMock
+from helio.viewstate import backends
+from backends import SessionViewStateBackend, LocalMemoryViewStateBackend, SQLiteViewStateBackend, \
+    get_viewstate_backend, check_viewstate_backend
+from viewstate import ViewStateManager, clear_viewstate_prototypes
+from helio.controller.base import BaseViewController
+from helio.helio_exceptions import ViewStateError, HelioConfigurationError
+from helio.settings import VIEWSTATE_MANAGER_SESSION_KEY
+
+
+class SessionBackendTests(unittest.TestCase):
+    def test_load_and_save(self):
+        """The session backend stores the ViewStateManager directly in the session."""
+        backend = SessionViewStateBackend()
+        session = {}
+        self.assertIsNone(backend.load(session))
+        vsm = ViewStateManager()
+        backend.save(session, vsm)
+        self.assertEqual(session[VIEWSTATE_MANAGER_SESSION_KEY], vsm)
+        self.assertEqual(backend.load(session), vsm)
+
+    def test_clean_manager_not_assigned(self):
+        """An unchanged ViewStateManager is not assigned to the session again, so the session isn't modified."""
+        backend = SessionViewStateBackend()
+        vsm = ViewStateManager()
+        session = MagicMock()
+        session.get = MagicMock(return_value=vsm)
+        backend.save(session, vsm)
+        session.__setitem__.assert_not_called()
+
+
+class LocalMemoryBackendTests(unittest.TestCase):
+    def test_session_holds_key(self):
+        """The session holds an opaque key, and the same live ViewStateManager is returned on the next load."""
+        backend = LocalMemoryViewStateBackend(pickle_fallback=False)
+        session = {}
+        vsm = ViewStateManager()
+        backend.save(session, vsm)
+        self.assertIsInstance(session[VIEWSTATE_MANAGER_SESSION_KEY], basestring)
+        self.assertIs(backend.load(session), vsm)
+
+    def test_unknown_session(self):
+        """A session without a key, or whose key is not in the store, has no ViewStateManager."""
+        backend = LocalMemoryViewStateBackend(pickle_fallback=False)
+        self.assertIsNone(backend.load({}))
+        self.assertIsNone(backend.load({VIEWSTATE_MANAGER_SESSION_KEY: 'not-a-key'}))
+
+    def test_size_cap_evicts_least_recently_used(self):
+        """Once max_entries is exceeded, the least recently used entry is evicted."""
+        backend = LocalMemoryViewStateBackend(max_entries=2, pickle_fallback=False)
+        sessions = [{}, {}, {}]
+        vsms = [ViewStateManager(), ViewStateManager(), ViewStateManager()]
+        backend.save(sessions[0], vsms[0])
+        backend.save(sessions[1], vsms[1])
+        backend.load(sessions[0])
+        backend.release(sessions[0])
+        backend.save(sessions[2], vsms[2])
+
+        self.assertEqual(len(backend), 2)
+        self.assertIs(backend.load(sessions[0]), vsms[0])
+        self.assertIsNone(backend.load(sessions[1]))
+        self.assertIs(backend.load(sessions[2]), vsms[2])
+
+    @patch('helio.viewstate.backends.time.time')
+    def test_idle_ttl(self, mock_time):
+        """Entries that haven't been used for idle_ttl seconds are not returned."""
+        backend = LocalMemoryViewStateBackend(idle_ttl=10, pickle_fallback=False)
+        session = {}
+        mock_time.return_value = 100
+        backend.save(session, ViewStateManager())
+        mock_time.return_value = 109
+        self.assertIsNotNone(backend.load(session))
+        backend.release(session)
+        mock_time.return_value = 120
+        self.assertIsNone(backend.load(session))
+
+    def test_pickle_fallback(self):
+        """When an entry has been evicted, the pickled copy in the session is used instead."""
+        backend = LocalMemoryViewStateBackend(max_entries=1, pickle_fallback=True)
+        session = {}
+        vsm = ViewStateManager()
+        backend.save(session, vsm)
+        self.assertIn(LocalMemoryViewStateBackend.fallback_session_key, session)
+        backend.save({}, ViewStateManager())
+
+        restored_vsm = backend.load(session)
+        self.assertIsInstance(restored_vsm, ViewStateManager)
+        self.assertIsNot(restored_vsm, vsm)
+        backend.release(session)
+        self.assertIs(backend.load(session), restored_vsm)
+
+    def test_clean_manager_not_pickled(self):
+        """The pickled fallback is only written again if the manager changed."""
+        backend = LocalMemoryViewStateBackend(pickle_fallback=True)
+        session = {}
+        vsm = ViewStateManager()
+        backend.save(session, vsm)
+        self.assertFalse(vsm.dirty)
+
+        with patch('helio.viewstate.backends.pickle.dumps') as mock_dumps:
+            backend.save(session, vsm)
+            mock_dumps.assert_not_called()
+
+    def test_no_pickle_fallback_by_default(self):
+        """By default nothing but the key is stored in the session."""
+        backend = LocalMemoryViewStateBackend()
+        session = {}
+        backend.save(session, ViewStateManager())
+        self.assertEqual(session.keys(), [VIEWSTATE_MANAGER_SESSION_KEY])
+
+    def test_concurrent_fallback_loads_share_manager(self):
+        """Concurrent loads of an evicted entry unpickle it once, and all get the same ViewStateManager."""
+        backend = LocalMemoryViewStateBackend(max_entries=1, pickle_fallback=True)
+        session = {}
+        backend.save(session, ViewStateManager())
+        backend.save({}, ViewStateManager())
+        real_loads = pickle.loads
+
+        def slow_loads(data):
+            time.sleep(0.05)
+            return real_loads(data)
+
+        loaded = []
+
+        def load_and_release():
+            loaded.append(backend.load(session))
+            backend.release(session)
+
+        with patch('helio.viewstate.backends.pickle.loads', side_effect=slow_loads) as mock_loads:
+            threads = [threading.Thread(target=load_and_release) for _ in range(3)]
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(mock_loads.call_count, 1)
+        self.assertIs(loaded[0], loaded[1])
+        self.assertIs(loaded[1], loaded[2])
+
+    def test_requests_for_session_serialized(self):
+        """A request holds the session's ViewStateManager from its load until it is released, so another request for
+        the session waits for it."""
+        backend = LocalMemoryViewStateBackend()
+        session = {}
+        backend.save(session, ViewStateManager())
+        backend.release(session)
+        backend.load(session)
+        loaded = threading.Event()
+
+        def load_and_release():
+            backend.load(session)
+            loaded.set()
+            backend.release(session)
+
+        thread = threading.Thread(target=load_and_release)
+        thread.start()
+        self.assertFalse(loaded.wait(0.05))
+        backend.release(session)
+        thread.join()
+        self.assertTrue(loaded.is_set())
+
+    def test_release_without_load(self):
+        """Releasing a ViewStateManager the request didn't load (e.g. a new one) does nothing, and locks are only
+        kept while they are in use."""
+        backend = LocalMemoryViewStateBackend(max_entries=1)
+        session = {}
+        backend.save(session, ViewStateManager())
+        backend.release(session)
+        backend.load(session)
+        backend.save({}, ViewStateManager())
+        backend.release(session)
+        self.assertEqual(backend._key_locks, {})
+        self.assertIsNone(backend.load(session))
+
+    def test_session_stored_manager_migrated(self):
+        """A ViewStateManager stored directly in the session is used, and replaced by a key when saved."""
+        backend = LocalMemoryViewStateBackend(pickle_fallback=False)
+        vsm = ViewStateManager()
+        session = {VIEWSTATE_MANAGER_SESSION_KEY: vsm}
+        self.assertIs(backend.load(session), vsm)
+        backend.save(session, vsm)
+        self.assertIsInstance(session[VIEWSTATE_MANAGER_SESSION_KEY], basestring)
+
+
+@patch('helio.viewstate.viewstate.init_controller', side_effect=lambda component_name: BaseViewController())
+class SQLiteBackendTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.backend = SQLiteViewStateBackend(join(self.temp_dir, 'viewstates.sqlite3'))
+        self.addCleanup(clear_viewstate_prototypes)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_new_session(self, mock_init):
+        """A session without a key gets a new manager, and the key is written to the session when it is saved."""
+        session = {}
+        self.assertIsNone(self.backend.load(session))
+        vsm = self.backend.create(session)
+        vs = vsm.get_view_state(-1)
+        self.assertEqual(vs.index, 0)
+        self.backend.save(session, vsm)
+        self.assertEqual(session[VIEWSTATE_MANAGER_SESSION_KEY], vsm.session_key)
+
+    def test_view_states_shared(self, mock_init):
+        """A ViewState saved through one backend instance (e.g. in another worker) can be loaded by another."""
+        session = {}
+        vsm = self.backend.create(session)
+        vsm.get_view_state(-1)
+        vs = vsm.get_view_state(-1)
+        vs.root_controller.local_value = 'saved'
+        self.backend.save(session, vsm)
+
+        other_backend = SQLiteViewStateBackend(self.backend.path)
+        other_vsm = other_backend.load(session)
+        other_vs = other_vsm.get_view_state(1, no_create=True)
+        self.assertEqual(other_vs.index, 1)
+        self.assertEqual(other_vs.root_controller.local_value, 'saved')
+        self.assertEqual(other_vsm.loaded_view_states(), [other_vs])
+
+    def test_missing_view_state(self, mock_init):
+        """Requesting a tab that isn't stored raises ViewStateError with no_create, otherwise creates a new one."""
+        session = {}
+        vsm = self.backend.create(session)
+
+        with self.assertRaises(ViewStateError):
+            vsm.get_view_state(3, no_create=True)
+
+        self.assertEqual(vsm.get_view_state(3).index, 0)
+
+    def test_fork_view_state(self, mock_init):
+        """A forked ViewState is stored as a new row."""
+        session = {}
+        vsm = self.backend.create(session)
+        vsm.get_view_state(-1).root_controller.local_value = 'saved'
+        forked_vs = vsm.fork_view_state(0)
+        self.assertEqual(forked_vs.index, 1)
+        self.assertEqual(self.backend.read_view_state(vsm.session_key, 1).root_controller.local_value, 'saved')
+
+    @patch('helio.viewstate.backends.time.time')
+    def test_idle_view_states_ignored_and_purged(self, mock_time, mock_init):
+        """ViewStates that haven't been saved for idle_ttl seconds are not loaded, and are removed by purge."""
+        self.backend.idle_ttl = 10
+        session = {}
+        mock_time.return_value = 100
+        vsm = self.backend.create(session)
+        vsm.get_view_state(-1)
+        self.backend.save(session, vsm)
+
+        mock_time.return_value = 120
+        with self.assertRaises(ViewStateError):
+            self.backend.load(session).get_view_state(0, no_create=True)
+
+        self.backend.purge()
+        count = self.backend.connection.execute('SELECT COUNT(*) FROM helio_viewstates').fetchone()[0]
+        self.assertEqual(count, 0)
+
+    def _updated(self, session_key, index):
+        return self.backend.connection.execute('SELECT updated FROM helio_viewstates WHERE session_key = ? AND '
+                                               'vs_id = ?', (session_key, index)).fetchone()[0]
+
+    @patch('helio.viewstate.backends.time.time')
+    def test_read_touches_view_state(self, mock_time, mock_init):
+        """Reading a ViewState refreshes its timestamp, but only once touch_interval has passed."""
+        session = {}
+        mock_time.return_value = 100
+        vsm = self.backend.create(session)
+        vsm.get_view_state(-1)
+
+        mock_time.return_value = 130
+        self.backend.read_view_state(vsm.session_key, 0)
+        self.assertEqual(self._updated(vsm.session_key, 0), 100)
+
+        mock_time.return_value = 200
+        self.backend.read_view_state(vsm.session_key, 0)
+        self.assertEqual(self._updated(vsm.session_key, 0), 200)
+
+    @patch('helio.viewstate.backends.time.time')
+    def test_max_view_states_per_session(self, mock_time, mock_init):
+        """Inserting more than max_view_states ViewStates for a session deletes the least recently used."""
+        self.backend.max_view_states = 2
+        session = {}
+        vsm = self.backend.create(session)
+
+        for now in (100, 101, 102):
+            mock_time.return_value = now
+            vsm.get_view_state(-1)
+
+        indexes = [row[0] for row in self.backend.connection.execute('SELECT vs_id FROM helio_viewstates ORDER BY '
+                                                                     'vs_id')]
+        self.assertEqual(indexes, [1, 2])
+
+    @patch('helio.viewstate.backends.time.time')
+    def test_purge_on_insert_throttled(self, mock_time, mock_init):
+        """Inserting a ViewState purges idle rows, at most once every purge_interval seconds."""
+        self.backend.idle_ttl = 10
+
+        with patch.object(self.backend, 'purge') as mock_purge:
+            for now in (1000, 1100, 1300):
+                mock_time.return_value = now
+                self.backend.create({}).get_view_state(-1)
+
+        self.assertEqual(mock_purge.call_count, 2)
+
+    def test_vs_ids_not_reused(self, mock_init):
+        """A vs_id isn't given out again once its row has been deleted, so a stale tab gets ViewStateError."""
+        self.backend.max_view_states = 1
+        session = {}
+        vsm = self.backend.create(session)
+        vsm.get_view_state(-1)
+        vsm.get_view_state(-1)
+        self.backend.save(session, vsm)
+        self.assertIsNone(self.backend.read_view_state(vsm.session_key, 0))
+        self.backend.connection.execute('DELETE FROM helio_viewstates WHERE vs_id = 1')
+
+        vsm = self.backend.load(session)
+        self.assertEqual(vsm.get_view_state(-1).index, 2)
+
+        with self.assertRaises(ViewStateError):
+            self.backend.load(session).get_view_state(1, no_create=True)
+
+    @patch('helio.viewstate.backends.time.time')
+    def test_purged_session_given_new_key(self, mock_time, mock_init):
+        """Once a session's ViewStates and counter have been purged, its next ViewState is stored under a new key."""
+        self.backend.idle_ttl = 10
+        session = {}
+        mock_time.return_value = 100
+        vsm = self.backend.create(session)
+        vsm.get_view_state(-1)
+        self.backend.save(session, vsm)
+        old_key = session[VIEWSTATE_MANAGER_SESSION_KEY]
+
+        mock_time.return_value = 120
+        self.backend.purge()
+        vsm = self.backend.load(session)
+        self.assertEqual(vsm.get_view_state(-1).index, 0)
+        self.backend.save(session, vsm)
+        self.assertNotEqual(session[VIEWSTATE_MANAGER_SESSION_KEY], old_key)
+
+
+class GetBackendTests(unittest.TestCase):
+    def setUp(self):
+        backends._backend = None
+        self.addCleanup(setattr, backends, '_backend', None)
+
+    @patch('helio.viewstate.backends.VIEWSTATE_BACKEND', 'helio.viewstate.backends.LocalMemoryViewStateBackend')
+    @patch('helio.viewstate.backends.VIEWSTATE_BACKEND_OPTIONS', {'max_entries': 5})
+    def test_backend_resolved_once(self):
+        """The backend is instantiated from the settings once, then reused."""
+        backend = get_viewstate_backend()
+        self.assertIsInstance(backend, LocalMemoryViewStateBackend)
+        self.assertEqual(backend.max_entries, 5)
+        self.assertIs(get_viewstate_backend(), backend)
+
+    def test_default_backend(self):
+        """By default the ViewStateManager is kept in the session."""
+        self.assertIsInstance(get_viewstate_backend(), SessionViewStateBackend)
+
+    @patch('helio.viewstate.backends.STREAM_RESPONSES', True)
+    def test_streaming_needs_backend_outside_session(self):
+        """STREAM_RESPONSES can't be used with a backend that stores the ViewStates in the session."""
+        with patch('helio.viewstate.backends.get_viewstate_backend', return_value=SessionViewStateBackend()):
+            self.assertRaises(HelioConfigurationError, check_viewstate_backend)
+
+        with patch('helio.viewstate.backends.get_viewstate_backend',
+                   return_value=LocalMemoryViewStateBackend(pickle_fallback=True)):
+            self.assertRaises(HelioConfigurationError, check_viewstate_backend)
+
+        with patch('helio.viewstate.backends.get_viewstate_backend', return_value=LocalMemoryViewStateBackend()):
+            check_viewstate_backend()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+from collections import deque
 from viewstate import ViewState
 
 
@@ -11,8 +12,33 @@ class NotificationCentre(object):
         self._view_state = view_state
         view_state.notification_centre = self
 
-        self._notification_queue = []
+        self._notification_queue = deque()
         self._notification_listeners = {}
+        self._controller_subscriptions = {}
+        self._dispatch_tables = {}
+
+    def __getstate__(self):
+        # dispatch tables are rebuilt as notifications are posted, so there's no need to serialize them
+        state = self.__dict__.copy()
+        state['_dispatch_tables'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        if '_controller_subscriptions' not in state:  # pickled before subscriptions were indexed by controller
+            self._controller_subscriptions = {}
+
+            for notification_name, sources in self._notification_listeners.iteritems():
+                for source_controller_path, controller_paths in sources.iteritems():
+                    for controller_path in controller_paths:
+                        self._controller_subscriptions.setdefault(controller_path, set()).add(
+                            (notification_name, source_controller_path))
+
+        if not isinstance(self._notification_queue, deque):  # pickled when the queue was a list
+            self._notification_queue = deque(self._notification_queue)
+
+        self._dispatch_tables = {}
 
     @property
     def view_state(self):
@@ -27,24 +53,60 @@ class NotificationCentre(object):
 
         self._notification_listeners[notification_name][source_controller_path].add(controller_path)
 
+        if not controller_path in self._controller_subscriptions:
+            self._controller_subscriptions[controller_path] = set()
+
+        self._controller_subscriptions[controller_path].add((notification_name, source_controller_path))
+        self._dispatch_tables.pop(notification_name, None)
+        self.view_state.mark_dirty()
+
+    def _dispatch_table(self, notification_name, source_controller_path):
+        """Return the paths of the controllers that should receive a notification from the given source. These are
+        compiled once (including global listeners) and cached until a subscription to the notification changes."""
+        tables = self._dispatch_tables.setdefault(notification_name, {})
+
+        if not source_controller_path in tables:
+            sources = self._notification_listeners[notification_name]
+            listeners = set(sources.get(source_controller_path, ()))
+
+            # always send to global listeners even if a path provided
+            if source_controller_path != '__global__':
+                listeners.update(sources.get('__global__', ()))
+
+            tables[source_controller_path] = tuple(listeners)
+
+        return tables[source_controller_path]
+
     def post_notification(self, notification_name, source_controller_path='__global__', data=None):
         if not notification_name in self._notification_listeners:
             return
 
-        listeners = self._notification_listeners[notification_name].get(source_controller_path, set())
-
-        # always send to global listeners even if a path provided
-        if source_controller_path != '__global__' and '__global__' in self._notification_listeners[notification_name]:
-            listeners.update(self._notification_listeners[notification_name]['__global__'])
-
-        for controller_path in list(listeners):
-            controller = self.view_state.controller_from_path(controller_path)
+        for controller_path in self._dispatch_table(notification_name, source_controller_path):
+            try:
+                controller = self.view_state.controller_from_path(controller_path)
+            except (KeyError, IndexError):
+                continue
 
             if controller is None:
                 continue
 
+            controller.invalidate_fragment()
             controller.handle_notification(notification_name, data)
 
+    def _remove_listener(self, notification_name, controller_path, source_controller_path):
+        sources = self._notification_listeners[notification_name]
+        listeners = sources[source_controller_path]
+        listeners.discard(controller_path)
+
+        if len(listeners) == 0:
+            del sources[source_controller_path]
+
+        if len(sources) == 0:
+            del self._notification_listeners[notification_name]
+
+        self._dispatch_tables.pop(notification_name, None)
+        self.view_state.mark_dirty()
+
     def unsubscribe_from_notification(self, notification_name, controller_path, source_controller_path='__global__'):
         if not notification_name in self._notification_listeners:
             return
@@ -52,29 +114,23 @@ class NotificationCentre(object):
         if not source_controller_path in self._notification_listeners[notification_name]:
             return
 
-        self._notification_listeners[notification_name][source_controller_path].discard(controller_path)
+        self._remove_listener(notification_name, controller_path, source_controller_path)
 
-    def unsubscribe_from_all_notifications(self, controller_path):
-        """Unsubscribe a controller from all listeners, useful when a controller is going to be taken off the VS tree."""
-        notifications_to_remove = []
-
-        for notification_name, sources in self._notification_listeners.iteritems():
-            sources_to_remove = []
-
-            for source_path, listeners in sources.iteritems():
-                listeners.discard(controller_path)
+        subscriptions = self._controller_subscriptions.get(controller_path)
 
-                if len(listeners) == 0:
-                    sources_to_remove.append(source_path)
+        if subscriptions is not None:
+            subscriptions.discard((notification_name, source_controller_path))
 
-            for source_path in sources_to_remove:
-                del sources[source_path]
+            if len(subscriptions) == 0:
+                del self._controller_subscriptions[controller_path]
 
-            if len(sources) == 0:
-                notifications_to_remove.append(notification_name)
-
-        for notification_name in notifications_to_remove:
-            del self._notification_listeners[notification_name]
+    def unsubscribe_from_all_notifications(self, controller_path):
+        """Unsubscribe a controller from all listeners, useful when a controller is going to be taken off the VS tree.
+        Only the notifications the controller subscribed to are visited."""
+        for notification_name, source_controller_path in self._controller_subscriptions.pop(controller_path, ()):
+            if notification_name in self._notification_listeners and \
+                    source_controller_path in self._notification_listeners[notification_name]:
+                self._remove_listener(notification_name, controller_path, source_controller_path)
 
     def queue_client_notification(self, notification_name, controller_path, data=None, force=False):
         """Queue a notification to be delivered to a specific controller in the client. By default, the same notification
@@ -87,13 +143,15 @@ class NotificationCentre(object):
             return
 
         self._notification_queue.append(notification)
+        self.view_state.mark_dirty()
 
     def queue_load(self, controller_path, scroll_top=False):
         self.queue_client_notification('load' + (':scroll_top' if scroll_top else ''), controller_path)
 
     def _client_notification_iterator(self):
         while len(self._notification_queue):
-            yield self._notification_queue.pop(0)
+            self.view_state.mark_dirty()
+            yield self._notification_queue.popleft()
 
     def __iter__(self):
         return self._client_notification_iterator()
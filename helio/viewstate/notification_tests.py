@@ -1,3 +1,4 @@
+from collections import deque
 import unittest
 from mock import MagicMock
 from notification import NotificationCentre
@@ -53,6 +54,16 @@ class NotifcationCentreTests(unittest.TestCase):
         n.post_notification('test_notification2', 'page.another_controller')
         controller.handle_notification.assert_called_with('test_notification2', None)
 
+    def test_notification_invalidates_fragment(self):
+        """A controller's cached HTML is dropped before it handles a notification."""
+        v = ViewState(MagicMock())
+        n = NotificationCentre(v)
+        controller = MagicMock()
+        v.controller_from_path = MagicMock(return_value=controller)
+        n.subscribe_to_notification('test_notification', 'page.test_controller')
+        n.post_notification('test_notification')
+        controller.invalidate_fragment.assert_called_with()
+
     def test_specific_notification_subscription_and_receive(self):
         """A controller can listen to events from only single sources, so shouldn't receive that notification if posted
         from elsewhere."""
@@ -113,6 +124,92 @@ class NotifcationCentreTests(unittest.TestCase):
         n.post_notification('test_notification2')
         self.assertEqual(controller.handle_notification.call_count, 0)
 
+    def test_global_listeners_not_merged_into_source_listeners(self):
+        """Posting from a source must not add the global listeners to that source's stored listeners."""
+        v = ViewState(MagicMock())
+        n = NotificationCentre(v)
+        v.controller_from_path = MagicMock(return_value=MagicMock())
+
+        n.subscribe_to_notification('test_notification', 'page.global_listener')
+        n.subscribe_to_notification('test_notification', 'page.source_listener', 'page.source')
+        n.post_notification('test_notification', 'page.source')
+        self.assertEqual(n._notification_listeners['test_notification']['page.source'], set(['page.source_listener']))
+
+        n.unsubscribe_from_notification('test_notification', 'page.global_listener')
+        v.controller_from_path.reset_mock()
+        n.post_notification('test_notification', 'page.source')
+        v.controller_from_path.assert_called_once_with('page.source_listener')
+
+    def test_dispatch_table_updated_on_subscribe(self):
+        """A controller subscribing after a notification has been posted still receives it the next time."""
+        v = ViewState(MagicMock())
+        n = NotificationCentre(v)
+        controller = MagicMock()
+        v.controller_from_path = MagicMock(return_value=controller)
+
+        n.subscribe_to_notification('test_notification', 'page.one', 'page.source')
+        n.post_notification('test_notification', 'page.source')
+        n.subscribe_to_notification('test_notification', 'page.two')
+        v.controller_from_path.reset_mock()
+        n.post_notification('test_notification', 'page.source')
+        called_paths = sorted(call[0][0] for call in v.controller_from_path.call_args_list)
+        self.assertEqual(called_paths, ['page.one', 'page.two'])
+
+    def test_detached_controller_no_exception(self):
+        """If the listener's path is no longer in the tree, the notification is skipped for that listener."""
+        v = ViewState(MagicMock())
+        n = NotificationCentre(v)
+        v.controller_from_path = MagicMock(side_effect=KeyError('page.test_controller'))
+        n.subscribe_to_notification('test_notification', 'page.test_controller')
+        n.post_notification('test_notification')
+
+    def test_unsubscribe_all_clears_reverse_index(self):
+        """unsubscribe_from_all_notifications removes only that controller, and cleans up empty listener entries."""
+        v = ViewState(MagicMock())
+        n = NotificationCentre(v)
+
+        n.subscribe_to_notification('test_notification', 'page.one')
+        n.subscribe_to_notification('test_notification', 'page.two')
+        n.subscribe_to_notification('test_notification2', 'page.one', 'page.source')
+        n.unsubscribe_from_all_notifications('page.one')
+
+        self.assertEqual(n._notification_listeners, {'test_notification': {'__global__': set(['page.two'])}})
+        self.assertNotIn('page.one', n._controller_subscriptions)
+        self.assertIn('page.two', n._controller_subscriptions)
+
+    def test_subscription_changes_mark_view_state_dirty(self):
+        """Subscribing and unsubscribing change the ViewState, so mark it dirty."""
+        v = ViewState(MagicMock())
+        n = NotificationCentre(v)
+
+        v.mark_clean()
+        n.subscribe_to_notification('test_notification', 'page.test_controller')
+        self.assertTrue(v.dirty)
+
+        v.mark_clean()
+        n.post_notification('test_notification')
+        self.assertFalse(v.dirty)
+
+        n.unsubscribe_from_all_notifications('page.test_controller')
+        self.assertTrue(v.dirty)
+
+    def test_client_notification_queue_changes_mark_view_state_dirty(self):
+        """Queueing a client notification, and taking them from the queue, change the ViewState, so mark it dirty."""
+        v = ViewState(MagicMock())
+        n = NotificationCentre(v)
+
+        v.mark_clean()
+        n.queue_client_notification('test_name', 'page.test_controller')
+        self.assertTrue(v.dirty)
+
+        v.mark_clean()
+        list(n)
+        self.assertTrue(v.dirty)
+
+        v.mark_clean()
+        list(n)
+        self.assertFalse(v.dirty)
+
     def test_client_notification_queue_and_retrieve(self):
         """Client notifications are queued and retrieved in FIFO order."""
         v = ViewState(MagicMock())
@@ -199,3 +296,33 @@ class NotifcationCentreTests(unittest.TestCase):
         nc.queue_client_notification = MagicMock()
         nc.queue_load('test.controller', scroll_top=True)
         nc.queue_client_notification.assert_called_with('load:scroll_top', 'test.controller')
+
+    def test_legacy_state_restored(self):
+        """A NotificationCentre pickled before subscriptions were indexed gets its index and dispatch tables back."""
+        v = ViewState(MagicMock())
+        nc = NotificationCentre(v)
+        nc.subscribe_to_notification('note', 'page.one')
+        nc.subscribe_to_notification('note', 'page.two', 'page.source')
+        state = nc.__getstate__()
+        del state['_controller_subscriptions']
+        del state['_dispatch_tables']
+
+        restored = NotificationCentre.__new__(NotificationCentre)
+        restored.__setstate__(state)
+        self.assertEqual(restored._controller_subscriptions, {'page.one': set([('note', '__global__')]),
+                                                              'page.two': set([('note', 'page.source')])})
+        self.assertEqual(restored._dispatch_tables, {})
+        restored.unsubscribe_from_all_notifications('page.one')
+        self.assertEqual(restored._notification_listeners, {'note': {'page.source': set(['page.two'])}})
+
+    def test_legacy_list_queue_restored_as_deque(self):
+        """A notification queue pickled as a list is restored as a deque in the same order."""
+        v = ViewState(MagicMock())
+        nc = NotificationCentre(v)
+        state = nc.__getstate__()
+        state['_notification_queue'] = [('a', 1), ('b', 2)]
+
+        restored = NotificationCentre.__new__(NotificationCentre)
+        restored.__setstate__(state)
+        self.assertTrue(isinstance(restored._notification_queue, deque))
+        self.assertEqual(restored._notification_queue.popleft(), ('a', 1))
@@ -0,0 +1,54 @@
+import cPickle as pickle
+import zlib
+from helio.settings import VIEWSTATE_COMPRESSION_LEVEL
+from helio.helio_exceptions import ViewStateError
+
+# Serialized ViewStates start with this marker, then the format version and whether the pickle is compressed. Data
+# without the marker is a plain pickle from before the format existed.
+SERIALIZATION_MARKER = 'HVS'
+SERIALIZATION_VERSION = 1
+COMPRESSED_FLAG = 'z'
+UNCOMPRESSED_FLAG = 'p'
+
+# Functions to upgrade the unpickled object from one version to the next, keyed by the version they upgrade from.
+MIGRATIONS = {}
+
+
+def dumps_view_state(view_state, compression_level=None):
+    """Serialize a ViewState. The pickle is compressed with zlib unless compression_level (defaulting to the
+    VIEWSTATE_COMPRESSION_LEVEL setting) is 0."""
+    if compression_level is None:
+        compression_level = VIEWSTATE_COMPRESSION_LEVEL
+
+    data = pickle.dumps(view_state, pickle.HIGHEST_PROTOCOL)
+
+    if compression_level:
+        return '%s%d%s%s' % (SERIALIZATION_MARKER, SERIALIZATION_VERSION, COMPRESSED_FLAG,
+                             zlib.compress(data, compression_level))
+
+    return '%s%d%s%s' % (SERIALIZATION_MARKER, SERIALIZATION_VERSION, UNCOMPRESSED_FLAG, data)
+
+
+def loads_view_state(data):
+    """Deserialize a ViewState written by dumps_view_state (of this or an earlier version), or a plain pickle."""
+    if not data.startswith(SERIALIZATION_MARKER):
+        return pickle.loads(data)
+
+    header_length = len(SERIALIZATION_MARKER) + 2
+    version, flag = data[len(SERIALIZATION_MARKER)], data[header_length - 1]
+
+    if not version.isdigit() or int(version) > SERIALIZATION_VERSION or flag not in (COMPRESSED_FLAG,
+                                                                                     UNCOMPRESSED_FLAG):
+        raise ViewStateError("Unknown ViewState serialization format '%s'." % data[:header_length])
+
+    data = data[header_length:]
+
+    if flag == COMPRESSED_FLAG:
+        data = zlib.decompress(data)
+
+    view_state = pickle.loads(data)
+
+    for from_version in xrange(int(version), SERIALIZATION_VERSION):
+        view_state = MIGRATIONS[from_version](view_state)
+
+    return view_state
@@ -0,0 +1,57 @@
+import unittest
+import cPickle as pickle
+from mock import patch
+from serialization import dumps_view_state, loads_view_state, SERIALIZATION_MARKER, SERIALIZATION_VERSION
+from viewstate import ViewState
+from helio.controller.base import BaseViewController
+from helio.helio_exceptions import ViewStateError
+
+
+class SerializationTests(unittest.TestCase):
+    def setUp(self):
+        self.view_state = ViewState(BaseViewController())
+        self.view_state.root_controller.set_child('child', BaseViewController())
+
+    def test_round_trip(self):
+        """A serialized ViewState is restored with its controller tree."""
+        view_state = loads_view_state(dumps_view_state(self.view_state))
+        self.assertIsInstance(view_state, ViewState)
+        self.assertEqual(view_state.controller_from_path('page.child').path, 'page.child')
+
+    def test_header(self):
+        """The data starts with the marker, the version and whether it is compressed."""
+        self.assertTrue(dumps_view_state(self.view_state, 6).startswith('%s%dz' % (SERIALIZATION_MARKER,
+                                                                                    SERIALIZATION_VERSION)))
+        self.assertTrue(dumps_view_state(self.view_state, 0).startswith('%s%dp' % (SERIALIZATION_MARKER,
+                                                                                    SERIALIZATION_VERSION)))
+
+    @patch('helio.viewstate.serialization.VIEWSTATE_COMPRESSION_LEVEL', 0)
+    def test_compression_disabled_by_setting(self):
+        """Setting VIEWSTATE_COMPRESSION_LEVEL to 0 stores a plain pickle after the header."""
+        data = dumps_view_state(self.view_state)
+        self.assertIsInstance(pickle.loads(data[len(SERIALIZATION_MARKER) + 2:]), ViewState)
+        self.assertIsInstance(loads_view_state(data), ViewState)
+
+    def test_legacy_pickle(self):
+        """Data without the header is loaded as a plain pickle."""
+        view_state = loads_view_state(pickle.dumps(self.view_state, pickle.HIGHEST_PROTOCOL))
+        self.assertIsInstance(view_state, ViewState)
+
+    def test_unknown_format(self):
+        """Data from a newer version, or with an unknown flag, raises ViewStateError."""
+        with self.assertRaises(ViewStateError):
+            loads_view_state('%s%dp' % (SERIALIZATION_MARKER, SERIALIZATION_VERSION + 1))
+
+        with self.assertRaises(ViewStateError):
+            loads_view_state('%s%dx' % (SERIALIZATION_MARKER, SERIALIZATION_VERSION))
+
+    @patch('helio.viewstate.serialization.SERIALIZATION_VERSION', 2)
+    @patch.dict('helio.viewstate.serialization.MIGRATIONS', {1: lambda view_state: 'migrated'})
+    def test_migrations_applied(self):
+        """Data from an older version is passed through the migrations up to the current version."""
+        data = '%s1p%s' % (SERIALIZATION_MARKER, pickle.dumps(self.view_state, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(loads_view_state(data), 'migrated')
+
+
+if __name__ == '__main__':
+    unittest.main()
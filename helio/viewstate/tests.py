@@ -1,6 +1,9 @@
 import unittest
 from mock import MagicMock, patch
-from viewstate import ViewState, ViewStateManager, split_and_validate_path, get_default_viewstate
+import cPickle as pickle
+import time
+from viewstate import ViewState, ViewStateManager, ViewStateHandle, split_and_validate_path, get_default_viewstate, \
+    clear_viewstate_prototypes
 from helio.controller.base import BaseViewController
 from helio.helio_exceptions import ViewStateError
 
@@ -44,6 +47,57 @@ class TestViewStateClass(unittest.TestCase):
         self.child_one.set_child('two', self.child_two)
         self.child_two.set_child('three', self.child_three)
 
+    def test_class_map_delta(self):
+        """The class map delta holds the paths that are new or changed since the last one for the subtree, and the
+        paths that have gone from it."""
+        first_map = {'page.one': {}, 'page.one.two': {'script': 'two'}, 'page.one.two.three': {}}
+        self.assertEqual(self.vs.class_map_delta('page.one', first_map), {'changed': first_map, 'removed': []})
+        self.vs.mark_clean()
+        self.assertEqual(self.vs.class_map_delta('page.one', first_map), {'changed': {}, 'removed': []})
+        self.assertFalse(self.vs.dirty)
+
+        delta = self.vs.class_map_delta('page.one.two', {'page.one.two': {'script': 'new'}})
+        self.assertEqual(delta, {'changed': {'page.one.two': {'script': 'new'}}, 'removed': ['page.one.two.three']})
+        self.assertEqual(self.vs.sent_class_map, {'page.one': {}, 'page.one.two': {'script': 'new'}})
+        self.assertTrue(self.vs.dirty)
+
+        self.vs.reset_sent_class_map()
+        self.assertEqual(self.vs.class_map_delta('page.one', {'page.one': {}})['changed'], {'page.one': {}})
+
+    def test_class_map_delta_replaced_controller(self):
+        """A path is reported as changed once another controller has taken it over, even if its assets are the
+        same."""
+        self.vs.class_map_delta('page.one', {'page.one': {}, 'page.one.two': {}, 'page.one.two.three': {}})
+        self.child_one.set_child('two', BaseViewController())
+        self.assertEqual(self.vs.class_map_delta('page.one', {'page.one': {}, 'page.one.two': {}}),
+                         {'changed': {'page.one.two': {}}, 'removed': ['page.one.two.three']})
+
+        self.child_one.push_child('two', BaseViewController())
+        self.vs.class_map_delta('page.one', {'page.one': {}, 'page.one.two': {}})
+        self.child_one.pop_child('two')
+        self.assertEqual(self.vs.class_map_delta('page.one', {'page.one': {}, 'page.one.two': {}})['changed'],
+                         {'page.one.two': {}})
+
+    def test_swap_sent_html_digest(self):
+        """The digest of the HTML sent for a path replaces what was sent before, and what was sent for its ancestors
+        and descendants is dropped."""
+        self.assertIsNone(self.vs.swap_sent_html_digest('page.one.two', 'two'))
+        self.vs.swap_sent_html_digest('page.other', 'other')
+        self.assertEqual(self.vs.swap_sent_html_digest('page.one.two', 'new two'), 'two')
+        self.vs.swap_sent_html_digest('page.one', 'one')
+        self.assertEqual(self.vs.sent_html_digests, {'page.one': 'one', 'page.other': 'other'})
+        self.vs.reset_sent_html()
+        self.assertIsNone(self.vs.swap_sent_html_digest('page.one', 'one'))
+
+    def test_unchanged_sent_html_digest_clean(self):
+        """Sending the same HTML for a path again doesn't mark the ViewState dirty."""
+        self.vs.swap_sent_html_digest('page.one', 'one')
+        self.vs.mark_clean()
+        self.vs.swap_sent_html_digest('page.one', 'one')
+        self.assertFalse(self.vs.dirty)
+        self.vs.swap_sent_html_digest('page.one', 'new one')
+        self.assertTrue(self.vs.dirty)
+
     def test_view_state_init(self):
         """A ViewState can only be inited with a root controller arg."""
         with self.assertRaises(TypeError):
@@ -62,6 +116,45 @@ class TestViewStateClass(unittest.TestCase):
         self.assertEqual(self.vs.controller_from_path('page.one.two'), self.child_two)
         self.assertEqual(self.vs.controller_from_path('page.one.two.three'), self.child_three)
 
+    def test_controller_path_retrieval_from_index(self):
+        """Once the index is built, controllers are retrieved from it rather than by walking the tree."""
+        self.vs.controller_from_path('page')
+        self.child_one.get_child = MagicMock()
+        self.assertEqual(self.vs.controller_from_path('page.one.two.three'), self.child_three)
+        self.child_one.get_child.assert_not_called()
+
+    def test_controller_index_tree_changes(self):
+        """The path index is kept up to date as controllers are set, pushed and popped."""
+        self.vs.controller_from_path('page')
+        new_two = BaseViewController()
+        new_three = BaseViewController()
+        new_two.set_child('three', new_three)
+
+        self.child_one.push_child('two', new_two)
+        self.assertEqual(self.vs.controller_index['page.one.two'], new_two)
+        self.assertEqual(self.vs.controller_index['page.one.two.three'], new_three)
+
+        self.child_one.pop_child('two')
+        self.assertEqual(self.vs.controller_index['page.one.two'], self.child_two)
+        self.assertEqual(self.vs.controller_index['page.one.two.three'], self.child_three)
+
+        self.root_controller.set_child('one', BaseViewController())
+        self.assertNotIn('page.one.two', self.vs.controller_index)
+        self.assertNotIn('page.one.two.three', self.vs.controller_index)
+
+    def test_missing_controller_path_retrieval(self):
+        """Retrieving a controller that does not exist still raises an error."""
+        with self.assertRaises(KeyError):
+            self.vs.controller_from_path('page.one.four')
+
+        with self.assertRaises(ValueError):
+            self.vs.controller_from_path('page..one')
+
+    def test_controller_index_not_serialized(self):
+        """The path index is left out of the ViewState's serialized state."""
+        self.vs.controller_from_path('page.one')
+        self.assertNotIn('_controller_index', self.vs.__getstate__())
+
     def test_root_controller_insert_error(self):
         """Inserting a controller at path 'page' is invalid and raises a ValueError."""
         new_controller = BaseViewController
@@ -183,6 +276,213 @@ class TestViewStateManagerClass(unittest.TestCase):
         vs = self.vsm.get_view_state(-2)
         self.assertEqual(vs.index, 2)
 
+    def test_least_recently_used_evicted(self, mock_init):
+        """Once there are more than max_view_states, the least recently used ViewState is evicted, and its index is
+        not reused."""
+        self.vsm.max_view_states = 2
+        self.vsm.get_view_state(None)
+        self.vsm.get_view_state(None)
+
+        with patch('helio.viewstate.viewstate.time.time', return_value=time.time() + 1):
+            self.vsm.get_view_state(0)
+
+        with patch('helio.viewstate.viewstate.time.time', return_value=time.time() + 2):
+            vs = self.vsm.get_view_state(None)
+
+        self.assertEqual(vs.index, 2)
+        self.assertEqual(len(self.vsm), 2)
+        self.vsm.get_view_state(0, no_create=True)
+
+        with self.assertRaises(ViewStateError):
+            self.vsm.get_view_state(1, no_create=True)
+
+    @patch('helio.viewstate.viewstate.time.time', return_value=1000)
+    def test_idle_view_states_evicted(self, mock_time, mock_init):
+        """ViewStates that have not been used for idle_ttl seconds are evicted."""
+        self.vsm.idle_ttl = 10
+        self.vsm.get_view_state(None)
+        self.vsm.get_view_state(None)
+        mock_time.return_value = 1005
+        self.vsm.get_view_state(1)
+        mock_time.return_value = 1012
+
+        with self.assertRaises(ViewStateError):
+            self.vsm.get_view_state(0, no_create=True)
+
+        self.vsm.get_view_state(1, no_create=True)
+        self.assertEqual(len(self.vsm), 1)
+
+    @patch('helio.viewstate.viewstate.time.time', return_value=1000)
+    def test_last_used_marks_dirty_in_steps(self, mock_time, mock_init):
+        """Using a ViewState only marks the manager dirty once its last use time has moved by more than
+        last_used_step."""
+        self.vsm.get_view_state(None)
+        self.vsm.mark_clean()
+        mock_time.return_value = 1030
+        self.vsm.get_view_state(0)
+        self.assertFalse(self.vsm.dirty)
+        mock_time.return_value = 1100
+        self.vsm.get_view_state(0)
+        self.assertTrue(self.vsm.dirty)
+
+    def test_evicted_view_state_recreated(self, mock_init):
+        """Asking for an evicted ViewState without no_create makes a new one with a new index."""
+        self.vsm.max_view_states = 1
+        self.vsm.get_view_state(None)
+        self.vsm.get_view_state(None)
+        self.assertEqual(self.vsm.get_view_state(0).index, 2)
+
+
+class TestViewStateManagerSerialization(unittest.TestCase):
+    def setUp(self):
+        init_patcher = patch('helio.viewstate.viewstate.init_controller',
+                             side_effect=lambda component_name: BaseViewController())
+        init_patcher.start()
+        self.addCleanup(init_patcher.stop)
+        self.addCleanup(clear_viewstate_prototypes)
+
+        self.vsm = ViewStateManager()
+        self.vsm.get_view_state(None)
+        self.vsm.get_view_state(None)
+
+    def test_view_states_deserialized_on_request(self):
+        """After unpickling a VSM, only the ViewState that is requested is deserialized."""
+        self.vsm.get_view_state(1).root_controller.value = 'tab one'
+        vsm = pickle.loads(pickle.dumps(self.vsm))
+        self.assertFalse(vsm._state_store[0].is_loaded)
+        self.assertFalse(vsm._state_store[1].is_loaded)
+
+        vs = vsm.get_view_state(1, no_create=True)
+        self.assertEqual(vs.index, 1)
+        self.assertEqual(vs.root_controller.value, 'tab one')
+        self.assertFalse(vsm._state_store[0].is_loaded)
+        self.assertTrue(vsm._state_store[1].is_loaded)
+
+    def test_unloaded_view_states_not_reserialized(self):
+        """A ViewState that was not requested is written back as the data it was loaded with."""
+        vsm = pickle.loads(pickle.dumps(self.vsm))
+        data = vsm._state_store[0]._data
+
+        with patch('helio.viewstate.viewstate.dumps_view_state') as mock_dumps:
+            state = vsm._state_store[0].__getstate__()
+            mock_dumps.assert_not_called()
+
+        self.assertIs(state['_data'], data)
+
+    def test_loaded_view_states_clean(self):
+        """New ViewStates are dirty, but those loaded from the session are clean until they change."""
+        self.assertTrue(self.vsm.dirty)
+        vsm = pickle.loads(pickle.dumps(self.vsm))
+        self.assertFalse(vsm.dirty)
+        vs = vsm.get_view_state(0)
+        self.assertFalse(vsm.dirty)
+        vs.root_controller.value = 'changed'
+        self.assertTrue(vsm.dirty)
+        vsm.mark_clean()
+        self.assertFalse(vsm.dirty)
+        self.assertFalse(vs.dirty)
+
+    def test_clean_view_states_not_reserialized(self):
+        """A ViewState that was loaded but didn't change is written back as the data it was loaded with."""
+        vsm = pickle.loads(pickle.dumps(self.vsm))
+        vsm.get_view_state(0)
+
+        with patch('helio.viewstate.viewstate.dumps_view_state') as mock_dumps:
+            vsm._state_store[0].__getstate__()
+            mock_dumps.assert_not_called()
+
+        vsm.get_view_state(0).root_controller.value = 'changed'
+        vsm = pickle.loads(pickle.dumps(vsm))
+        self.assertEqual(vsm.get_view_state(0).root_controller.value, 'changed')
+
+    def test_new_view_state_marks_manager_dirty(self):
+        """Adding a ViewState marks the manager dirty."""
+        vsm = pickle.loads(pickle.dumps(self.vsm))
+        vsm.get_view_state(None)
+        self.assertTrue(vsm.dirty)
+
+    def test_legacy_state_store(self):
+        """A VSM pickled with ViewStates directly in its store is loaded with each one wrapped in a handle."""
+        vs = get_default_viewstate()
+        vs.index = 0
+        vsm = ViewStateManager.__new__(ViewStateManager)
+        vsm.__setstate__({'_state_store': [vs]})
+        self.assertIsInstance(vsm._state_store[0], ViewStateHandle)
+        self.assertEqual(vsm.get_view_state(0), vs)
+        self.assertEqual(vsm.get_view_state(None).index, 1)
+
+
+class UnclonableController(BaseViewController):
+    clone_safe = False
+
+
+class CountingController(BaseViewController):
+    post_attach_count = 0
+
+    def post_attach(self):
+        CountingController.post_attach_count += 1
+
+
+class TestViewStatePrototypes(unittest.TestCase):
+    def setUp(self):
+        clear_viewstate_prototypes()
+        self.addCleanup(clear_viewstate_prototypes)
+        CountingController.post_attach_count = 0
+
+        def init_controller(component_name):
+            root = CountingController()
+            root.set_child('child', BaseViewController())
+            return root
+
+        init_patcher = patch('helio.viewstate.viewstate.init_controller', side_effect=init_controller)
+        self.mock_init = init_patcher.start()
+        self.addCleanup(init_patcher.stop)
+
+    def test_default_viewstates_cloned(self):
+        """The default tree is built once, and later default ViewStates are independent, dirty, clones of it."""
+        vs_one = get_default_viewstate()
+        vs_two = get_default_viewstate()
+        self.assertEqual(self.mock_init.call_count, 1)
+        self.assertEqual(CountingController.post_attach_count, 1)
+        self.assertIsNot(vs_one.root_controller, vs_two.root_controller)
+        self.assertTrue(vs_two.dirty)
+        self.assertEqual(vs_two.controller_from_path('page.child').view_state, vs_two)
+        self.assertIs(vs_two.notification_centre.view_state, vs_two)
+
+        vs_one.root_controller.value = 'changed'
+        self.assertFalse(hasattr(get_default_viewstate().root_controller, 'value'))
+
+    def test_unclonable_trees_built_each_time(self):
+        """If a controller in the default tree isn't clone safe, every default ViewState is built from scratch."""
+        self.mock_init.side_effect = lambda component_name: UnclonableController()
+        get_default_viewstate()
+        get_default_viewstate()
+        self.assertEqual(self.mock_init.call_count, 2)
+
+    def test_fork_view_state(self):
+        """Forking copies a ViewState, with its changes, into a new ViewState with a new index."""
+        vsm = ViewStateManager()
+        vs = vsm.get_view_state(None)
+        vs.root_controller.value = 'changed'
+        forked_vs = vsm.fork_view_state(0)
+
+        self.assertEqual(forked_vs.index, 1)
+        self.assertIs(vsm.get_view_state(1), forked_vs)
+        self.assertEqual(forked_vs.root_controller.value, 'changed')
+        self.assertIsNot(forked_vs.root_controller, vs.root_controller)
+
+    def test_fork_missing_view_state(self):
+        """Forking a ViewState that doesn't exist raises ViewStateError."""
+        self.assertRaises(ViewStateError, ViewStateManager().fork_view_state, 0)
+
+    def test_fork_unclonable_view_state(self):
+        """Forking a ViewState that isn't clone safe gives a new default ViewState."""
+        vsm = ViewStateManager()
+        vsm.get_view_state(None).root_controller.set_child('extra', UnclonableController())
+        forked_vs = vsm.fork_view_state(0)
+        self.assertEqual(forked_vs.index, 1)
+        self.assertRaises(KeyError, forked_vs.controller_from_path, 'page.extra')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,9 @@
-from helio.settings import DEFAULT_ROOT_COMPONENT
+import time
+import cPickle as pickle
+from helio.settings import DEFAULT_ROOT_COMPONENT, VIEWSTATE_MAX_PER_SESSION, VIEWSTATE_IDLE_TTL
 from helio.controller.helpers import init_controller
 from helio.helio_exceptions import ViewStateError
+from helio.viewstate.serialization import dumps_view_state, loads_view_state
 
 
 def split_and_validate_path(path):
@@ -16,23 +19,146 @@ def split_and_validate_path(path):
 
 
 class ViewState(object):
+    _controller_index = None
+    dirty = False
+    sent_class_map = None
+    sent_html_digests = None
+
     def __init__(self, root_controller):
         self.root_controller = root_controller
         root_controller.make_root(self)
+        self.dirty = True
+
+    def __getstate__(self):
+        # the index is rebuilt from the tree on first use, so there's no need to serialize it, and a ViewState that
+        # has just been loaded is clean
+        state = self.__dict__.copy()
+        state.pop('_controller_index', None)
+        state.pop('dirty', None)
+        return state
+
+    def mark_dirty(self):
+        """Flag that the tree, its subscriptions or a controller's state have changed since the ViewState was
+        loaded."""
+        self.dirty = True
+
+    def mark_clean(self):
+        self.dirty = False
+
+    @property
+    def controller_index(self):
+        """Mapping of path -> controller for every active controller in the tree. It is built on first access then
+        kept up to date by the controllers as they are attached and detached."""
+        if self._controller_index is None:
+            self._controller_index = {}
+            self.index_controller_tree(self.root_controller)
+
+        return self._controller_index
+
+    def index_controller_tree(self, controller):
+        """Add a controller and all the controllers below it to the path index."""
+        if self._controller_index is None:
+            return
+
+        for tree_controller in controller.iter_tree():
+            self._controller_index[tree_controller.path] = tree_controller
+
+    def unindex_controller_tree(self, controller):
+        """Remove a controller and all the controllers below it from the path index. Paths that have already been
+        taken over by another controller are left alone."""
+        if self._controller_index is None:
+            return
+
+        for tree_controller in controller.iter_tree():
+            path = tree_controller.path
+
+            if self._controller_index.get(path) is tree_controller:
+                del self._controller_index[path]
 
     def controller_from_path(self, path):
-        split_path = split_and_validate_path(path)
+        try:
+            return self.controller_index[path]
+        except KeyError:
+            pass
 
-        if path == 'page':
-            return self.root_controller
+        split_path = split_and_validate_path(path)
 
         controller = self.root_controller
 
         for path_component in split_path[1:]:
             controller = controller.get_child(path_component)
 
+        self._controller_index[path] = controller
         return controller
 
+    def class_map_delta(self, path, class_map):
+        """Compare the class map of the subtree at path with what was last sent to the client for it, and record it as
+        sent. Returns the paths that are new or have changed assets, and the paths that are no longer in the subtree."""
+        if self.sent_class_map is None:
+            self.sent_class_map = {}
+
+        sent_class_map = self.sent_class_map
+        path_prefix = path + '.'
+        removed = [sent_path for sent_path in sent_class_map
+                   if (sent_path == path or sent_path.startswith(path_prefix)) and sent_path not in class_map]
+        changed = dict((map_path, assets) for map_path, assets in class_map.iteritems()
+                       if sent_class_map.get(map_path) != assets)
+
+        if removed or changed:
+            for removed_path in removed:
+                del sent_class_map[removed_path]
+
+            sent_class_map.update(changed)
+            self.mark_dirty()
+
+        return {'changed': changed, 'removed': removed}
+
+    def forget_sent_controller_tree(self, controller):
+        """Mark what was sent to the client for the paths of a controller that has just been attached, and those below
+        it, as out of date. The client's controllers at those paths belong to the controllers that were there before,
+        so the next class_map_delta reports the paths as changed even if their assets are the same."""
+        if not self.sent_class_map:
+            return
+
+        for tree_controller in controller.iter_tree():
+            if tree_controller.path in self.sent_class_map:
+                self.sent_class_map[tree_controller.path] = None
+
+    def reset_sent_class_map(self):
+        """Forget what has been sent to the client, e.g. when the page has been loaded again."""
+        if self.sent_class_map:
+            self.sent_class_map = None
+            self.mark_dirty()
+
+    def reset_sent_html(self):
+        """Forget the HTML sent to the client, e.g. when the page has been loaded again."""
+        if self.sent_html_digests:
+            self.sent_html_digests = None
+            self.mark_dirty()
+
+    def swap_sent_html_digest(self, path, digest):
+        """Record digest as that of the HTML last sent to the client for path, and return what was recorded before (or
+        None). What was recorded for the path's ancestors and descendants is dropped, as the client's copy of it has
+        changed. Only the digest is kept so the HTML isn't stored with the ViewState."""
+        if self.sent_html_digests is None:
+            self.sent_html_digests = {}
+
+        sent_html_digests = self.sent_html_digests
+        base_digest = sent_html_digests.pop(path, None)
+        changed = base_digest != digest
+
+        for sent_path in sent_html_digests.keys():
+            if sent_path.startswith(path + '.') or path.startswith(sent_path + '.'):
+                del sent_html_digests[sent_path]
+                changed = True
+
+        sent_html_digests[path] = digest
+
+        if changed:
+            self.mark_dirty()
+
+        return base_digest
+
     def post_setup(self):
         self.root_controller._post_attach()
 
@@ -93,29 +219,206 @@ class ViewState(object):
         return parent_controller.pop_child(child_key)
 
 
+class ViewStateHandle(object):
+    """Wraps a single ViewState in a ViewStateManager. Each ViewState is serialized separately, and is only
+    deserialized when it is first requested, so loading a session doesn't unpickle every tab. A ViewState that was
+    never requested, or that hasn't changed, is written back as the same data it was loaded from."""
+
+    def __init__(self, view_state):
+        self._view_state = view_state
+        self._data = None
+        self.last_used = time.time()
+
+    def __getstate__(self):
+        if self._view_state is not None and (self._view_state.dirty or self._data is None):
+            self._data = dumps_view_state(self._view_state)
+
+        return {'_data': self._data, 'last_used': self.last_used}
+
+    def __setstate__(self, state):
+        self._data = state['_data']
+        self._view_state = None
+        self.last_used = state.get('last_used', time.time())
+
+    @property
+    def is_loaded(self):
+        return self._view_state is not None
+
+    @property
+    def view_state(self):
+        if self._view_state is None:
+            self._view_state = loads_view_state(self._data)
+
+        return self._view_state
+
+
 class ViewStateManager(object):
+    """Holds the ViewStates (one per browser tab) for a session, keyed by index. Indexes are never reused, so a tab
+    whose ViewState has been evicted gets a ViewStateError rather than another tab's ViewState.
+
+    Once there are more than max_view_states, the least recently used ViewStates are evicted, as are any that have not
+    been used for idle_ttl seconds. Either limit can be None to disable it.
+
+    Using a ViewState only marks the manager dirty once its last use time has moved by more than last_used_step
+    seconds, so reads don't force the session to be saved on every request."""
+
+    max_view_states = VIEWSTATE_MAX_PER_SESSION
+    idle_ttl = VIEWSTATE_IDLE_TTL
+    last_used_step = 60
+    _dirty = False
+
     def __init__(self):
-        self._state_store = []
+        self._state_store = {}
+        self._next_index = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_dirty', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        # sessions stored before eviction existed hold a list, which may hold the ViewStates themselves
+        if isinstance(self._state_store, list):
+            self._state_store = dict(
+                (index, view_state if isinstance(view_state, ViewStateHandle) else ViewStateHandle(view_state))
+                for index, view_state in enumerate(self._state_store))
+            self._next_index = len(self._state_store)
+
+    def __len__(self):
+        return len(self._state_store)
+
+    @property
+    def dirty(self):
+        """True if ViewStates have been added or evicted, or any ViewState that has been loaded has changed."""
+        return self._dirty or any(handle.is_loaded and handle.view_state.dirty
+                                  for handle in self._state_store.itervalues())
+
+    def mark_clean(self):
+        self._dirty = False
+
+        for handle in self._state_store.itervalues():
+            if handle.is_loaded:
+                handle.view_state.mark_clean()
+
+    def _evict(self, current_index):
+        """Remove idle ViewStates, then the least recently used ones until there are no more than max_view_states.
+        The ViewState that is currently being used is never evicted."""
+        if self.idle_ttl is not None:
+            oldest_allowed = time.time() - self.idle_ttl
+
+            for index, handle in self._state_store.items():
+                if handle.last_used < oldest_allowed and index != current_index:
+                    del self._state_store[index]
+                    self._dirty = True
+
+        if self.max_view_states is not None and len(self._state_store) > self.max_view_states:
+            lru_indexes = sorted((index for index in self._state_store if index != current_index),
+                                 key=lambda index: self._state_store[index].last_used)
+
+            for index in lru_indexes[:len(self._state_store) - self.max_view_states]:
+                del self._state_store[index]
+                self._dirty = True
 
     def get_view_state(self, index, no_create=False):
         index = None if index < 0 else index
+        handle = self._state_store.get(index)
 
-        try:
-            view_state = self._state_store[index]
-        except (IndexError, TypeError):
+        if handle is not None and self.idle_ttl is not None and handle.last_used < time.time() - self.idle_ttl:
+            del self._state_store[index]
+            self._dirty = True
+            handle = None
+
+        if handle is None:
             if no_create:
                 raise ViewStateError("ViewState does not exist at index %s" % index)
+
             view_state = get_default_viewstate()
-            self._state_store.append(view_state)
-            view_state.index = len(self._state_store) - 1
+            self._add_view_state(view_state)
+        else:
+            view_state = handle.view_state
+            now = time.time()
+
+            if now - handle.last_used > self.last_used_step:
+                self._dirty = True
+
+            handle.last_used = now
+
+        self._evict(view_state.index)
 
         return view_state
 
+    def _add_view_state(self, view_state):
+        """Give a new ViewState the next index and store it."""
+        view_state.index = self._next_index
+        self._next_index += 1
+        self._state_store[view_state.index] = ViewStateHandle(view_state)
+        self._dirty = True
 
-def get_default_viewstate():
+    def fork_view_state(self, index):
+        """Copy the ViewState at index into a new ViewState with its own index, e.g. for a link opened in a new tab.
+        If the ViewState's tree isn't clone safe the new ViewState is a default one instead. Raises ViewStateError if
+        there is no ViewState at index."""
+        view_state = clone_view_state(self.get_view_state(index, no_create=True)) or get_default_viewstate()
+        self._add_view_state(view_state)
+        self._evict(view_state.index)
+
+        return view_state
+
+
+# serialized prototype ViewState for each root component, or None if its tree can't be cloned
+_prototypes = {}
+
+
+def _serialize_for_cloning(view_state):
+    if not all(controller.clone_safe for controller in view_state.root_controller.iter_tree()):
+        return None
+
+    try:
+        return dumps_view_state(view_state, compression_level=0)
+    except (pickle.PicklingError, TypeError):
+        return None
+
+
+def _clone_from_data(data):
+    view_state = loads_view_state(data)
+    view_state.mark_dirty()
+    return view_state
+
+
+def clone_view_state(view_state):
+    """Return an independent copy of a ViewState, without an index, or None if it isn't clone safe."""
+    data = _serialize_for_cloning(view_state)
+    return None if data is None else _clone_from_data(data)
+
+
+def _build_default_viewstate():
     from notification import NotificationCentre
     root = init_controller(DEFAULT_ROOT_COMPONENT)
     vs = ViewState(root)
     NotificationCentre(vs)
     vs.post_setup()
     return vs
+
+
+def get_default_viewstate():
+    """Return a new ViewState with the DEFAULT_ROOT_COMPONENT as its root. The first is built from scratch and a
+    serialized copy is kept as a prototype that later ViewStates are cloned from, so the default tree is only built
+    (and its post_attach hooks run) once per process."""
+    if DEFAULT_ROOT_COMPONENT not in _prototypes:
+        view_state = _build_default_viewstate()
+        _prototypes[DEFAULT_ROOT_COMPONENT] = _serialize_for_cloning(view_state)
+        return view_state
+
+    prototype = _prototypes[DEFAULT_ROOT_COMPONENT]
+
+    if prototype is None:
+        return _build_default_viewstate()
+
+    return _clone_from_data(prototype)
+
+
+def clear_viewstate_prototypes():
+    """Forget the prototype ViewStates, so the next ViewState for each root component is built from scratch."""
+    _prototypes.clear()